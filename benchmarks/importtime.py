@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Profile what hapcat spends its import time on.
+
+This runs a statement in a fresh interpreter with ``python -X importtime``,
+and summarizes the slowest modules, and the total time of each top level
+package, so the dependencies worth loading lazily stand out.
+
+The application uses the configuration in ``HAPCAT_FLASK_CONFIG``, if set,
+which should point at a database whose schema is up to date, so migrations
+aren't counted.
+
+Example:
+    Run from the root of the source tree::
+
+        python benchmarks/importtime.py --statement 'import hapcat; hapcat.app'
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_line = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def make_argparser():
+    """Return an ArgumentParser for the benchmark.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Profile what hapcat spends its import time on.',
+    )
+
+    parser.add_argument(
+        '--statement',
+        default='import hapcat; hapcat.app',
+        help='the statement to profile (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--top',
+        type=int,
+        default=15,
+        help='the number of modules and packages to list (default: '
+            '%(default)s)',
+    )
+
+    return parser
+
+
+def profile(statement):
+    """Profile the imports of a statement in a new interpreter.
+
+    :returns: A list of tuples of each module's own time and cumulative
+        time, in microseconds, its nesting depth, and its name, in the order
+        they finished importing.
+    """
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [SOURCE] + [path for path in [env.get('PYTHONPATH')] if path]
+    )
+
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    err = process.communicate()[1].decode('utf-8', 'replace')
+
+    if process.returncode:
+        sys.stderr.write(err)
+        raise SystemExit(process.returncode)
+
+    modules = []
+
+    for line in err.splitlines():
+        match = _line.match(line)
+
+        if match:
+            modules.append((
+                int(match.group(1)),
+                int(match.group(2)),
+                len(match.group(3)) // 2,
+                match.group(4),
+            ))
+
+    return modules
+
+
+def main():
+    """Run the benchmark.
+    """
+
+    args = make_argparser().parse_args()
+
+    modules = profile(args.statement)
+    packages = {}
+
+    for own, cumulative, depth, name in modules:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + own
+
+    total = sum(own for own, cumulative, depth, name in modules)
+
+    print('{0}: {1:.1f}ms importing {2} modules'.format(
+        args.statement,
+        total / 1000,
+        len(modules),
+    ))
+
+    print('slowest top level imports, including what they import:')
+
+    toplevel = sorted(
+        [module for module in modules if module[2] == 0],
+        key=lambda module: -module[1],
+    )
+
+    for own, cumulative, depth, name in toplevel[:args.top]:
+        print('  {0:>8.1f}ms  {1}'.format(cumulative / 1000, name))
+
+    print('slowest packages, by their own modules:')
+
+    for package, own in sorted(
+            packages.items(),
+            key=lambda item: -item[1],
+        )[:args.top]:
+        print('  {0:>8.1f}ms  {1}'.format(own / 1000, package))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
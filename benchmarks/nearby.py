@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark finding the raw locations near a point.
+
+This fills a database with raw locations scattered over a region, then
+times radius searches around random points in it.
+
+By default this uses a temporary SQLite database.
+To benchmark PostgreSQL, give an empty scratch database with ``--dburl``;
+the tables are created in it, and the test rows are left behind.
+
+Example:
+    Run from the root of the source tree::
+
+        python benchmarks/nearby.py --locations 1000000 --radius 2000
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import sqlalchemy
+import sqlalchemy.orm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hapcat.feed
+import hapcat.geo
+
+from hapcat import db
+
+from hapcat.models import (
+    RawLocation,
+    UUIDObject,
+)
+
+
+def make_argparser():
+    """Return an ArgumentParser for the benchmark.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark finding the raw locations near a point.',
+    )
+
+    parser.add_argument(
+        '--dburl',
+        help='the database URL to use (default: a temporary SQLite file)',
+    )
+
+    parser.add_argument(
+        '--locations',
+        type=int,
+        default=1000000,
+        help='the number of raw locations (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--region',
+        type=float,
+        default=2.0,
+        help='the size of the region, in degrees (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--radius',
+        type=float,
+        default=2000,
+        help='the search radius, in meters (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--queries',
+        type=int,
+        default=100,
+        help='the number of searches (default: %(default)s)',
+    )
+
+    return parser
+
+
+def setup(engine, numlocations, region):
+    """Create the tables and fill them with raw locations.
+    """
+
+    db.metadata.create_all(engine)
+
+    rng = random.Random(1234)
+    batch = 10000
+
+    with engine.begin() as conn:
+        for start in range(0, numlocations, batch):
+            rows = []
+
+            for i in range(start, min(start + batch, numlocations)):
+                latitude = 41 + rng.uniform(0, region)
+                longitude = -82 + rng.uniform(0, region)
+
+                rows.append({
+                    'id': uuid.uuid4(),
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'geohash': hapcat.geo.encode(latitude, longitude),
+                    'address': u'{0} Benchmark St'.format(i),
+                })
+
+            conn.execute(
+                UUIDObject.__table__.insert(),
+                [{'id': row['id'], 'type': 'rawlocation'} for row in rows],
+            )
+            conn.execute(RawLocation.__table__.insert(), rows)
+
+
+def main():
+    """Run the benchmark.
+    """
+
+    args = make_argparser().parse_args()
+
+    tmpdir = None
+    dburl = args.dburl
+
+    if dburl is None:
+        tmpdir = tempfile.mkdtemp()
+        dburl = 'sqlite:///{0}'.format(os.path.join(tmpdir, 'nearby.db'))
+
+    engine = sqlalchemy.create_engine(dburl)
+
+    try:
+        began = time.time()
+        setup(engine, args.locations, args.region)
+        print('loaded {0} locations in {1:.1f}s'.format(
+            args.locations,
+            time.time() - began,
+        ))
+
+        session = sqlalchemy.orm.Session(bind=engine)
+        rng = random.Random(5678)
+        timings = []
+        found = 0
+
+        for i in range(args.queries):
+            latitude = 41 + rng.uniform(0, args.region)
+            longitude = -82 + rng.uniform(0, args.region)
+
+            began = time.time()
+            found += len(hapcat.feed.nearby_rawlocations(
+                session,
+                latitude,
+                longitude,
+                args.radius,
+            ))
+            timings.append(time.time() - began)
+
+        session.close()
+    finally:
+        engine.dispose()
+
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    timings.sort()
+
+    print('{0} searches within {1:.0f}m: {2:.0f} found on average'.format(
+        args.queries,
+        args.radius,
+        found / args.queries,
+    ))
+    print('median {0:.2f}ms, 95th percentile {1:.2f}ms'.format(
+        timings[len(timings) // 2] * 1000,
+        timings[int(len(timings) * 0.95)] * 1000,
+    ))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark scoring votables for personalized suggestions.
+
+This fills a tag index with votables tagged at random, then times scoring
+all of them against random tag affinities and picking the best of each
+section, as the personalized suggestions do.
+No database is needed.
+
+Example:
+    Run from the root of the source tree::
+
+        python benchmarks/personalized.py --votables 100000 --tags 500
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hapcat.tagindex
+
+
+def make_argparser():
+    """Return an ArgumentParser for the benchmark.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark scoring votables for personalized suggestions.',
+    )
+
+    parser.add_argument(
+        '--votables',
+        type=int,
+        default=100000,
+        help='the number of votables (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--tags',
+        type=int,
+        default=500,
+        help='the number of tags (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--tags-per-votable',
+        type=int,
+        default=4,
+        help='the number of tags on each votable (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--liked',
+        type=int,
+        default=30,
+        help='the number of tags each user likes (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=20,
+        help='the number of suggestions per section (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--queries',
+        type=int,
+        default=100,
+        help='the number of users to score for (default: %(default)s)',
+    )
+
+    return parser
+
+
+def setup(index, numvotables, numtags, tagspervotable):
+    """Fill the tag index with votables tagged at random.
+
+    :returns: The tag UUIDs.
+    """
+
+    rng = random.Random(1234)
+
+    tags = [uuid.uuid4() for i in range(numtags)]
+    ids = [uuid.UUID(int=rng.getrandbits(128)) for i in range(numvotables)]
+    codes = [rng.randint(0, 1) for i in range(numvotables)]
+    postings = {}
+
+    for number in range(numvotables):
+        for tag_id in rng.sample(tags, tagspervotable):
+            postings.setdefault(tag_id, []).append(number)
+
+    index._load(
+        ids,
+        codes,
+        {votable_id: number for number, votable_id in enumerate(ids)},
+        {
+            tag_id: numpy.array(votables, dtype=numpy.int64)
+            for tag_id, votables in postings.items()
+        },
+    )
+
+    # Never rebuild it from the database.
+    index._built = float('inf')
+
+    return tags
+
+
+def main():
+    """Run the benchmark.
+    """
+
+    args = make_argparser().parse_args()
+
+    index = hapcat.tagindex.TagIndex()
+
+    began = time.time()
+    tags = setup(index, args.votables, args.tags, args.tags_per_votable)
+    print('indexed {0} votables in {1:.1f}s'.format(
+        args.votables,
+        time.time() - began,
+    ))
+
+    # The matrix is built on first use, and kept until a votable is added.
+    began = time.time()
+    index.scores({})
+    print('built the votable by tag matrix in {0:.2f}ms'.format(
+        (time.time() - began) * 1000,
+    ))
+
+    rng = random.Random(5678)
+    timings = []
+
+    for i in range(args.queries):
+        affinity = {
+            tag_id: rng.randint(1, 10)
+            for tag_id in rng.sample(tags, args.liked)
+        }
+
+        began = time.time()
+        scores = index.scores(affinity)
+
+        for section in ('locations', 'events'):
+            scores.top(section, args.limit)
+
+        timings.append(time.time() - began)
+
+    timings.sort()
+
+    print('{0} users scored against {1} votables'.format(
+        args.queries,
+        args.votables,
+    ))
+    print('median {0:.2f}ms, 95th percentile {1:.2f}ms'.format(
+        timings[len(timings) // 2] * 1000,
+        timings[int(len(timings) * 0.95)] * 1000,
+    ))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark how long hapcat takes to start.
+
+This times fresh interpreters importing the hapcat package alone, as the
+commands' ``--version`` does, and starting the application, as each server
+worker does, and fails if the median of either is over its threshold, to
+catch startup time regressions.
+
+The application uses the configuration in ``HAPCAT_FLASK_CONFIG``, if set,
+which should point at a database whose schema is up to date, so migrations
+aren't counted.
+
+Example:
+    Run from the root of the source tree::
+
+        python benchmarks/startup.py --runs 10 --max-start 1.5
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import subprocess
+import sys
+
+SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Time the statement itself, not starting the interpreter.
+TIMER = '''
+import time
+began = time.time()
+{0}
+print(time.time() - began)
+'''
+
+
+def make_argparser():
+    """Return an ArgumentParser for the benchmark.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark how long hapcat takes to start.',
+    )
+
+    parser.add_argument(
+        '--runs',
+        type=int,
+        default=5,
+        help='the number of times to start each way (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--max-import',
+        type=float,
+        default=0.05,
+        help='the longest importing the package may take, in seconds '
+            '(default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--max-start',
+        type=float,
+        default=2.0,
+        help='the longest starting the application may take, in seconds '
+            '(default: %(default)s)',
+    )
+
+    return parser
+
+
+def timed(statement):
+    """Time a statement in a new interpreter.
+
+    :returns: The time, in seconds.
+    """
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [SOURCE] + [path for path in [env.get('PYTHONPATH')] if path]
+    )
+
+    output = subprocess.check_output(
+        [sys.executable, '-c', TIMER.format(statement)],
+        env=env,
+    )
+
+    return float(output.decode('ascii').split()[-1])
+
+
+def main():
+    """Run the benchmark.
+    """
+
+    args = make_argparser().parse_args()
+
+    failed = False
+
+    for label, statement, threshold in [
+            ('import hapcat', 'import hapcat', args.max_import),
+            ('start the application', 'import hapcat; hapcat.app',
+                args.max_start),
+        ]:
+        timings = sorted(timed(statement) for i in range(args.runs))
+        median = timings[len(timings) // 2]
+
+        print('{0}: median {1:.1f}ms, slowest {2:.1f}ms, limit {3:.1f}ms'
+            .format(
+                label,
+                median * 1000,
+                timings[-1] * 1000,
+                threshold * 1000,
+            ))
+
+        if median > threshold:
+            print('{0}: too slow'.format(label), file=sys.stderr)
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark password strength checks on worst-case passwords.
+
+zxcvbn's time grows steeply with the length of the password, fastest for
+repetitive passwords which match many patterns at once.
+This times scoring such passwords at increasing lengths in this process,
+then times whole checks of them through the worker processes, capped at
+``[passwords] strength_max_length`` characters, as registering does.
+
+Example:
+    Run from the root of the source tree::
+
+        python benchmarks/strength.py --lengths 16,32,64,72 --repeat 5
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hapcat.strength
+
+from hapcat import app
+
+# Repeated patterns which match many dictionary words, l33t substitutions,
+# keyboard walks, sequences, and dates at once.
+WORST_CASES = [
+    u'a',
+    u'a1!',
+    u'p@ssw0rd',
+    u'1qaz2wsx',
+    u'qwertyuiop',
+    u'abcdefghijklmnopqrstuvwxyz',
+    u'19991231',
+    u'Tr0ub4dor&3correcthorsebatterystaple',
+]
+
+
+def make_argparser():
+    """Return an ArgumentParser for the benchmark.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark password strength checks on worst-case '
+            'passwords.',
+    )
+
+    parser.add_argument(
+        '--lengths',
+        default='16,32,64,72',
+        help='the comma separated password lengths to score in this process '
+            '(default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--length',
+        type=int,
+        default=1000,
+        help='the length of the passwords to check through the workers '
+            '(default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='the number of times to time each password (default: '
+            '%(default)s)',
+    )
+
+    return parser
+
+
+def timed(func, *args):
+    """Time a call.
+
+    :returns: The time, in seconds.
+    """
+
+    began = time.time()
+    func(*args)
+
+    return time.time() - began
+
+
+def main():
+    """Run the benchmark.
+    """
+
+    args = make_argparser().parse_args()
+    lengths = [int(length) for length in args.lengths.split(',')]
+
+    print('scoring in this process, worst of {0}:'.format(args.repeat))
+
+    for pattern in WORST_CASES:
+        password = pattern * (max(lengths) // len(pattern) + 1)
+
+        print('  {0!r:40} {1}'.format(
+            pattern,
+            '  '.join(
+                '{0:>4}: {1:7.1f}ms'.format(
+                    length,
+                    max(
+                        timed(
+                            hapcat.strength.score,
+                            password,
+                            [],
+                            length,
+                        )
+                        for i in range(args.repeat)
+                    ) * 1000,
+                )
+                for length in lengths
+            ),
+        ))
+
+    checker = hapcat.strength.StrengthChecker()
+
+    print('checking {0} characters through the workers, capped at {1}, '
+        'worst of {2}:'.format(
+            args.length,
+            app.iniconfig.getint('passwords', 'strength_max_length'),
+            args.repeat,
+        ))
+
+    # Start the workers, and import zxcvbn in them.
+    checker.check(u'warm up', [])
+
+    try:
+        for pattern in WORST_CASES:
+            password = pattern * (args.length // len(pattern) + 1)
+
+            print('  {0!r:40} {1:7.1f}ms'.format(
+                pattern,
+                max(
+                    timed(checker.check, password[:args.length], [])
+                    for i in range(args.repeat)
+                ) * 1000,
+            ))
+    finally:
+        checker.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
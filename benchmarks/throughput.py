@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark the request throughput of hapcatd's servers.
+
+This starts hapcatd with the ``--dev`` Werkzeug development server, and
+then with the preforking production server, each against a temporary SQLite
+database with the test data, and has several client processes request an
+endpoint as fast as they can for a while, reporting the requests per second
+and latencies of each.
+
+Example:
+    Run from the root of the source tree::
+
+        python benchmarks/throughput.py --clients 8 --duration 10 \\
+            --processes 4 --threads 2
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = '''
+[apiserver]
+address = 127.0.0.1
+port = {port}
+
+[database]
+dburl = sqlite:///{database}
+migrations = never
+pool_size = {threads}
+
+[flask]
+debug = no
+testing = no
+
+[uwsgi]
+processes = {processes}
+threads = {threads}
+'''
+
+
+def make_argparser():
+    """Return an ArgumentParser for the benchmark.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the request throughput of hapcatd's servers.",
+    )
+
+    parser.add_argument(
+        '--path',
+        default='/api/v0/suggestions/',
+        help='the path to request (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--clients',
+        type=int,
+        default=8,
+        help='the number of client processes (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--duration',
+        type=float,
+        default=10,
+        help='how long to request for, in seconds (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=4,
+        help='the number of server processes (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=2,
+        help='the number of threads per server process (default: '
+            '%(default)s)',
+    )
+
+    return parser
+
+
+def make_database(path):
+    """Create a SQLite database with the test data.
+    """
+
+    configpath = path + '.conf'
+
+    with open(configpath, 'w') as configfile:
+        configfile.write(
+            '[database]\ndburl = sqlite:///{0}\nmigrations = never\n'
+            .format(path)
+        )
+
+    env = dict(os.environ)
+    env['HAPCAT_FLASK_CONFIG'] = configpath
+    env['PYTHONPATH'] = SOURCE
+
+    subprocess.check_call(
+        [
+            sys.executable,
+            '-c',
+            # Starting the application needs the tables already.
+            'import hapcat.application, hapcat.dbutil, hapcat.models\n'
+            'with hapcat.application.app.app_context():\n'
+            '    hapcat.application.db.create_all()\n'
+            '    hapcat.dbutil.load_test_data()\n',
+        ],
+        env=env,
+    )
+
+
+def free_port():
+    """Find a free port to listen on.
+    """
+
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    return port
+
+
+def client(url, deadline, results):
+    """Request a URL until the deadline, reporting the latencies.
+    """
+
+    latencies = []
+    errors = 0
+
+    while time.time() < deadline:
+        began = time.time()
+
+        try:
+            urlopen(url, timeout=30).read()
+        except (IOError, OSError):
+            errors += 1
+            continue
+
+        latencies.append(time.time() - began)
+
+    results.put((latencies, errors))
+
+
+def run(args, configpath, port, dev):
+    """Start hapcatd, and benchmark it.
+
+    :returns: A tuple of the requests per second, the median and 99th
+        percentile latencies, and the number of errors.
+    """
+
+    env = dict(os.environ)
+    env.pop('HAPCAT_FLASK_CONFIG', None)
+    env['PYTHONPATH'] = SOURCE
+
+    command = [sys.executable, '-m', 'hapcat.hapcat', '-c', configpath]
+
+    if dev:
+        command.append('--dev')
+
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen(
+            command,
+            env=env,
+            stdout=devnull,
+            stderr=devnull,
+        )
+
+    url = 'http://127.0.0.1:{0}{1}'.format(port, args.path)
+
+    try:
+        deadline = time.time() + 30
+
+        while True:
+            try:
+                urlopen(url, timeout=5).read()
+                break
+            except (IOError, OSError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+        results = multiprocessing.Queue()
+        deadline = time.time() + args.duration
+
+        clients = [
+            multiprocessing.Process(
+                target=client,
+                args=(url, deadline, results),
+            )
+            for i in range(args.clients)
+        ]
+
+        for process in clients:
+            process.start()
+
+        latencies = []
+        errors = 0
+
+        for process in clients:
+            clientlatencies, clienterrors = results.get()
+            latencies.extend(clientlatencies)
+            errors += clienterrors
+
+        for process in clients:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+
+    if not latencies:
+        return 0, 0, 0, errors
+
+    return (
+        len(latencies) / args.duration,
+        latencies[len(latencies) // 2],
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        errors,
+    )
+
+
+def main():
+    """Run the benchmark.
+    """
+
+    args = make_argparser().parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        database = os.path.join(tmpdir, 'throughput.db')
+        make_database(database)
+
+        for label, dev in [
+                ('--dev', True),
+                ('{0} processes of {1} threads'.format(
+                    args.processes,
+                    args.threads,
+                ), False),
+            ]:
+            port = free_port()
+            configpath = os.path.join(tmpdir, 'hapcatd.conf')
+
+            with open(configpath, 'w') as configfile:
+                configfile.write(CONFIG.format(
+                    port=port,
+                    database=database,
+                    processes=args.processes,
+                    threads=args.threads,
+                ))
+
+            rate, median, slowest, errors = run(args, configpath, port, dev)
+
+            print('{0}: {1:.1f} requests/s, median {2:.1f}ms, 99th percentile '
+                '{3:.1f}ms, {4} errors'.format(
+                    label,
+                    rate,
+                    median * 1000,
+                    slowest * 1000,
+                    errors,
+                ))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
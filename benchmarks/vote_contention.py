@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark concurrent votes for the same votable.
+
+Several threads, each with their own database connection, vote for the
+same votable as the same user as fast as they can.
+This reports the vote throughput, and fails if any votes were lost.
+
+By default this uses a temporary SQLite database.
+To benchmark PostgreSQL, give an empty scratch database with ``--dburl``;
+the tables are created in it, and the test rows are left behind.
+
+Example:
+    Run from the root of the source tree::
+
+        python benchmarks/vote_contention.py --threads 16 --votes 500
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import sqlalchemy
+import sqlalchemy.orm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hapcat.dbutil
+
+from hapcat import db
+
+from hapcat.models import (
+    Location,
+    RawLocation,
+    User,
+    Vote,
+)
+
+
+def make_argparser():
+    """Return an ArgumentParser for the benchmark.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark concurrent votes for the same votable.',
+    )
+
+    parser.add_argument(
+        '--dburl',
+        help='the database URL to use (default: a temporary SQLite file)',
+    )
+
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=8,
+        help='the number of voting threads (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--votes',
+        type=int,
+        default=200,
+        help='the number of votes per thread (default: %(default)s)',
+    )
+
+    return parser
+
+
+def setup(engine):
+    """Create the tables, a user, and a location, returning their IDs.
+    """
+
+    db.metadata.create_all(engine)
+
+    session = sqlalchemy.orm.Session(bind=engine)
+
+    userid = uuid.uuid4()
+    locationid = uuid.uuid4()
+
+    session.add_all([
+        User(
+            id=userid,
+            username=u'bench-{0}'.format(userid),
+            email=u'bench@example.com',
+            date_of_birth=datetime.date(1999, 9, 9),
+            password=u'correct horse battery',
+        ),
+        Location(
+            id=locationid,
+            name=u'Benchmark location',
+            rawlocation=RawLocation(
+                id=uuid.uuid4(),
+                address=u'Benchmark {0}'.format(locationid),
+            ),
+        ),
+    ])
+
+    session.commit()
+    session.close()
+
+    return userid, locationid
+
+
+def run(engine, numthreads, numvotes, userid, locationid):
+    """Run the voting threads, returning the elapsed time and any errors.
+    """
+
+    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+    errors = []
+    start = threading.Event()
+
+    def voter():
+        session = Session()
+        start.wait()
+
+        try:
+            for i in range(numvotes):
+                hapcat.dbutil.add_votes(session, locationid, userid)
+                session.commit()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=voter) for i in range(numthreads)]
+
+    for thread in threads:
+        thread.start()
+
+    began = time.time()
+    start.set()
+
+    for thread in threads:
+        thread.join()
+
+    return time.time() - began, errors
+
+
+def main():
+    """Run the benchmark.
+    """
+
+    args = make_argparser().parse_args()
+
+    tmpdir = None
+    dburl = args.dburl
+
+    if dburl is None:
+        tmpdir = tempfile.mkdtemp()
+        dburl = 'sqlite:///{0}'.format(os.path.join(tmpdir, 'votes.db'))
+
+    if dburl.startswith('sqlite'):
+        # Wait for the other writers rather than failing.
+        engine = sqlalchemy.create_engine(
+            dburl,
+            connect_args={'timeout': 60},
+        )
+    else:
+        engine = sqlalchemy.create_engine(dburl, pool_size=args.threads)
+
+    try:
+        userid, locationid = setup(engine)
+        elapsed, errors = run(
+            engine,
+            args.threads,
+            args.votes,
+            userid,
+            locationid,
+        )
+
+        session = sqlalchemy.orm.Session(bind=engine)
+        total = session.query(Vote.numvotes).filter(
+            Vote.votable_id == locationid,
+            Vote.user_id == userid,
+        ).scalar() or 0
+        session.close()
+    finally:
+        engine.dispose()
+
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    expected = args.threads * args.votes
+
+    print('{0} threads x {1} votes in {2:.3f}s: {3:.0f} votes/s'.format(
+        args.threads,
+        args.votes,
+        elapsed,
+        expected / elapsed,
+    ))
+
+    for error in errors:
+        print('error: {0!r}'.format(error))
+
+    print('counted {0} of {1} votes'.format(total, expected))
+
+    if errors or total != expected:
+        print('FAILED: votes were lost')
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
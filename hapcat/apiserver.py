@@ -6,11 +6,9 @@
 
 from __future__ import absolute_import
 
-from pkg_resources import resource_string
-
 import hapcat
 
-from hapcat import (
+from hapcat.application import (
     app,
     db,
     jwt,
@@ -28,6 +26,7 @@ from flask_jwt import (
     jwt_required,
 )
 
+import os
 import uuid
 import flask
 
@@ -35,16 +34,71 @@ from sqlalchemy.exc import (
     IntegrityError,
 )
 
-import random
-
 from hapcat.models import *
 
 import hapcat.dbutil
+import hapcat.feed
+import hapcat.geo
+import hapcat.hashing
+import hapcat.httpcache
+import hapcat.identity
+import hapcat.pool
+import hapcat.replicas
+import hapcat.search
+import hapcat.strength
+import hapcat.tagindex
+import hapcat.usernames
+import hapcat.votebuffer
 
 from flask_api.decorators import set_renderers
 from flask_api.renderers import JSONRenderer, HTMLRenderer
 from flask_api import status
 
+def serialize_votables(ids):
+    """Serialize the events and locations with the given IDs.
+
+    This takes a fixed number of queries however many there are.
+
+    :returns: A dictionary of the serialized votables by ID.
+    """
+
+    serialized = {}
+
+    if not ids:
+        return serialized
+
+    for cls in (Location, Event):
+        votables = db.session.query(cls).options(
+            *cls.serialize_options()
+        ).filter(
+            cls.id.in_(list(ids))
+        )
+
+        for votable in votables:
+            serialized[votable.id] = votable.serialize()
+
+    return serialized
+
+
+def user_exists(userid):
+    """Check whether a user exists.
+
+    Tokens are checked against a cache, so they may outlive their user for a
+    while.
+    """
+
+    return db.session.query(User.id).filter(
+        User.id == userid
+    ).scalar() is not None
+
+
+# The server info only changes with the backend version.
+serverinfo_etag = hapcat.httpcache.make_etag(
+    'serverinfo',
+    hapcat.__api_versions__,
+)
+
+
 @app.route('/api/v<int:version>/serverinfo/')
 def serverinfo(
         version,
@@ -57,8 +111,15 @@ def serverinfo(
 
     :>json list(int) api_versions: The supported API versions
 
+    :reqheader If-None-Match: If this matches the server info's ETag, nothing
+        is sent.
+
+    :resheader ETag: The ETag of the server info.
+
     :statuscode 200: No error
 
+    :statuscode 304: The server info hasn't changed
+
     **Example request**:
 
     .. http:example:: curl
@@ -81,10 +142,13 @@ def serverinfo(
         }
     """
 
-    return {
-        'server_version': hapcat.__version__,
-        'api_versions': hapcat.__api_versions__,
-    }
+    return hapcat.httpcache.cached(
+        serverinfo_etag,
+        lambda: {
+            'server_version': hapcat.__version__,
+            'api_versions': hapcat.__api_versions__,
+        },
+    )
 
 @app.route('/api/serverinfo/')
 def serverinfo_redirect():
@@ -108,7 +172,97 @@ def serverinfo_redirect():
 
     return flask.redirect('/api/v0/serverinfo/')
 
+@app.route('/api/v<int:version>/poolstats/')
+def poolstats(
+        version,
+    ):
+    """Get the database connection pool statistics of the answering process.
+
+    Each server process has its own pool, so successive requests may be
+    answered by different processes.
+    The checkout statistics count from when the process started, and are
+    ``null`` for pools which aren't queued, such as SQLite's by default.
+
+    This reveals the server's process IDs, so it's only available if
+    ``[apiserver] poolstats`` is true.
+
+    :query version: The version of the API currently in use
+
+    :>json int pid: The ID of the process which answered
+
+    :>json string pool: The class of the pool
+
+    :>json int size: The number of connections the pool keeps open
+
+    :>json int checked_in: The number of open connections not in use
+
+    :>json int checked_out: The number of connections in use
+
+    :>json int overflow: The number of connections open past the pool size
+
+    :>json int checkouts: The number of times a connection was got
+
+    :>json int timeouts: The number of times getting a connection timed out
+
+    :>json float average_wait: The average seconds getting a connection took
+
+    :>json float max_wait: The longest seconds getting a connection took
+
+    :>json list replicas: The same statistics for each replica's pool
+
+    :statuscode 200: No error
+
+    :statuscode 404: The statistics aren't available
+
+    **Example request**:
+
+    .. http:example:: curl
+
+        GET /api/v0/poolstats/ HTTP/1.0
+        Accept: application/json
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 200 OK
+        Content-Type: application/json
+
+        {
+            "pid": 1234,
+            "pool": "TimedQueuePool",
+            "size": 2,
+            "checked_in": 1,
+            "checked_out": 1,
+            "overflow": 0,
+            "checkouts": 5820,
+            "timeouts": 0,
+            "average_wait": 0.0004,
+            "max_wait": 0.0213,
+            "replicas": []
+        }
+    """
+
+    if not app.iniconfig.getboolean('apiserver', 'poolstats'):
+        return (
+            {
+                'status': 'failure',
+                'message': 'Pool statistics are disabled',
+            },
+            status.HTTP_404_NOT_FOUND
+        )
+
+    description = hapcat.pool.describe(db.engine.pool)
+    description['pid'] = os.getpid()
+    description['replicas'] = [
+        hapcat.pool.describe(replica.engine.pool)
+        for replica in hapcat.replicas.replicas.replicas(app.iniconfig)
+    ]
+
+    return description
+
 @app.route('/api/v<int:version>/tag/<tag>')
+@hapcat.replicas.read_only
 def tag(
         version,
         tag,
@@ -119,8 +273,15 @@ def tag(
 
     :query tag: The UUID of the tag to get info for
 
+    :reqheader If-None-Match: If this matches the tag's ETag, nothing is
+        sent.
+
+    :resheader ETag: The ETag of the tag, which changes whenever it does.
+
     :statuscode 200: Success
 
+    :statuscode 304: The tag hasn't changed
+
     :statuscode 400: Invalid tag ID
 
     :>json UUID id: The tag ID
@@ -167,7 +328,10 @@ def tag(
         tagobj = db.session.query(Tag).filter_by(id=tagid).first()
 
         if tagobj:
-            return tagobj.serialize()
+            return hapcat.httpcache.cached(
+                hapcat.httpcache.object_etag(tagobj),
+                tagobj.serialize,
+            )
 
         else:
             return (
@@ -188,6 +352,7 @@ def tag(
         )
 
 @app.route('/api/v<int:version>/location/<location>')
+@hapcat.replicas.read_only
 def location(
         version,
         location,
@@ -198,14 +363,27 @@ def location(
 
     :query location: The UUID of the location to get info for
 
+    :reqheader If-None-Match: If this matches the location's ETag, nothing is
+        sent.
+
+    :resheader ETag: The ETag of the location, which changes whenever it does.
+
     :statuscode 200: Success
 
+    :statuscode 304: The location hasn't changed
+
     :statuscode 400: Invalid location ID
 
     :>json uuid id: The location ID.
 
     :>json string address: The location address.
 
+    :>json number latitude: The latitude of the address, or ``null`` if it
+        wasn't given when the address was added.
+
+    :>json number longitude: The longitude of the address, or ``null`` if it
+        wasn't given when the address was added.
+
     :>json boolean ephemeral: If true, this location is just an address for
         events.
 
@@ -232,6 +410,8 @@ def location(
         {
             "id": "a25a1b9a-2f5a-4c76-b19f-eb970d2c7049",
             "address": "1444 E Main St, Kent, OH 44240",
+            "latitude": 41.1531,
+            "longitude": -81.3265,
             "name": "Hungry Howie's Pizza",
             "ephemeral": false,
             "tags": [
@@ -251,6 +431,8 @@ def location(
         {
             "id": "cbedf9e2-4a1a-44b9-9e3f-6fe870405329",
             "address": "175 E Main St, Kent, OH 44240",
+            "latitude": null,
+            "longitude": null,
             "ephemeral": true
         }
 
@@ -272,7 +454,10 @@ def location(
         locobj = db.session.query(RawLocation).filter_by(id=locid).first()
 
         if locobj:
-            return locobj.serialize()
+            return hapcat.httpcache.cached(
+                hapcat.httpcache.object_etag(locobj),
+                locobj.serialize,
+            )
 
         else:
             return (
@@ -293,6 +478,7 @@ def location(
         )
 
 @app.route('/api/v<int:version>/event/<event>')
+@hapcat.replicas.read_only
 def event(
         version,
         event,
@@ -303,8 +489,15 @@ def event(
 
     :query event: The UUID of the event to get info for
 
+    :reqheader If-None-Match: If this matches the event's ETag, nothing is
+        sent.
+
+    :resheader ETag: The ETag of the event, which changes whenever it does.
+
     :statuscode 200: Success
 
+    :statuscode 304: The event hasn't changed
+
     :statuscode 400: Invalid event ID
 
     :>json UUID id: The event ID
@@ -361,7 +554,10 @@ def event(
         eventobj = db.session.query(Event).filter_by(id=eventid).first()
 
         if eventobj:
-            return eventobj.serialize()
+            return hapcat.httpcache.cached(
+                hapcat.httpcache.object_etag(eventobj),
+                eventobj.serialize,
+            )
 
         else:
             return (
@@ -381,6 +577,234 @@ def event(
             status.HTTP_400_BAD_REQUEST
         )
 
+def multiget(cls, options=()):
+    """Get several objects by their IDs from the ``ids`` query parameter.
+
+    The objects are loaded with one query and serialized together.
+
+    :param cls: The model class to get.
+
+    :param options: Any query options for loading what serialize() uses.
+
+    :returns: The response for a multi-get endpoint.
+    """
+
+    rawids = [
+        rawid
+        for rawid in request.args.get('ids', '').split(',')
+        if rawid
+    ]
+
+    if len(rawids) > app.iniconfig.getint('apiserver', 'max_multiget_ids'):
+        return (
+            {
+                'status': 'failure',
+                'message': 'Too many IDs',
+            },
+            status.HTTP_400_BAD_REQUEST
+        )
+
+    ids = {}
+    invalid = []
+
+    for rawid in rawids:
+        try:
+            ids[uuid.UUID(rawid)] = rawid
+        except ValueError:
+            invalid.append(rawid)
+
+    found = {}
+
+    if ids:
+        objs = db.session.query(cls).options(*options).filter(
+            cls.id.in_(list(ids))
+        )
+
+        for obj in objs:
+            found[ids.pop(obj.id)] = obj.serialize()
+
+    return {
+        'found': found,
+        'missing': list(ids.values()),
+        'invalid': invalid,
+    }
+
+
+@app.route('/api/v<int:version>/tags/')
+@hapcat.replicas.read_only
+def tags(
+        version,
+    ):
+    """Get several tags' info at once.
+
+    :query version: The version of the API currently in use
+
+    :query ids: The comma-separated UUIDs of the tags to get info for
+
+    :statuscode 200: Success
+
+    :statuscode 400: Too many IDs
+
+    :>json found: The tags found, by ID.
+        See the documentation for
+        :http:get:`/api/v(int:version)/tag/(tag)`.
+
+    :>json missing: The IDs of any tags not found
+
+    :>json invalid: Any invalid IDs
+
+    **Example request**:
+
+    .. http:example:: curl
+
+        GET /api/v0/tags/?ids=d927d94f-beb8-4295-ac78-5c00e6dc217c,bad HTTP/1.0
+        Accept: application/json
+
+    **Example success**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 200 OK
+        Content-Type: application/json
+
+        {
+            "found": {
+                "d927d94f-beb8-4295-ac78-5c00e6dc217c": {
+                    "id": "d927d94f-beb8-4295-ac78-5c00e6dc217c",
+                    "name": "healthy",
+                    "type": "tag"
+                }
+            },
+            "missing": [],
+            "invalid": [
+                "bad"
+            ]
+        }
+    """
+
+    return multiget(Tag)
+
+
+@app.route('/api/v<int:version>/locations/')
+@hapcat.replicas.read_only
+def locations(
+        version,
+    ):
+    """Get several raw locations' info at once.
+
+    :query version: The version of the API currently in use
+
+    :query ids: The comma-separated UUIDs of the locations to get info for
+
+    :statuscode 200: Success
+
+    :statuscode 400: Too many IDs
+
+    :>json found: The locations found, by ID.
+        See the documentation for
+        :http:get:`/api/v(int:version)/location/(location)`.
+
+    :>json missing: The IDs of any locations not found
+
+    :>json invalid: Any invalid IDs
+
+    **Example request**:
+
+    .. http:example:: curl
+
+        GET /api/v0/locations/?ids=cbedf9e2-4a1a-...,a25a1b9a-2f5a-... HTTP/1.0
+        Accept: application/json
+
+    Note that the IDs are truncated here.
+
+    **Example success**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 200 OK
+        Content-Type: application/json
+
+        {
+            "found": {
+                "cbedf9e2-4a1a-44b9-9e3f-6fe870405329": {
+                    "id": "cbedf9e2-4a1a-44b9-9e3f-6fe870405329",
+                    "address": "175 E Main St, Kent, OH 44240",
+                    "latitude": null,
+                    "longitude": null,
+                    "ephemeral": true,
+                    "type": "rawlocation"
+                }
+            },
+            "missing": [
+                "a25a1b9a-2f5a-4c76-b19f-eb970d2c7049"
+            ],
+            "invalid": []
+        }
+    """
+
+    return multiget(RawLocation)
+
+
+@app.route('/api/v<int:version>/events/')
+@hapcat.replicas.read_only
+def events(
+        version,
+    ):
+    """Get several events' info at once.
+
+    :query version: The version of the API currently in use
+
+    :query ids: The comma-separated UUIDs of the events to get info for
+
+    :statuscode 200: Success
+
+    :statuscode 400: Too many IDs
+
+    :>json found: The events found, by ID.
+        See the documentation for
+        :http:get:`/api/v(int:version)/event/(event)`.
+
+    :>json missing: The IDs of any events not found
+
+    :>json invalid: Any invalid IDs
+
+    **Example request**:
+
+    .. http:example:: curl
+
+        GET /api/v0/events/?ids=b0a28a40-b8ad-4131-8c64-071f3fd45bee HTTP/1.0
+        Accept: application/json
+
+    **Example success**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 200 OK
+        Content-Type: application/json
+
+        {
+            "found": {
+                "b0a28a40-b8ad-4131-8c64-071f3fd45bee": {
+                    "id": "b0a28a40-b8ad-4131-8c64-071f3fd45bee",
+                    "name": "The Accidentals - Concert at the Kent Stage",
+                    "location": "cbedf9e2-4a1a-44b9-9e3f-6fe870405329",
+                    "tags": [
+                        "64b9eae5-b220-4a57-92f4-c21dc9b19ec5"
+                    ],
+                    "type": "event",
+                    "photos": [
+                        "https://image-ticketfly.imgix.net/00/02/83/80/81-og.jpg"
+                    ]
+                }
+            },
+            "missing": [],
+            "invalid": []
+        }
+    """
+
+    return multiget(Event, Event.serialize_options())
+
+
 @app.route('/api/v<int:version>/addevent/', methods=['POST'])
 @app.route('/api/v<int:version>/addlocation/', methods=['POST'])
 @jwt_required()
@@ -400,6 +824,11 @@ def addevent(
 
     :<json string address: The address.
 
+    :<json number latitude: The latitude of the address, optionally.
+        This is only used for new addresses, and needs the longitude too.
+
+    :<json number longitude: The longitude of the address, optionally.
+
     :<json list tags: A list of tag UUIDs.
 
     :<json photos tags: A list of photo URLs.
@@ -480,101 +909,192 @@ def addevent(
 
     data = request.get_json(force=True)
 
-    dbobjs = []
-
-    types = {
-        'event': Event,
-        'location': Location,
-    }
-
-    # Validate data.
+    [(votableid, message)] = hapcat.dbutil.add_votables(db.session, [data])
 
-    try:
-        if data['type'] != 'event' and data['type'] != 'location':
-            raise KeyError('Invalid type')
+    if message is not None:
+        db.session.rollback()
 
-        data['name']
-        data['address']
-    except KeyError:
         return (
             {
                 'success': False,
-                'message': 'Invalid request JSON',
+                'message': message,
             },
             status.HTTP_400_BAD_REQUEST,
         )
 
-    # Create or get the address.
-    addr = db.session.query(RawLocation).filter(
-        RawLocation.address == data['address']).scalar()
+    db.session.commit()
 
-    if addr is None:
-        addr = RawLocation(
-            id=uuid.uuid4(),
-            address=data['address'],
-        )
+    hapcat.feed.suggestions_feed.invalidate()
 
-        dbobjs.append(addr)
+    votable = serialize_votables([votableid])[votableid]
+    hapcat.tagindex.tag_index.add(votableid, votable['type'], votable['tags'])
 
-    tags = []
+    return {
+        'success': True,
+        'votable': votable,
+    }
 
-    try:
-        tagids = [uuid.UUID(tag) for tag in data.get('tags', [])]
-        tags = [
-            db.session.query(Tag).filter(Tag.id == tag).scalar()
-            for tag in tagids
-        ]
-    except ValueError:
-        return (
-            {
-                'success': False,
-                'message': 'Invalid tag',
-            },
-            status.HTTP_400_BAD_REQUEST,
-        )
 
-    photos = []
+@app.route('/api/v<int:version>/addevents/', methods=['POST'])
+@app.route('/api/v<int:version>/addlocations/', methods=['POST'])
+@jwt_required()
+def addevents(
+        version,
+    ):
+    """Add several events or locations at once.
+
+    Everything the events and locations refer to is looked up at once, and
+    they're all added in bulk in one transaction.
 
-    try:
-        for url in data.get('photos', []):
-            photo = db.session.query(Photo).filter(
-                Photo.photourl == url).scalar()
-
-            if photo is None:
-                photo = Photo(
-                    id=uuid.uuid4(),
-                    photourl=url,
-                )
+    :reqheader Authorization: The JWT authorization token for the user from
+        :http:post:`/api/v(int:version)/auth/`.
 
-                dbobjs.append(photo)
+    :query version: The version of the API currently in use.
 
-            photos.append(photo)
-    except ValueError:
+    :<jsonarr: The events or locations.
+        See the documentation for
+        :http:post:`/api/v(int:version)/addevent/`
+        for details on the format.
+
+    :>json boolean success: ``True`` or ``False``.
+
+    :>json string message: A message if failed.
+
+    :>json list results: The result of adding each event or location, in
+        order, with whether it succeeded in ``success``, and either the new
+        event or location in ``votable`` or the failure reason in ``message``.
+
+    :statuscode 200: Success, although individual events or locations may have
+        failed.
+
+    :statuscode 400: Invalid request JSON, or too many events or locations.
+
+    **Example request**:
+
+    .. http:example:: curl
+
+        POST /api/v0/addevents/ HTTP/1.0
+        Accept: application/json
+        Content-Type: application/json
+        Authorization: JWT eyJ0eXAiOiJKV1QiLCJhbG...0UHGO-U0R4PTQ
+
+        [
+            {
+                "type": "event",
+                "name": "Event name",
+                "address": "2345 Tourist Road, Bla OH",
+                "tags": [
+                    "d927d94f-beb8-4295-ac78-5c00e6dc217c"
+                ],
+                "photos": [
+                    "http://example.com/image.png"
+                ]
+            },
+            {
+                "type": "location",
+                "name": "Location name"
+            }
+        ]
+
+    **Example success**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 200 OK
+        Content-Type: application/json
+
+        {
+            "success": true,
+            "results": [
+                {
+                    "success": true,
+                    "votable": {
+                        "id": "f99d4246-f354-49ca-9a4b-d568861ac3c9",
+                        "name": "Event name",
+                        "location": "ea72c24b-afdd-448e-b822-2c6646ca90fc",
+                        "tags": [
+                            "d927d94f-beb8-4295-ac78-5c00e6dc217c"
+                        ],
+                        "type": "event",
+                        "photos": [
+                            "http://example.com/image.png"
+                        ]
+                    }
+                },
+                {
+                    "success": false,
+                    "message": "Invalid request JSON"
+                }
+            ]
+        }
+
+    **Example failure**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 400 BAD REQUEST
+        Content-Type: application/json
+
+        {
+            "success": false,
+            "message": "Too many events or locations"
+        }
+    """
+
+    data = request.get_json(force=True)
+
+    if not isinstance(data, list):
         return (
             {
                 'success': False,
-                'message': 'Invalid photo URL',
+                'message': 'Invalid request JSON',
             },
             status.HTTP_400_BAD_REQUEST,
         )
 
-    votable = types[data['type']](
-        id=uuid.uuid4(),
-        rawlocation_id=addr.id,
-        name=data['name'],
+    if len(data) > app.iniconfig.getint('apiserver', 'max_batch_votables'):
+        return (
+            {
+                'success': False,
+                'message': 'Too many events or locations',
+            },
+            status.HTTP_400_BAD_REQUEST,
+        )
+
+    added = hapcat.dbutil.add_votables(db.session, data)
+
+    db.session.commit()
+
+    hapcat.feed.suggestions_feed.invalidate()
+
+    votables = serialize_votables(
+        [votableid for votableid, message in added if message is None]
     )
 
-    votable.tags.extend(tag.id for tag in tags)
-    votable.photos.extend(photo.id for photo in photos)
+    for votableid, votable in votables.items():
+        hapcat.tagindex.tag_index.add(
+            votableid,
+            votable['type'],
+            votable['tags'],
+        )
 
-    dbobjs.append(votable)
+    results = []
 
-    db.session.add_all(dbobjs)
-    db.session.commit()
+    for votableid, message in added:
+        if message is None:
+            results.append({
+                'success': True,
+                'votable': votables[votableid],
+            })
+        else:
+            results.append({
+                'success': False,
+                'message': message,
+            })
 
     return {
         'success': True,
-        'votable': votable.serialize(),
+        'results': results,
     }
 
 
@@ -605,130 +1125,785 @@ def vote(
 
     :>json int numvotes: The total number of votes of this user for this event
         or location.
+        If ``[apiserver] buffer_votes`` is enabled, this is the projected total
+        once the buffered votes are written.
+
+    :statuscode 200: Success.
+
+    :statuscode 400: Invalid votable ID or user.
+
+    :statuscode 401: Invalid authorization token.
+
+    **Example request**:
+
+    .. http:example:: curl
+
+        GET /api/v0/vote/c43e3c6a-64ad-4cc8-94cd-65d1c8e4ada6/ HTTP/1.0
+        Accept: application/json
+        Authorization: JWT eyJ0eXAiOiJKV1QiLCJhbG...0UHGO-U0R4PTQ
+
+    **Example success**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 200 OK
+        Content-Type: application/json
+
+        {
+            "success": true,
+            "votable": "c43e3c6a-64ad-4cc8-94cd-65d1c8e4ada6",
+            "user_id": "e7d45044-d500-451a-825f-cbff616030f2",
+            "username": "user",
+            "numvotes": 11
+        }
+
+    **Example failure**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 400 BAD REQUEST
+        Content-Type: application/json
+
+        {
+            "success": false,
+            "message": "No such votable",
+            "votable": "c43e3c6a-64ad-4cc8-94cd-65d1c8e4adaf",
+            "user_id": "e7d45044-d500-451a-825f-cbff616030f2",
+            "username": "user"
+        }
+    """
+
+    userid = current_identity.id
+    username = current_identity.username
+
+    try:
+        votableid = uuid.UUID(votable)
+    except ValueError:
+        return (
+            {
+                'success': False,
+                'message': 'Invalid UUID',
+                'votable': votable,
+                'user_id': userid,
+                'username': username,
+            },
+            status.HTTP_400_BAD_REQUEST
+        )
+
+    if app.iniconfig.getboolean('apiserver', 'buffer_votes'):
+        # Return the projected votes, and write them later.
+        numvotes = hapcat.votebuffer.votes.add(votableid, userid)
+    else:
+        # This checks the votable exists and adds the vote in one statement.
+        numvotes = hapcat.dbutil.add_votes(db.session, votableid, userid)
+
+    if numvotes is None:
+        db.session.rollback()
+
+        # The user may have been deleted since their token was checked.
+        if not user_exists(userid):
+            return (
+                {
+                    'success': False,
+                    'message': 'No such user',
+                    'votable': votable,
+                    'user_id': userid,
+                },
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        return (
+            {
+                'success': False,
+                'message': 'No such votable',
+                'votable': votable,
+                'user_id': userid,
+                'username': username,
+            },
+            status.HTTP_400_BAD_REQUEST
+        )
+
+    db.session.commit()
+
+    return {
+        'success': True,
+        'votable': votable,
+        'user_id': userid,
+        'username': username,
+        'numvotes': numvotes,
+    }
+
+
+@app.route('/api/v<int:version>/votes/', methods=['POST'])
+@jwt_required()
+def votes(
+        version,
+    ):
+    """Vote for several events or locations at once.
+
+    The votables are all checked in one query, and the votes are added in one
+    transaction.
+
+    :reqheader Authorization: The JWT authorization token for the user from
+        :http:post:`/api/v(int:version)/auth/`.
+
+    :query version: The version of the API currently in use.
+
+    :<json list votes: The votes, each with a ``votable`` UUID and an optional
+        positive ``count`` of votes, defaulting to 1.
+        The counts add up to the number of votes, which is limited.
+
+    :>json boolean success: ``True`` or ``False``.
+
+    :>json string message: The failure reason if ``False``.
+
+    :>json string user_id: The UUID of the user.
+
+    :>json string username: The username of the user.
+
+    :>json list results: The result of each vote, in order, with the
+        ``votable``, whether it succeeded in ``success``, and either the new
+        total votes of this user for it in ``numvotes`` or the failure reason
+        in ``message``.
+
+    :statuscode 200: Success, although individual votes may have failed.
+
+    :statuscode 400: Invalid request JSON, too many votes, or no such user.
+
+    :statuscode 401: Invalid authorization token.
+
+    **Example request**:
+
+    .. http:example:: curl
+
+        POST /api/v0/votes/ HTTP/1.0
+        Accept: application/json
+        Content-Type: application/json
+        Authorization: JWT eyJ0eXAiOiJKV1QiLCJhbG...0UHGO-U0R4PTQ
+
+        {
+            "votes": [
+                {
+                    "votable": "c43e3c6a-64ad-4cc8-94cd-65d1c8e4ada6",
+                    "count": 2
+                },
+                {
+                    "votable": "c43e3c6a-64ad-4cc8-94cd-65d1c8e4adaf"
+                }
+            ]
+        }
+
+    **Example success**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 200 OK
+        Content-Type: application/json
+
+        {
+            "success": true,
+            "user_id": "e7d45044-d500-451a-825f-cbff616030f2",
+            "username": "user",
+            "results": [
+                {
+                    "success": true,
+                    "votable": "c43e3c6a-64ad-4cc8-94cd-65d1c8e4ada6",
+                    "numvotes": 13
+                },
+                {
+                    "success": false,
+                    "votable": "c43e3c6a-64ad-4cc8-94cd-65d1c8e4adaf",
+                    "message": "No such votable"
+                }
+            ]
+        }
+
+    **Example failure**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 400 BAD REQUEST
+        Content-Type: application/json
+
+        {
+            "success": false,
+            "message": "Too many votes"
+        }
+    """
+
+    userid = current_identity.id
+    username = current_identity.username
+
+    data = request.get_json(force=True)
+
+    try:
+        rawvotes = data['votes']
+
+        if not isinstance(rawvotes, list):
+            raise TypeError('Invalid votes')
+    except (KeyError, TypeError):
+        return (
+            {
+                'success': False,
+                'message': 'Invalid request JSON',
+            },
+            status.HTTP_400_BAD_REQUEST,
+        )
+
+    if len(rawvotes) > app.iniconfig.getint('apiserver', 'max_batch_votes'):
+        return (
+            {
+                'success': False,
+                'message': 'Too many votes',
+            },
+            status.HTTP_400_BAD_REQUEST,
+        )
+
+    # Validate each vote, combining votes for the same votable.
+
+    results = []
+    counts = {}
+
+    for rawvote in rawvotes:
+        try:
+            votable = rawvote['votable']
+            count = rawvote.get('count', 1)
+        except (AttributeError, KeyError, TypeError):
+            results.append({
+                'success': False,
+                'votable': None,
+                'message': 'Invalid vote',
+            })
+            continue
+
+        try:
+            votableid = uuid.UUID(votable)
+        except (AttributeError, TypeError, ValueError):
+            results.append({
+                'success': False,
+                'votable': votable,
+                'message': 'Invalid UUID',
+            })
+            continue
+
+        if (
+                not isinstance(count, int) or
+                isinstance(count, bool) or
+                count < 1
+            ):
+            results.append({
+                'success': False,
+                'votable': votable,
+                'message': 'Invalid count',
+            })
+            continue
+
+        counts[votableid] = counts.get(votableid, 0) + count
+
+        results.append({
+            'success': True,
+            'votable': votable,
+            'id': votableid,
+        })
+
+    # Each count is a vote, so they're limited like the votes are.
+    if sum(counts.values()) > app.iniconfig.getint(
+            'apiserver',
+            'max_batch_votes',
+        ):
+        return (
+            {
+                'success': False,
+                'message': 'Too many votes',
+            },
+            status.HTTP_400_BAD_REQUEST,
+        )
+
+    # Check all the votables exist at once.
+
+    votable_ids = Votable.__table__.c.id
+
+    if counts:
+        existing = {
+            votableid
+            for (votableid,) in db.session.query(votable_ids).filter(
+                votable_ids.in_(list(counts))
+            )
+        }
+    else:
+        existing = set()
+
+    for votableid in set(counts) - existing:
+        del counts[votableid]
+
+    # Add the votes.
+
+    if app.iniconfig.getboolean('apiserver', 'buffer_votes'):
+        totals = hapcat.votebuffer.votes.add_many(counts, userid)
+    else:
+        hapcat.dbutil.add_votes_many(
+            db.session,
+            (
+                (votableid, userid, count)
+                for votableid, count in counts.items()
+            ),
+        )
+
+        if counts:
+            totals = dict(
+                db.session.query(Vote.votable_id, Vote.numvotes).filter(
+                    Vote.user_id == userid,
+                    Vote.votable_id.in_(list(counts)),
+                )
+            )
+        else:
+            totals = {}
+
+        db.session.commit()
+
+    if any(totals.get(votableid) is None for votableid in counts):
+        # The user may have been deleted since their token was checked.
+        if not user_exists(userid):
+            db.session.rollback()
+
+            return (
+                {
+                    'success': False,
+                    'message': 'No such user',
+                    'user_id': userid,
+                },
+                status.HTTP_400_BAD_REQUEST
+            )
+
+    for result in results:
+        votableid = result.pop('id', None)
+
+        if votableid is None:
+            continue
+
+        if totals.get(votableid) is None:
+            result['success'] = False
+            result['message'] = 'No such votable'
+        else:
+            result['numvotes'] = totals[votableid]
+
+    return {
+        'success': True,
+        'user_id': userid,
+        'username': username,
+        'results': results,
+    }
+
+
+@app.route('/api/v<int:version>/suggestions/')
+@hapcat.replicas.read_only
+def suggestions(
+        version,
+    ):
+    """Send our suggestions.
+
+    The suggestions are paginated, with up to ``limit`` locations and ``limit``
+    events per page.
+    To get the next page, pass the ``next`` token back as the ``cursor``.
+
+    The first page at the default size is precomputed and served as-is until
+    an event or location is added, or until it's older than the
+    ``[apiserver] suggestions_ttl`` configuration.
+
+    :query version: The version of the API currently in use
+
+    :query limit: The most locations and the most events to send.
+        Defaults to the ``[apiserver] suggestions_page_size`` configuration,
+        and is capped at ``[apiserver] max_suggestions_page_size``.
+
+    :query cursor: The ``next`` token from the previous page
+
+    :query near: ``latitude,longitude`` to send the suggestions nearest to,
+        nearest first.
+        Only events and locations with known coordinates are sent, and nearby
+        suggestions aren't paginated or filtered by tag.
+
+    :query tags: Comma-separated tag UUIDs to only send the events and
+        locations with.
+
+    :query mode: ``any`` to send the events and locations with any of the
+        ``tags``, which is the default, or ``all`` for those with all of them.
+
+    :query radius: The most meters away nearby suggestions can be.
+        Defaults to the ``[apiserver] near_radius`` configuration, and is
+        capped at ``[apiserver] max_near_radius``.
+
+    :reqheader Accept-Encoding: If this accepts ``gzip``, the precompressed
+        suggestions are sent.
+
+    :reqheader If-None-Match: If this matches the current suggestions' ETag,
+        nothing is sent.
+
+    :resheader Content-Encoding: ``gzip`` if the suggestions are compressed.
+
+    :resheader ETag: The ETag of the suggestions.
+
+    :statuscode 304: The suggestions haven't changed
+
+    :>json tags: The tags, by ID.
+        See the documentation for
+        :http:get:`/api/v(int:version)/tag/(tag)`.
+
+    :>json locations: The locations, by ID.
+        See the documentation for
+        :http:get:`/api/v(int:version)/location/(location)`.
+
+    :>json events: The events, by ID.
+        See the documentation for
+        :http:get:`/api/v(int:version)/event/(event)`.
+
+    :>json order: The order of the suggestions.
+        For nearby suggestions, each also has its ``distance`` in meters.
+
+    :>json next: The token for the next page, or ``null`` on the last page
+
+    :statuscode 200: No error
+
+    :statuscode 400: Invalid limit, cursor, location, tag, or mode
+
+    **Example request**:
+
+    .. http:example:: curl
+
+        GET /api/v0/suggestions/ HTTP/1.0
+        Accept: application/json
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 200 OK
+        Content-Type: application/json
+
+        {
+            "tags": {
+                "d927d94f-beb8-4295-ac78-5c00e6dc217c": {
+                    "id": "d927d94f-beb8-4295-ac78-5c00e6dc217c",
+                    "name": "healthy"
+                }
+                "64b9eae5-b220-4a57-92f4-c21dc9b19ec5": {
+                    "id": "64b9eae5-b220-4a57-92f4-c21dc9b19ec5",
+                    "name": "concert"
+                },
+            },
+            "locations": {
+                "f8293fe1-d439-4a4d-ac84-5e8290a28c23": {
+                    "address": "1075 Risman Dr, Kent, OH 44242",
+                    "tags": [
+                        "d927d94f-beb8-4295-ac78-5c00e6dc217c",
+                    ],
+                    "id": "f8293fe1-d439-4a4d-ac84-5e8290a28c23",
+                    "name": "Fresco",
+                    "photos": [
+                        "https://media-cdn.tripadvisor.com/media/photo-s/03/2b/02/a1/fresco-mexican-grill.jpg"
+                    ]
+                }
+                "cbedf9e2-4a1a-44b9-9e3f-6fe870405329": {
+                    "address": "175 E Main St, Kent, OH 44240",
+                    "ephemeral": true,
+                    "id": "cbedf9e2-4a1a-44b9-9e3f-6fe870405329"
+                },
+            },
+            "events": {
+                "b0a28a40-b8ad-4131-8c64-071f3fd45bee": {
+                    "location": "cbedf9e2-4a1a-44b9-9e3f-6fe870405329",
+                    "id": "b0a28a40-b8ad-4131-8c64-071f3fd45bee",
+                    "name": "The Accidentals - Concert at the Kent Stage",
+                    "photos": [
+                        "https://image-ticketfly.imgix.net/00/02/83/80/81-og.jpg"
+                    ],
+                    "tags": [
+                        "64b9eae5-b220-4a57-92f4-c21dc9b19ec5",
+                    ]
+                }
+            },
+            "order": [
+                {
+                    "section": "locations",
+                    "id": "f8293fe1-d439-4a4d-ac84-5e8290a28c23"
+                },
+                {
+                    "section": "events",
+                    "id": "b0a28a40-b8ad-4131-8c64-071f3fd45bee"
+                }
+            ],
+            "next": null
+        }
+    """
+
+    pagesize = app.iniconfig.getint('apiserver', 'suggestions_page_size')
+
+    try:
+        limit = int(request.args.get('limit', pagesize))
+
+        if limit < 1:
+            raise ValueError('Invalid limit')
+
+    except ValueError:
+        return (
+            {
+                'status': 'failure',
+                'message': 'Invalid limit',
+            },
+            status.HTTP_400_BAD_REQUEST
+        )
+
+    limit = min(
+        limit,
+        app.iniconfig.getint('apiserver', 'max_suggestions_page_size'),
+    )
+
+    if 'near' in request.args:
+        try:
+            latitude, longitude = (
+                float(x)
+                for x in request.args['near'].split(',')
+            )
+
+            radius = float(request.args.get(
+                'radius',
+                app.iniconfig.getfloat('apiserver', 'near_radius'),
+            ))
+
+            if not hapcat.geo.valid(latitude, longitude) or not radius > 0:
+                raise ValueError('Invalid location')
+
+        except ValueError:
+            return (
+                {
+                    'status': 'failure',
+                    'message': 'Invalid location',
+                },
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        if 'cursor' in request.args:
+            return (
+                {
+                    'status': 'failure',
+                    'message': 'Nearby suggestions have no pages',
+                },
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        if 'tags' in request.args:
+            return (
+                {
+                    'status': 'failure',
+                    'message': "Nearby suggestions can't be filtered by tag",
+                },
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        radius = min(
+            radius,
+            app.iniconfig.getfloat('apiserver', 'max_near_radius'),
+        )
+
+        return hapcat.feed.build_nearby_suggestions(
+            latitude,
+            longitude,
+            radius,
+            limit=limit,
+        )
+
+    cursor = None
+
+    if 'cursor' in request.args:
+        try:
+            cursor = hapcat.feed.decode_cursor(request.args['cursor'])
+        except hapcat.feed.InvalidCursor as e:
+            return (
+                {
+                    'status': 'failure',
+                    'message': str(e),
+                },
+                status.HTTP_400_BAD_REQUEST
+            )
+
+    if 'tags' in request.args:
+        try:
+            tags = [
+                uuid.UUID(tag)
+                for tag in request.args['tags'].split(',')
+            ]
+        except ValueError:
+            return (
+                {
+                    'status': 'failure',
+                    'message': 'Invalid tag',
+                },
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        mode = request.args.get('mode', 'any')
+
+        if mode not in ('any', 'all'):
+            return (
+                {
+                    'status': 'failure',
+                    'message': 'Invalid mode',
+                },
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        return hapcat.feed.build_tagged_suggestions(
+            tags,
+            mode=mode,
+            limit=limit,
+            cursor=cursor,
+        )
+
+    if cursor is not None:
+        return hapcat.feed.build_suggestions(limit=limit, cursor=cursor)
+
+    if limit != pagesize:
+        return hapcat.feed.build_suggestions(limit=limit)
+
+    # The first page is precomputed, so this normally doesn't touch the
+    # database at all.
+    payload = hapcat.feed.suggestions_feed.get()
+    gzipped = bool(request.accept_encodings['gzip'])
+    etag = payload.gzip_etag if gzipped else payload.etag
+
+    if hapcat.httpcache.is_fresh(etag):
+        response = hapcat.httpcache.not_modified(etag)
+
+    elif gzipped:
+        response = flask.Response(
+            payload.gzipped,
+            mimetype='application/json',
+        )
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag)
+
+    else:
+        response = flask.Response(
+            payload.body,
+            mimetype='application/json',
+        )
+        response.set_etag(etag)
+
+    response.vary.add('Accept-Encoding')
+
+    return response
+
+
+@app.route('/api/v<int:version>/suggestions/personalized/')
+@hapcat.replicas.read_only
+@jwt_required()
+def personalized_suggestions(
+        version,
+    ):
+    """Send the suggestions the user is likeliest to vote for.
 
-    :statuscode 200: Success.
+    If the ``hapcat-recommend`` job has recommended events and locations
+    for the user, from the votes of people who voted like them, those are
+    sent, best first.
 
-    :statuscode 400: Invalid votable ID or user.
+    Otherwise, each event and location is scored by the user's total votes
+    for the events and locations sharing its tags, and the best are sent,
+    best first.
+    Events and locations the user has voted for, or which share no tags
+    with them, aren't sent.
+    Users who haven't voted yet get the regular suggestions.
 
-    :statuscode 401: Invalid authorization token.
+    Votes buffered by the ``[apiserver] buffer_votes`` mode count once
+    they're written, and other servers' additions within the
+    ``[apiserver] tag_index_ttl`` configuration.
 
-    **Example request**:
+    :reqheader Authorization: The JWT authorization token for the user from
+        :http:post:`/api/v(int:version)/auth/`.
 
-    .. http:example:: curl
+    :query version: The version of the API currently in use
 
-        GET /api/v0/vote/c43e3c6a-64ad-4cc8-94cd-65d1c8e4ada6/ HTTP/1.0
-        Accept: application/json
-        Authorization: JWT eyJ0eXAiOiJKV1QiLCJhbG...0UHGO-U0R4PTQ
+    :query limit: The most locations and the most events to send.
+        Defaults to the ``[apiserver] suggestions_page_size`` configuration,
+        and is capped at ``[apiserver] max_suggestions_page_size``.
 
-    **Example success**:
+    :>json tags: The tags, by ID.
+        See the documentation for
+        :http:get:`/api/v(int:version)/tag/(tag)`.
 
-    .. sourcecode:: http
+    :>json locations: The locations, by ID.
+        See the documentation for
+        :http:get:`/api/v(int:version)/location/(location)`.
 
-        HTTP/1.0 200 OK
-        Content-Type: application/json
+    :>json events: The events, by ID.
+        See the documentation for
+        :http:get:`/api/v(int:version)/event/(event)`.
 
-        {
-            "success": true,
-            "votable": "c43e3c6a-64ad-4cc8-94cd-65d1c8e4ada6",
-            "user_id": "e7d45044-d500-451a-825f-cbff616030f2",
-            "username": "user",
-            "numvotes": 11
-        }
+    :>json order: The order of the suggestions, best first
 
-    **Example failure**:
+    :>json next: ``null``, since these suggestions aren't paginated
 
-    .. sourcecode:: http
+    :statuscode 200: No error
 
-        HTTP/1.0 400 BAD REQUEST
-        Content-Type: application/json
+    :statuscode 400: Invalid limit
 
-        {
-            "success": false,
-            "message": "No such votable",
-            "votable": "c43e3c6a-64ad-4cc8-94cd-65d1c8e4adaf",
-            "user_id": "e7d45044-d500-451a-825f-cbff616030f2",
-            "username": "user"
-        }
+    :statuscode 401: Not authorized
     """
 
-    user = db.session.query(User).filter(
-        User.id == current_identity.id
-    ).scalar()
+    try:
+        limit = int(request.args.get(
+            'limit',
+            app.iniconfig.getint('apiserver', 'suggestions_page_size'),
+        ))
 
-    if user is None:
-        return (
-            {
-                'success': False,
-                'message': 'No such user',
-                'votable': votable,
-                'user_id': current_identity.id,
-            },
-            status.HTTP_400_BAD_REQUEST
-        )
+        if limit < 1:
+            raise ValueError('Invalid limit')
 
-    try:
-        uuid.UUID(votable)
     except ValueError:
         return (
             {
-                'success': False,
-                'message': 'Invalid UUID',
-                'votable': votable,
-                'user_id': user.id,
-                'username': user.username,
+                'status': 'failure',
+                'message': 'Invalid limit',
             },
             status.HTTP_400_BAD_REQUEST
         )
 
-    votableobj = db.session.query(Votable).filter(
-        Votable.id == votable
-    ).scalar()
+    limit = min(
+        limit,
+        app.iniconfig.getint('apiserver', 'max_suggestions_page_size'),
+    )
 
-    if votableobj is None:
-        return (
-            {
-                'success': False,
-                'message': 'No such votable',
-                'votable': votable,
-                'user_id': user.id,
-                'username': user.username,
-            },
-            status.HTTP_400_BAD_REQUEST
-        )
+    return hapcat.feed.build_personalized_suggestions(
+        current_identity.id,
+        limit=limit,
+    )
 
-    vote = db.session.query(Vote).filter(
-        Vote.votable_id == votable and
-        Vote.user_id == current_identity.id
-    ).scalar()
 
-    if vote is None:
-        vote = Vote(
-            votable_id=votable,
-            user_id=current_identity.id,
-            numvotes=0,
-        )
+@app.route('/api/v<int:version>/search/')
+@hapcat.replicas.read_only
+def search(
+        version,
+    ):
+    """Search the events and locations.
 
-    vote.numvotes += 1
+    Every word of the query has to be in the name, address, or tag names of
+    a result, and the last word also matches the start of a word, so partial
+    words find results as they're typed.
+    Results matching by name come before those matching by address, which
+    come before those matching by tag name.
 
-    db.session.add(vote)
-    db.session.commit()
+    The results are paginated, with up to ``limit`` events and locations per
+    page.
+    To get the next page, pass the ``next`` token back as the ``cursor``.
 
-    return {
-        'success': True,
-        'votable': votable,
-        'user_id': user.id,
-        'username': user.username,
-        'numvotes': vote.numvotes,
-    }
+    :query version: The version of the API currently in use
 
+    :query q: The search query
 
-@app.route('/api/v<int:version>/suggestions/')
-def suggestions(
-        version,
-    ):
-    """Send our suggestions.
+    :query limit: The most events and locations to send.
+        Defaults to the ``[apiserver] suggestions_page_size`` configuration,
+        and is capped at ``[apiserver] max_suggestions_page_size``.
 
-    :query version: The version of the API currently in use
+    :query cursor: The ``next`` token from the previous page
 
     :>json tags: The tags, by ID.
         See the documentation for
@@ -742,15 +1917,19 @@ def suggestions(
         See the documentation for
         :http:get:`/api/v(int:version)/event/(event)`.
 
-    :>json order: The order of the suggestions
+    :>json order: The order of the results, best first
+
+    :>json next: The token for the next page, or ``null`` on the last page
 
     :statuscode 200: No error
 
+    :statuscode 400: Invalid query, limit, or cursor
+
     **Example request**:
 
     .. http:example:: curl
 
-        GET /api/v0/suggestions/ HTTP/1.0
+        GET /api/v0/search/?q=fresco HTTP/1.0
         Accept: application/json
 
     **Example response**:
@@ -766,10 +1945,6 @@ def suggestions(
                     "id": "d927d94f-beb8-4295-ac78-5c00e6dc217c",
                     "name": "healthy"
                 }
-                "64b9eae5-b220-4a57-92f4-c21dc9b19ec5": {
-                    "id": "64b9eae5-b220-4a57-92f4-c21dc9b19ec5",
-                    "name": "concert"
-                },
             },
             "locations": {
                 "f8293fe1-d439-4a4d-ac84-5e8290a28c23": {
@@ -783,91 +1958,61 @@ def suggestions(
                         "https://media-cdn.tripadvisor.com/media/photo-s/03/2b/02/a1/fresco-mexican-grill.jpg"
                     ]
                 }
-                "cbedf9e2-4a1a-44b9-9e3f-6fe870405329": {
-                    "address": "175 E Main St, Kent, OH 44240",
-                    "ephemeral": true,
-                    "id": "cbedf9e2-4a1a-44b9-9e3f-6fe870405329"
-                },
-            },
-            "events": {
-                "b0a28a40-b8ad-4131-8c64-071f3fd45bee": {
-                    "location": "cbedf9e2-4a1a-44b9-9e3f-6fe870405329",
-                    "id": "b0a28a40-b8ad-4131-8c64-071f3fd45bee",
-                    "name": "The Accidentals - Concert at the Kent Stage",
-                    "photos": [
-                        "https://image-ticketfly.imgix.net/00/02/83/80/81-og.jpg"
-                    ],
-                    "tags": [
-                        "64b9eae5-b220-4a57-92f4-c21dc9b19ec5",
-                    ]
-                }
             },
+            "events": {},
             "order": [
                 {
                     "section": "locations",
                     "id": "f8293fe1-d439-4a4d-ac84-5e8290a28c23"
-                },
-                {
-                    "section": "events",
-                    "id": "b0a28a40-b8ad-4131-8c64-071f3fd45bee"
                 }
-            ]
+            ],
+            "next": null
         }
     """
 
-    # Retrieve a few events and locations.
-
-    maxlocs = 20
-    maxevents = 20
-
-    tags = set()
-
-    # Retrieve some locations.
-
-    locs = db.session.query(Location).limit(maxlocs).all()
-    slocs = {}
-
-    for loc in locs:
-        tags.update(loc.tags)
-        slocs[str(loc.id)] = loc.serialize()
-
-    # Retrieve some events.
-
-    events = db.session.query(Event).limit(maxevents).all()
-    sevents = {}
-    eventlocs = {}
-
-    for event in events:
-        tags.update(event.tags)
-        sevents[str(event.id)] = event.serialize()
-        eventlocs[str(event.rawlocation.id)] = event.rawlocation.serialize()
+    try:
+        limit = int(request.args.get(
+            'limit',
+            app.iniconfig.getint('apiserver', 'suggestions_page_size'),
+        ))
 
-    # Retrieve our tags.
+        if limit < 1:
+            raise ValueError('Invalid limit')
 
-    stags = {str(tag.id): tag.serialize() for tag in tags}
+    except ValueError:
+        return (
+            {
+                'status': 'failure',
+                'message': 'Invalid limit',
+            },
+            status.HTTP_400_BAD_REQUEST
+        )
 
-    # Generate our order.
+    limit = min(
+        limit,
+        app.iniconfig.getint('apiserver', 'max_suggestions_page_size'),
+    )
 
-    raworder = list(slocs.values()) + list(sevents.values())
-    random.shuffle(raworder)
+    try:
+        offset = 0
 
-    order = [
-        {
-            'section': 'locations' if x['type'] == 'location' else 'events',
-            'id': x['id'],
-        }
-        for x in raworder
-    ]
+        if 'cursor' in request.args:
+            offset = hapcat.search.decode_cursor(request.args['cursor'])
 
-    # Add in our raw locations
-    slocs.update(eventlocs)
+        return hapcat.feed.build_search_results(
+            request.args.get('q', ''),
+            limit=limit,
+            offset=offset,
+        )
 
-    return {
-        'locations': slocs,
-        'events': sevents,
-        'tags': stags,
-        'order': order,
-    }
+    except hapcat.search.InvalidQuery as e:
+        return (
+            {
+                'status': 'failure',
+                'message': str(e),
+            },
+            status.HTTP_400_BAD_REQUEST
+        )
 
 
 @app.route('/')
@@ -897,6 +2042,8 @@ def load_testdata():
     """
 
     hapcat.dbutil.load_test_data()
+    hapcat.feed.suggestions_feed.invalidate()
+    hapcat.tagindex.tag_index.invalidate()
 
     return {'success': 'true'}
 
@@ -910,8 +2057,14 @@ def drop_data():
 
     # This should cascade to delete everything.
     db.session.query(UUIDObject).delete()
+    hapcat.search.clear(db.session)
     db.session.commit()
 
+    hapcat.feed.suggestions_feed.invalidate()
+    hapcat.tagindex.tag_index.invalidate()
+    hapcat.identity.versions.clear()
+    hapcat.usernames.usernames.invalidate()
+
     return {'success': 0}
 
 
@@ -972,6 +2125,80 @@ def protect():
     }
 
 
+@app.route('/api/v<int:version>/username-available/')
+@hapcat.replicas.read_only
+def username_available(version):
+    """Check whether a username is free to register.
+
+    This is meant for checking usernames as they're typed, so most answers
+    come from memory.
+    A username taken in the last ``[apiserver] username_filter_ttl`` seconds
+    may still be reported free, but registering it fails.
+
+    :query version: The version of the API currently in use.
+
+    :query username: The username to check.
+
+    :>json string username: The username.
+
+    :>json boolean available: Whether the username is free.
+
+    :statuscode 200: Success.
+
+    :statuscode 400: No username was given.
+
+    **Example request**:
+
+    .. http:example:: curl
+
+        GET /api/v0/username-available/?username=user HTTP/1.0
+        Accept: application/json
+
+    **Example success**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 200 OK
+        Content-Type: application/json
+
+        {
+            "username": "user",
+            "available": false
+        }
+
+    **Example failure**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 400 BAD REQUEST
+        Content-Type: application/json
+
+        {
+            "status": "failure",
+            "message": "Invalid username"
+        }
+    """
+
+    username = request.args.get('username')
+
+    if not username:
+        return (
+            {
+                'status': 'failure',
+                'message': 'Invalid username',
+            },
+            status.HTTP_400_BAD_REQUEST
+        )
+
+    return {
+        'username': username,
+        'available': not hapcat.usernames.usernames.taken(
+            db.session,
+            username,
+        ),
+    }
+
+
 @app.route('/api/v<int:version>/registration/', methods=['POST'])
 @app.route('/api/v<int:version>/register/', methods=['POST'])
 def register(version):
@@ -999,6 +2226,9 @@ def register(version):
 
     :statuscode 409: The username is already taken.
 
+    :statuscode 503: Too many passwords are being checked or hashed; try again
+        later.
+
     **Example request**:
 
     .. http:example:: curl
@@ -1066,12 +2296,27 @@ def register(version):
     )
     dob = data['date_of_birth']
 
+    # Turn taken usernames away before the slow password checks.
+    if hapcat.usernames.usernames.taken(db.session, data['username']):
+        return ({
+            'status': 'failure',
+            'username': data['username'],
+            'message': 'Username already exists',
+        }, status.HTTP_409_CONFLICT)
+
     # Check the password strength.
-    strong, feedback = User.checkpwstrength(
-        data['password'],
-        data['username'],
-        data['email'],
-    )
+    try:
+        strong, feedback = User.checkpwstrength(
+            data['password'],
+            data['username'],
+            data['email'],
+        )
+    except hapcat.strength.StrengthCheckTimeout:
+        return ({
+            'status': 'failure',
+            'username': data['username'],
+            'message': 'Too busy, try again later',
+        }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': '1'})
 
     if not strong:
         return ({
@@ -1081,6 +2326,14 @@ def register(version):
             'details': feedback,
         }, status.HTTP_400_BAD_REQUEST)
 
+    try:
+        password = hapcat.hashing.passwords.hash(data['password'])
+    except hapcat.hashing.HashingBusy:
+        return ({
+            'status': 'failure',
+            'username': data['username'],
+            'message': 'Too busy, try again later',
+        }, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': '1'})
 
     newuser = User(
         id=uuid.uuid4(),
@@ -1091,13 +2344,15 @@ def register(version):
             month=dob['month'],
             day=dob['day'],
         ),
-        password=data['password'],
+        password=password,
     )
 
     try:
         db.session.add(newuser)
         db.session.commit()
 
+        hapcat.usernames.usernames.add(data['username'])
+
         app.logger.info(
             'Created user %s for %s',
             newuser.username,
@@ -1145,6 +2400,8 @@ def login(version):
 
     :statuscode 401: Invalid credentials.
 
+    :statuscode 503: Too many passwords are being checked; try again later.
+
     **Example request**:
 
     .. http:example:: curl
@@ -1198,10 +2455,25 @@ def login(version):
             status.HTTP_401_UNAUTHORIZED,
         )
 
-    identity = jwt.authentication_callback(username, password)
+    try:
+        identity = jwt.authentication_callback(username, password)
+    except hapcat.hashing.HashingBusy:
+        return (
+            {
+                'success': False,
+                'message': 'Too busy, try again later',
+            },
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+            {'Retry-After': '1'},
+        )
 
     if identity:
         access_token = jwt.jwt_encode_callback(identity)
+
+        # Older PyJWT versions give bytes.
+        if isinstance(access_token, bytes):
+            access_token = access_token.decode('ascii')
+
         return {
             'success': True,
             'access_token': access_token,
@@ -1214,3 +2486,47 @@ def login(version):
             },
             status.HTTP_401_UNAUTHORIZED,
         )
+
+
+@app.route('/api/v<int:version>/logout/', methods=['POST'])
+@jwt_required()
+def logout(version):
+    """Log out everywhere, revoking all of the user's access tokens.
+
+    Other server processes may accept the revoked tokens for up to
+    ``[apiserver] identity_cache_ttl`` seconds.
+
+    :query version: The version of the API currently in use.
+
+    :reqheader Authorization: The JWT authorization token for the user from
+        :http:post:`/api/v(int:version)/login/`.
+
+    :>json boolean success: ``True``.
+
+    :statuscode 200: Success.
+
+    :statuscode 401: Invalid authorization token.
+
+    **Example request**:
+
+    .. http:example:: curl
+
+        POST /api/v0/logout/ HTTP/1.0
+        Accept: application/json
+        Authorization: JWT eyJ0eXAiOiJKV1QiLCJhbG...0UHGO-U0R4PTQ
+
+    **Example success**:
+
+    .. sourcecode:: http
+
+        HTTP/1.0 200 OK
+        Content-Type: application/json
+
+        {
+            "success": true
+        }
+    """
+
+    hapcat.identity.revoke(db.session, current_identity.id)
+
+    return {'success': True}
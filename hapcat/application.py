@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+
+"""The Hapcat Flask application.
+
+Importing this creates the application and its extensions, without touching
+the database.
+:func:`start` then brings the database schema up to date, loads the JWT
+secret, and registers the API endpoints.
+
+When uWSGI loads the application in its master process before forking the
+workers, as it does unless ``lazy-apps`` is set, this is only done once,
+and the workers inherit the secret rather than each querying for it.
+
+The :mod:`hapcat` package does both the first time :data:`app` or the other
+names here are looked up in it, so importing the package alone, such as to
+get its version, is cheap.
+Modules within hapcat import the names from here instead, so they don't
+start the application while they're being imported themselves.
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+)
+
+import time
+
+_imported = time.time()
+
+import binascii
+import configparser
+import datetime
+import errno
+import flask
+import flask_api
+import flask_cors
+import flask_jwt
+import flask_ini
+import os
+import os.path
+import sqlalchemy
+import sys
+import tempfile
+import threading
+
+import hapcat.pool
+import hapcat.replicas
+
+try:
+    import secrets
+except ImportError:
+    # Import the small module hackily copied from the Python 3.6 library, since
+    # no one seems to have backported it on PyPI yet.
+    import hapcat.compat.secrets as secrets
+
+
+def _resource(path):
+    """Get the path of a file in the package.
+
+    This is quicker than importing :mod:`pkg_resources`, and the package is
+    never zipped.
+    """
+
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+app = flask_api.FlaskAPI(
+    'hapcat',
+)
+
+with app.app_context():
+    app.iniconfig = flask_ini.FlaskIni(
+        delimiters=('=',),
+        comment_prefixes=('#',),
+        inline_comment_prefixes=None,
+        strict=True,
+        interpolation=configparser.ExtendedInterpolation()
+    )
+
+    app.iniconfig.read(_resource('data/hapcatd-defaults.conf'))
+
+    envconf = os.environ.get('HAPCAT_FLASK_CONFIG', None)
+
+    if envconf:
+        app.iniconfig.read(envconf)
+
+def configure_database():
+    """Configure the database connection and its pool from the configuration.
+
+    This must be done before the database is first used.
+    """
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = app.iniconfig.get(
+        'database',
+        'dburl',
+    )
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = hapcat.pool.engine_options(
+        app.iniconfig,
+    )
+
+configure_database()
+
+db = hapcat.replicas.SQLAlchemy(app)
+
+app.after_request(hapcat.replicas.stick_to_primary)
+
+migrate = None
+
+def init_migrate():
+    """Set up Flask-Migrate, if it isn't already.
+
+    This is left until it's needed, since importing Alembic is slow.
+    """
+
+    global migrate
+
+    if migrate is None:
+        import flask_migrate
+
+        migrate = flask_migrate.Migrate(
+            app,
+            db,
+            directory=_resource('migrations'),
+        )
+
+    return migrate
+
+# The flask db commands need it set up already.
+if os.path.basename(sys.argv[0]) in ['flask', 'flask.exe']:
+    init_migrate()
+
+
+flask_cors.CORS(
+    app,
+    expose_headers='Authorization'
+)
+
+insphinx = os.path.basename(sys.argv[0]) in ['sphinx-build', 'sphinx-build.exe']
+
+def insertsecret(session, key, payload):
+    """Insert a secret unless there's one with its key already, committing
+    the session.
+
+    This is a single statement, so processes starting at once can't both
+    insert one.
+    """
+
+    from hapcat.models import Secret
+
+    table = Secret.__table__
+    dialect = session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        import sqlalchemy.dialects.postgresql
+
+        statement = sqlalchemy.dialects.postgresql.insert(
+            table,
+        ).on_conflict_do_nothing(
+            index_elements=[table.c.id],
+        )
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE')
+    elif dialect == 'mysql':
+        statement = table.insert().prefix_with('IGNORE')
+    else:
+        statement = table.insert()
+
+    try:
+        session.execute(statement.values(id=key, payload=payload))
+        session.commit()
+    except sqlalchemy.exc.IntegrityError:
+        # Another process got there first.
+        session.rollback()
+
+def loadsecret(session, key, bits=512):
+    """Get a secret from the database, generating it if there isn't one.
+
+    Once it's been generated, this is a single query.
+    """
+
+    from hapcat.models import Secret
+
+    table = Secret.__table__
+    select = sqlalchemy.select([table.c.payload]).where(table.c.id == key)
+
+    payload = session.execute(select).scalar()
+
+    if payload is None:
+        insertsecret(session, key, secrets.token_bytes(bits // 8))
+
+        # Whichever process inserted it, this is the one everyone gets.
+        payload = session.execute(select).scalar()
+
+    return payload
+
+def readsecretfile(path):
+    """Read a hex encoded secret from a key file.
+
+    :returns: The secret, or ``None`` if the file doesn't exist.
+    """
+
+    try:
+        with open(path, 'rb') as secretfile:
+            return binascii.unhexlify(secretfile.read().strip())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+        return None
+
+def writesecretfile(path, payload):
+    """Write a secret to a key file, unless it exists already.
+
+    The file is written under another name and then linked into place, so
+    it's never seen half written, and only one of several processes
+    starting at once writes it.
+
+    :returns: The secret in the file, which may be another process's.
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.jwtsecret-')
+
+    try:
+        with os.fdopen(fd, 'wb') as secretfile:
+            secretfile.write(binascii.hexlify(payload) + b'\n')
+
+        try:
+            os.link(temporary, path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    finally:
+        os.unlink(temporary)
+
+    return readsecretfile(path)
+
+def makejwtsecret(bits=512):
+    """Read or generate the JWT secret.
+
+    If ``[apiserver] jwt_secret_file`` is set, the secret is read from that
+    file, which is only written from the database the first time, so
+    starting needs no queries after that.
+    Otherwise it's read from the database, and generated if it's missing.
+    """
+
+    if insphinx:
+        # Create a random secret instead of querying while in Sphinx.
+        return secrets.token_bytes(bits // 8)
+
+    path = app.iniconfig.get('apiserver', 'jwt_secret_file')
+
+    if path:
+        payload = readsecretfile(path)
+
+        if payload is not None:
+            return payload
+
+    payload = loadsecret(db.session, u'jwtsecret', bits)
+
+    if path:
+        payload = writesecretfile(path, payload)
+
+    return payload
+
+app.config['JWT_ALGORITHM'] = 'HS512'
+app.config['JWT_AUTH_URL_RULE'] = None
+app.config['JWT_EXPIRATION_DELTA'] = datetime.timedelta(days=30)
+
+def authenticate(username, password):
+    """Authenticate the user.
+
+    :raises hapcat.hashing.HashingBusy: Too many passwords are being checked.
+    """
+
+    from hapcat.models import User
+
+    import hapcat.hashing
+
+    user = db.session.query(User).filter(User.username == username).scalar()
+
+    if user is not None and hapcat.hashing.passwords.check(user, password):
+        # Save the password if it was rehashed.
+        db.session.commit()
+
+        return user
+
+def identity(payload):
+    """Get the identity from the JWT payload.
+
+    This comes from the token's claims, rather than loading the user.
+    """
+
+    import hapcat.identity
+
+    return hapcat.identity.from_payload(payload)
+
+jwt = flask_jwt.JWT(app, authenticate, identity)
+
+@jwt.jwt_payload_handler
+def payload_handler(identity):
+    """Transform the identity object into a payload.
+    """
+
+    current_app = flask.current_app
+
+    iat = datetime.datetime.utcnow()
+    exp = iat + current_app.config.get('JWT_EXPIRATION_DELTA')
+    nbf = iat + current_app.config.get('JWT_NOT_BEFORE_DELTA')
+
+    return {
+        'exp': exp,
+        'iat': iat,
+        'nbf': nbf,
+        'identity': str(identity.id),
+        'username': identity.username,
+        'version': identity.token_version,
+    }
+
+_start_lock = threading.RLock()
+_starting = False
+_started = False
+
+def start():
+    """Start the application, if it isn't already.
+
+    This brings the database schema up to date, loads the JWT secret, and
+    registers the API endpoints.
+    If starting fails, it's tried again the next time.
+    """
+
+    global _starting
+
+    with _start_lock:
+        # This is reentrant, since starting imports modules which look the
+        # application up.
+        if _started or _starting:
+            return
+
+        _starting = True
+
+        try:
+            _start()
+        finally:
+            _starting = False
+
+def _start():
+    """Start the application.
+    """
+
+    global _started
+
+    if not insphinx:
+        import hapcat.schema
+
+        with app.app_context():
+            hapcat.schema.upgrade(
+                db.engine,
+                app.iniconfig.get('database', 'migrations'),
+            )
+
+    # Flask-JWT copied the secret when it was set up, before this.
+    with app.app_context():
+        app.config['SECRET_KEY'] = makejwtsecret()
+    app.config['JWT_SECRET_KEY'] = app.config['SECRET_KEY']
+
+    import hapcat.apiserver
+    import hapcat.models
+
+    # Starting is done before forking, by uWSGI's master or hapcatd, and
+    # the workers mustn't share its connections.
+    release_connections()
+
+    _started = True
+
+    app.logger.info('Started in %.3f seconds', time.time() - _imported)
+
+def release_connections():
+    """Close the process's pooled database connections, so a forked process
+    opens its own.
+
+    An in-memory SQLite database is kept, since closing its connection would
+    lose it.
+    """
+
+    import sqlalchemy.pool
+
+    import hapcat.replicas
+
+    if not isinstance(
+            db.engine.pool,
+            (sqlalchemy.pool.StaticPool, sqlalchemy.pool.SingletonThreadPool),
+        ):
+        db.engine.dispose()
+
+    hapcat.replicas.replicas.close()
@@ -6,7 +6,7 @@
 
 from __future__ import absolute_import
 
-from pkg_resources import resource_string
+import os
 
 import configparser
 
@@ -14,5 +14,95 @@ def create_config(conffile):
     """Write the example configuration to the given file.
     """
 
+    # This is slow to import, and only needed here.
+    from pkg_resources import resource_string
+
     exconf = resource_string('hapcat', 'data/hapcatd-example.conf').decode()
     conffile.write(exconf)
+
+
+def _section_name(line):
+    """Get the section a configuration line starts, if any.
+    """
+
+    line = line.strip()
+
+    if line.startswith('[') and line.endswith(']'):
+        return line[1:-1].strip()
+
+    return None
+
+
+def set_options(filename, section, options):
+    """Set options in a configuration file, keeping the rest of it as-is.
+
+    Options already set in the section are changed where they are, and the
+    others are added to the end of it.
+    Comments, including commented out options, are left alone.
+
+    :param str filename: The configuration file.
+
+    :param str section: The section of the options, which is added if the
+        file doesn't have it.
+
+    :param dict options: The values of the options, by name.
+    """
+
+    with open(filename) as conffile:
+        lines = conffile.readlines()
+
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+
+    start = None
+    end = len(lines)
+
+    for number, line in enumerate(lines):
+        name = _section_name(line)
+
+        if name is None:
+            continue
+
+        if start is not None:
+            end = number
+            break
+
+        if name == section:
+            start = number
+
+    remaining = dict(options)
+
+    if start is None:
+        lines.extend(['\n', '[{0}]\n'.format(section)])
+        start = end = len(lines)
+    else:
+        for number in range(start + 1, end):
+            key, sep, value = lines[number].partition('=')
+
+            if not sep or lines[number].lstrip()[:1] in ('#', ';'):
+                continue
+
+            key = key.strip()
+
+            if key in remaining:
+                lines[number] = '{0} = {1}\n'.format(key, remaining.pop(key))
+
+        # Add the rest after the section's last option, before any blank
+        # lines and comments leading into the next section.
+        while end > start + 1 and (
+                not lines[end - 1].strip() or
+                lines[end - 1].lstrip()[:1] in ('#', ';')
+            ):
+            end -= 1
+
+    lines[end:end] = [
+        '{0} = {1}\n'.format(key, value)
+        for key, value in sorted(remaining.items())
+    ]
+
+    tmpname = '{0}.tmp'.format(filename)
+
+    with open(tmpname, 'w') as conffile:
+        conffile.writelines(lines)
+
+    os.rename(tmpname, filename)
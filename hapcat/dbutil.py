@@ -6,16 +6,16 @@
 
 from __future__ import absolute_import, with_statement, print_function
 
+import hapcat.geo
 import hapcat.models
+import hapcat.search
 import uuid
 
 from hapcat.models import *
 
 import sqlalchemy
 import sqlalchemy.orm
-import alembic.config
-import alembic
-from hapcat import (
+from hapcat.application import (
     app,
     db,
 )
@@ -24,13 +24,576 @@ from sqlalchemy.exc import (
     IntegrityError,
 )
 
+import furl
 import json
-from pkg_resources import resource_string
+import sqlite3
+import time
+
+from sqlalchemy.dialects import postgresql
+
+# SQLite only supports upserts from 3.24.0 on.
+sqlite_upsert = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# SQLite only supports RETURNING from 3.35.0 on.
+sqlite_returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# The vote upserts, by dialect name and whether they return the new total.
+_vote_upserts = {}
+
+
+def _vote_upsert(dialect, returning=True):
+    """Build the statement atomically adding votes for a user.
+
+    The statement takes ``votable_id``, ``user_id``, ``numvotes`` and
+    ``updated`` parameters.
+    It inserts nothing if there's no such votable or user, and otherwise adds
+    ``numvotes`` to any existing votes and sets when they were updated in a
+    single statement, so concurrent votes can't lose each other's updates.
+
+    :returns: The statement, or ``None`` if the database can't do it.
+    """
+
+    vote = Vote.__table__
+    votable = Votable.__table__
+    user = User.__table__
+
+    if dialect.name == 'postgresql':
+        voters = sqlalchemy.select([
+            votable.c.id,
+            user.c.id,
+            sqlalchemy.bindparam('numvotes', type_=vote.c.numvotes.type),
+            sqlalchemy.bindparam('updated', type_=vote.c.updated.type),
+        ]).where(
+            sqlalchemy.and_(
+                votable.c.id == sqlalchemy.bindparam(
+                    'votable_id',
+                    type_=votable.c.id.type,
+                ),
+                user.c.id == sqlalchemy.bindparam(
+                    'user_id',
+                    type_=user.c.id.type,
+                ),
+            )
+        )
+
+        stmt = postgresql.insert(vote).from_select(
+            ['votable_id', 'user_id', 'numvotes', 'updated'],
+            voters,
+        )
+
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[vote.c.votable_id, vote.c.user_id],
+            set_={
+                'numvotes': vote.c.numvotes + stmt.excluded.numvotes,
+                'updated': stmt.excluded.updated,
+            },
+        )
+
+        if returning:
+            stmt = stmt.returning(vote.c.numvotes)
+
+        return stmt
+
+    elif dialect.name == 'sqlite' and sqlite_upsert:
+        # SQLAlchemy can't generate an upsert for SQLite, so spell it out.
+        # The WHERE clause is needed for SQLite to parse the ON CONFLICT as
+        # part of the INSERT rather than as a join constraint.
+        stmt = sqlalchemy.text(
+            'INSERT INTO vote (votable_id, user_id, numvotes, updated) '
+            'SELECT votable.id, "user".id, :numvotes, :updated '
+            'FROM votable, "user" '
+            'WHERE votable.id = :votable_id AND "user".id = :user_id '
+            'ON CONFLICT (votable_id, user_id) DO UPDATE '
+            'SET numvotes = vote.numvotes + excluded.numvotes, '
+            'updated = excluded.updated'
+            + (' RETURNING numvotes' if returning else '')
+        ).bindparams(
+            sqlalchemy.bindparam('votable_id', type_=votable.c.id.type),
+            sqlalchemy.bindparam('user_id', type_=vote.c.user_id.type),
+            sqlalchemy.bindparam('numvotes', type_=vote.c.numvotes.type),
+            sqlalchemy.bindparam('updated', type_=vote.c.updated.type),
+        )
+
+        return stmt
+
+    return None
+
+
+def add_votes(session, votable_id, user_id, numvotes=1):
+    """Add votes for a votable by a user.
+
+    This is a single atomic statement on PostgreSQL and SQLite 3.24.0 or
+    newer.
+    The caller is responsible for committing.
+
+    :param session: The database session.
+
+    :param uuid.UUID votable_id: The event or location to vote for.
+
+    :param uuid.UUID user_id: The user voting.
+
+    :param int numvotes: The number of votes to add.
+
+    :returns: The user's new total votes for the votable, or ``None`` if there
+        is no such votable or user.
+    """
+
+    dialect = session.get_bind().dialect
+
+    params = {
+        'votable_id': votable_id,
+        'user_id': user_id,
+        'numvotes': numvotes,
+        'updated': time.time(),
+    }
+
+    returning = dialect.name != 'sqlite' or sqlite_returning
+
+    try:
+        stmt = _vote_upserts[dialect.name, returning]
+    except KeyError:
+        stmt = _vote_upserts[dialect.name, returning] = _vote_upsert(
+            dialect,
+            returning=returning,
+        )
+
+    if stmt is None:
+        # Fall back to locking the row and updating it.
+        if session.query(Votable.id).filter(
+                Votable.id == votable_id).scalar() is None:
+            return None
+
+        if session.query(User.id).filter(
+                User.id == user_id).scalar() is None:
+            return None
+
+        vote = session.query(Vote).filter(
+            Vote.votable_id == votable_id,
+            Vote.user_id == user_id,
+        ).with_for_update().scalar()
+
+        if vote is None:
+            vote = Vote(votable_id=votable_id, user_id=user_id, numvotes=0)
+            session.add(vote)
+
+        vote.numvotes += numvotes
+        session.flush()
+
+        return vote.numvotes
+
+    result = session.execute(stmt, params)
+
+    if returning:
+        return result.scalar()
+
+    # Without RETURNING, read the total back in the same transaction.
+    # SQLite only allows one writer at a time, so nothing can change it in
+    # between.
+    if result.rowcount < 1:
+        return None
+
+    return session.query(Vote.numvotes).filter(
+        Vote.votable_id == votable_id,
+        Vote.user_id == user_id,
+    ).scalar()
+
+
+def add_votes_many(session, votes):
+    """Add votes for several votables and users in one batch.
+
+    This is a single statement executed once per vote on PostgreSQL and
+    SQLite 3.24.0 or newer, which the driver can batch.
+    Votes for nonexistent votables, or by nonexistent users, are skipped.
+    The caller is responsible for committing.
+
+    :param session: The database session.
+
+    :param votes: An iterable of ``(votable_id, user_id, numvotes)`` tuples.
+    """
+
+    dialect = session.get_bind().dialect
+
+    updated = time.time()
+
+    params = [
+        {
+            'votable_id': votable_id,
+            'user_id': user_id,
+            'numvotes': numvotes,
+            'updated': updated,
+        }
+        for votable_id, user_id, numvotes in votes
+    ]
+
+    if not params:
+        return
+
+    try:
+        stmt = _vote_upserts[dialect.name, False]
+    except KeyError:
+        stmt = _vote_upserts[dialect.name, False] = _vote_upsert(
+            dialect,
+            returning=False,
+        )
+
+    if stmt is None:
+        for param in params:
+            add_votes(
+                session,
+                param['votable_id'],
+                param['user_id'],
+                param['numvotes'],
+            )
+
+        return
+
+    session.execute(stmt, params)
+
+
+class InvalidVotable(ValueError):
+    """An event or location to add is invalid.
+
+    The message is suitable for sending back to the client.
+    """
+
+
+def parse_votable(data):
+    """Validate the JSON for an event or location to add.
+
+    See the addevent endpoint for the format.
+
+    :returns: A tuple of the votable class, name, address, tag UUIDs, photo
+        URLs, and latitude and longitude, or ``None`` if not given.
+
+    :raises InvalidVotable: The JSON is invalid.
+    """
+
+    types = {
+        'event': Event,
+        'location': Location,
+    }
+
+    try:
+        cls = types[data['type']]
+        name = data['name']
+        address = data['address']
+    except (KeyError, TypeError):
+        raise InvalidVotable('Invalid request JSON')
+
+    if not (
+            isinstance(name, type(u'')) and
+            isinstance(address, type(u''))
+        ):
+        raise InvalidVotable('Invalid request JSON')
+
+    tags = data.get('tags', [])
+    photos = data.get('photos', [])
+
+    if not (isinstance(tags, list) and isinstance(photos, list)):
+        raise InvalidVotable('Invalid request JSON')
+
+    try:
+        tags = [uuid.UUID(tag) for tag in tags]
+    except (AttributeError, TypeError, ValueError):
+        raise InvalidVotable('Invalid tag')
+
+    try:
+        for url in photos:
+            if not isinstance(url, type(u'')):
+                raise TypeError('Invalid photo URL')
+
+        photos = [normalize_url(url) for url in photos]
+    except (TypeError, ValueError):
+        raise InvalidVotable('Invalid photo URL')
+
+    coordinates = None
+
+    if 'latitude' in data or 'longitude' in data:
+        coordinates = (data.get('latitude'), data.get('longitude'))
+
+        if not hapcat.geo.valid(*coordinates):
+            raise InvalidVotable('Invalid coordinates')
+
+    return cls, name, address, tags, photos, coordinates
+
+
+def normalize_url(url):
+    """Normalize a photo URL, so it's stored and looked up the same way
+    however it was written.
+
+    :param url: The URL, as a string or :class:`furl.furl`.
+
+    :returns: The URL, as a string.
+
+    :raises ValueError: The URL is invalid.
+    """
+
+    return furl.furl(url).url
+
+
+def _insert_ignore(session, table, column):
+    """Build a statement inserting rows into a table, skipping any whose
+    unique column value is already there.
+
+    Databases which can't skip them raise :class:`IntegrityError` instead.
+    """
+
+    dialect = session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing(
+            index_elements=[column],
+        )
+    elif dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    elif dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+
+    return table.insert()
+
+
+def _insert_unique(session, cls, column, rows, key=None):
+    """Insert objects with a unique column, using the ones with the same
+    values instead if they're already there.
+
+    This is a fixed number of statements, and another transaction inserting
+    the same values at the same time doesn't make it fail.
+
+    :param cls: The :class:`UUIDObject` subclass.
+
+    :param str column: The name of the unique column.
+
+    :param list rows: The mappings of the columns of the class's own table,
+        each with a new ``id``.
+
+    :param key: A function normalizing the column values read back, if
+        they're read as something else than they're written.
+
+    :returns: A dictionary of the IDs of the objects, by the column value.
+    """
+
+    if not rows:
+        return {}
+
+    parent = UUIDObject.__table__
+    table = cls.__table__
+
+    session.execute(
+        parent.insert(),
+        [
+            {
+                'id': row['id'],
+                'type': cls.__mapper_args__['polymorphic_identity'],
+            }
+            for row in rows
+        ],
+    )
+    session.execute(_insert_ignore(session, table, table.c[column]), rows)
+
+    ids = {
+        (value if key is None else key(value)): objectid
+        for value, objectid in session.execute(
+            sqlalchemy.select([table.c[column], table.c.id]).where(
+                table.c[column].in_([row[column] for row in rows])
+            )
+        )
+    }
+
+    # Remove the parents of the rows which were skipped.
+    unused = [row['id'] for row in rows if ids[row[column]] != row['id']]
+
+    if unused:
+        session.execute(parent.delete().where(parent.c.id.in_(unused)))
+
+    return ids
+
+
+def add_votables(session, items):
+    """Add events and locations in bulk.
+
+    The tags, addresses, and photo URLs of all the items are looked up at
+    once, and everything is inserted in bulk, so this takes a fixed number
+    of queries however many items there are.
+    Addresses and photos added by another transaction meanwhile are used
+    rather than added again.
+    The caller is responsible for committing.
+
+    :param session: The database session.
+
+    :param items: The JSON for each event or location.
+        See the addevent endpoint for the format.
+
+    :returns: A list with a tuple of the new votable's UUID and ``None``, or
+        ``None`` and the failure message, for each item.
+    """
+
+    results = []
+    parsed = []
+
+    for data in items:
+        try:
+            parsed.append(parse_votable(data))
+            results.append(None)
+        except InvalidVotable as e:
+            parsed.append(None)
+            results.append((None, str(e)))
+
+    valid = [item for item in parsed if item is not None]
+
+    tagids = set()
+    addresses = set()
+    urls = set()
+
+    for cls, name, address, tags, photos, coordinates in valid:
+        tagids.update(tags)
+        addresses.add(address)
+        urls.update(photos)
+
+    # Look up everything the items refer to at once.
+
+    if tagids:
+        known_tags = {
+            tagid
+            for (tagid,) in session.query(Tag.__table__.c.id).filter(
+                Tag.__table__.c.id.in_(list(tagids))
+            )
+        }
+    else:
+        known_tags = set()
+
+    if addresses:
+        rawlocs = dict(
+            session.query(RawLocation.address, RawLocation.id).filter(
+                RawLocation.address.in_(list(addresses))
+            )
+        )
+    else:
+        rawlocs = {}
+
+    if urls:
+        photoids = {
+            normalize_url(photourl): photoid
+            for photourl, photoid in session.query(
+                Photo.photourl,
+                Photo.id,
+            ).filter(
+                Photo.photourl.in_(list(urls))
+            )
+        }
+    else:
+        photoids = {}
+
+    # Build the new rows.
+
+    newrawlocs = {}
+    newphotos = {}
+    newvotables = {
+        Event: [],
+        Location: [],
+    }
+    votable_tags = []
+    votable_photos = []
+
+    for i, item in enumerate(parsed):
+        if item is None:
+            continue
+
+        cls, name, address, tags, photos, coordinates = item
+
+        if not known_tags.issuperset(tags):
+            results[i] = (None, 'Invalid tag')
+            continue
+
+        if address not in rawlocs and address not in newrawlocs:
+            newrawloc = {
+                'id': uuid.uuid4(),
+                'address': address,
+                'latitude': None,
+                'longitude': None,
+                'geohash': None,
+            }
+
+            if coordinates is not None:
+                newrawloc['latitude'], newrawloc['longitude'] = coordinates
+                newrawloc['geohash'] = hapcat.geo.encode(*coordinates)
+
+            newrawlocs[address] = newrawloc
+
+        for url in photos:
+            if url not in photoids and url not in newphotos:
+                newphotos[url] = {
+                    'id': uuid.uuid4(),
+                    'photourl': url,
+                }
+
+        results[i] = (uuid.uuid4(), None)
+
+    # Insert everything in bulk, parents first.
+
+    rawlocs.update(_insert_unique(
+        session,
+        RawLocation,
+        'address',
+        list(newrawlocs.values()),
+    ))
+    photoids.update(_insert_unique(
+        session,
+        Photo,
+        'photourl',
+        list(newphotos.values()),
+        key=normalize_url,
+    ))
+
+    for i, item in enumerate(parsed):
+        if item is None or results[i][0] is None:
+            continue
+
+        cls, name, address, tags, photos, coordinates = item
+        votableid = results[i][0]
+
+        newvotables[cls].append({
+            'id': votableid,
+            'type': cls.__mapper_args__['polymorphic_identity'],
+            'name': name,
+            'rawlocation_id': rawlocs[address],
+        })
+
+        votable_tags.extend(
+            {'votable_id': votableid, 'tag_id': tagid}
+            for tagid in set(tags)
+        )
+
+        votable_photos.extend(
+            {'votable_id': votableid, 'photo_id': photoid}
+            for photoid in set(photoids[url] for url in photos)
+        )
+
+    for cls, mappings in newvotables.items():
+        session.bulk_insert_mappings(cls, mappings)
+
+    session.bulk_insert_mappings(VotableTag, votable_tags)
+    session.bulk_insert_mappings(VotablePhoto, votable_photos)
+
+    # Bulk inserts skip the flush that would otherwise index them.
+    hapcat.search.reindex(
+        session,
+        [
+            mapping['id']
+            for mappings in newvotables.values()
+            for mapping in mappings
+        ],
+    )
+
+    return results
+
 
 def load_test_data():
     """Load the test data into the database.
     """
 
+    # This is slow to import, and only needed here.
+    from pkg_resources import resource_string
+
     session = db.session
 
     testdata = json.loads(
@@ -0,0 +1,780 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat suggestions feed.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import binascii
+import gzip
+import random
+import threading
+import time
+import uuid
+
+import numpy
+import sqlalchemy
+
+from flask import json
+
+import hapcat.geo
+import hapcat.httpcache
+import hapcat.replicas
+import hapcat.search
+import hapcat.tagindex
+
+from hapcat.application import (
+    app,
+    db,
+)
+
+from hapcat.models import (
+    Event,
+    Location,
+    RawLocation,
+    Recommendation,
+    Vote,
+    VotableTag,
+)
+
+
+# The sections of the suggestions which are paginated, and their models.
+sections = (
+    ('locations', Location),
+    ('events', Event),
+)
+
+
+# The number of nearby raw locations to look up votables at in each query.
+NEARBY_CHUNK = 500
+
+
+class InvalidCursor(ValueError):
+    """A suggestions continuation token is invalid.
+    """
+
+
+def encode_cursor(cursor):
+    """Encode a suggestions cursor as an opaque continuation token.
+
+    :param dict cursor: The ID of the last location and of the last event
+        sent, by section, or ``None`` for sections with nothing left.
+
+    :returns: The token, or ``None`` if no section has anything left.
+    """
+
+    if all(last is None for last in cursor.values()):
+        return None
+
+    raw = json.dumps({
+        section: None if last is None else last.hex
+        for section, last in cursor.items()
+    }).encode('utf-8')
+
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(token):
+    """Decode a continuation token from :func:`encode_cursor`.
+
+    :raises InvalidCursor: The token is invalid.
+    """
+
+    try:
+        raw = base64.urlsafe_b64decode(
+            (token + '=' * (-len(token) % 4)).encode('ascii')
+        )
+        data = json.loads(raw.decode('utf-8'))
+
+        return {
+            section: None if data[section] is None else uuid.UUID(
+                data[section]
+            )
+            for section, cls in sections
+        }
+
+    except (
+            AttributeError,
+            KeyError,
+            TypeError,
+            UnicodeError,
+            ValueError,
+            binascii.Error,
+        ):
+        raise InvalidCursor('Invalid cursor')
+
+
+def build_suggestions(
+        limit=20,
+        cursor=None,
+    ):
+    """Build a page of suggestions from the database.
+
+    Locations and events are each paginated by ID, continuing after the last
+    ones on the previous page, so every page takes the same indexed lookups
+    however deep it is.
+
+    See the suggestions endpoint for the format.
+
+    :param int limit: The most locations and the most events to include.
+
+    :param dict cursor: Where to continue from, as from :func:`decode_cursor`,
+        or ``None`` for the first page.
+    """
+
+    found = {}
+    nextcursor = {}
+
+    # Retrieve a page of each section.
+    # Everything serialized below is loaded up front, so the number of queries
+    # doesn't grow with the number of suggestions.
+
+    for section, cls in sections:
+        found[section] = []
+        nextcursor[section] = None
+
+        query = db.session.query(cls).options(
+            *cls.serialize_options()
+        ).order_by(cls.id)
+
+        if cursor is not None:
+            if cursor[section] is None:
+                continue
+
+            query = query.filter(cls.id > cursor[section])
+
+        # Fetch an extra row to tell whether there's another page.
+        rows = query.limit(limit + 1).all()
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            nextcursor[section] = rows[-1].id
+
+        found[section] = rows
+
+    suggestions = serialize_suggestions(found['locations'], found['events'])
+    suggestions['next'] = encode_cursor(nextcursor)
+
+    return suggestions
+
+
+def _tagged_ids(cls, tags, mode, limit, after):
+    """Get the IDs of the votables with any or all of some tags by query.
+
+    This is used when the tag index is disabled.
+    """
+
+    votable_tag = VotableTag.__table__
+
+    tagged = sqlalchemy.select([votable_tag.c.votable_id]).where(
+        votable_tag.c.tag_id.in_(tags)
+    )
+
+    if mode == 'all':
+        tagged = tagged.group_by(votable_tag.c.votable_id).having(
+            sqlalchemy.func.count() == len(tags)
+        )
+
+    query = db.session.query(cls.id).filter(
+        cls.id.in_(tagged)
+    ).order_by(cls.id)
+
+    if after is not None:
+        query = query.filter(cls.id > after)
+
+    return [votableid for (votableid,) in query.limit(limit)]
+
+
+def build_tagged_suggestions(
+        tags,
+        mode='any',
+        limit=20,
+        cursor=None,
+    ):
+    """Build a page of the suggestions with any or all of the given tags.
+
+    The matching votables are found with the in-memory tag index if the
+    ``[apiserver] tag_index`` configuration is set, and by query otherwise.
+    They're paginated by ID like :func:`build_suggestions`.
+
+    See the suggestions endpoint for the format.
+
+    :param tags: The tag UUIDs.
+
+    :param str mode: ``any`` or ``all``.
+
+    :param int limit: The most locations and the most events to include.
+
+    :param dict cursor: Where to continue from, as from :func:`decode_cursor`,
+        or ``None`` for the first page.
+    """
+
+    tags = set(tags)
+    found = {}
+    nextcursor = {}
+
+    if app.iniconfig.getboolean('apiserver', 'tag_index'):
+        matches = hapcat.tagindex.tag_index.match(tags, mode)
+    else:
+        matches = None
+
+    for section, cls in sections:
+        found[section] = []
+        nextcursor[section] = None
+        after = None
+
+        if cursor is not None:
+            if cursor[section] is None:
+                continue
+
+            after = cursor[section]
+
+        # Find an extra ID to tell whether there's another page.
+        if matches is not None:
+            ids = matches.page(section, limit + 1, after)
+        else:
+            ids = _tagged_ids(cls, tags, mode, limit + 1, after)
+
+        if len(ids) > limit:
+            ids = ids[:limit]
+            nextcursor[section] = ids[-1]
+
+        if ids:
+            found[section] = db.session.query(cls).options(
+                *cls.serialize_options()
+            ).filter(
+                cls.id.in_(ids)
+            ).order_by(cls.id).all()
+
+    suggestions = serialize_suggestions(found['locations'], found['events'])
+    suggestions['next'] = encode_cursor(nextcursor)
+
+    return suggestions
+
+
+def nearby_rawlocations(session, latitude, longitude, radius):
+    """Find the raw locations within a radius of a point.
+
+    The candidates are found by their indexed geohashes, then filtered by
+    their exact distances all at once.
+
+    :param session: The database session.
+
+    :param float radius: The radius, in meters.
+
+    :returns: A list of the raw location UUIDs and their distances, nearest
+        first.
+    """
+
+    rawlocation = RawLocation.__table__
+
+    ranges = [
+        sqlalchemy.and_(
+            rawlocation.c.geohash >= prefix,
+            rawlocation.c.geohash < prefix + '~',
+        )
+        for prefix in hapcat.geo.cover(latitude, longitude, radius)
+    ]
+
+    rows = session.execute(
+        sqlalchemy.select([
+            rawlocation.c.id,
+            rawlocation.c.latitude,
+            rawlocation.c.longitude,
+        ]).where(
+            sqlalchemy.or_(*ranges)
+        )
+    ).fetchall()
+
+    if not rows:
+        return []
+
+    ids, latitudes, longitudes = zip(*rows)
+
+    distances = hapcat.geo.distances(
+        latitude,
+        longitude,
+        numpy.array(latitudes, dtype=float),
+        numpy.array(longitudes, dtype=float),
+    )
+
+    order = numpy.argsort(distances, kind='stable')
+    order = order[distances[order] <= radius]
+
+    return [(ids[i], float(distances[i])) for i in order]
+
+
+def build_nearby_suggestions(
+        latitude,
+        longitude,
+        radius,
+        limit=20,
+    ):
+    """Build the suggestions nearest a point, within a radius.
+
+    See the suggestions endpoint for the format.
+
+    :param float radius: The radius, in meters.
+
+    :param int limit: The most locations and the most events to include.
+    """
+
+    nearby = nearby_rawlocations(db.session, latitude, longitude, radius)
+    distances = dict(nearby)
+    found = {}
+    votabledistances = {}
+
+    for section, cls in sections:
+        ids = []
+
+        # Look through the nearest raw locations first, until there are
+        # enough votables at them.
+        for start in range(0, len(nearby), NEARBY_CHUNK):
+            chunk = [
+                rawid
+                for rawid, distance in nearby[start:start + NEARBY_CHUNK]
+            ]
+
+            rows = db.session.query(cls.id, cls.rawlocation_id).filter(
+                cls.rawlocation_id.in_(chunk)
+            ).all()
+
+            rows.sort(key=lambda row: distances[row.rawlocation_id])
+            ids.extend(row.id for row in rows)
+
+            if len(ids) >= limit:
+                break
+
+        ids = ids[:limit]
+
+        if ids:
+            found[section] = db.session.query(cls).options(
+                *cls.serialize_options()
+            ).filter(
+                cls.id.in_(ids)
+            ).all()
+        else:
+            found[section] = []
+
+        for votable in found[section]:
+            votabledistances[votable.id] = distances[votable.rawlocation_id]
+
+    suggestions = serialize_suggestions(
+        found['locations'],
+        found['events'],
+        distances=votabledistances,
+    )
+    suggestions['next'] = None
+
+    return suggestions
+
+
+def tag_affinity(session, user_id):
+    """Get how much a user likes each tag, from their votes.
+
+    Each tag's affinity is the user's total votes for the votables with it.
+
+    :param session: The database session.
+
+    :param uuid.UUID user_id: The UUID of the user.
+
+    :returns: A tuple of the affinity of each tag, by UUID, and a set of the
+        UUIDs of the tagged votables the user has voted for.
+    """
+
+    vote = Vote.__table__
+    votable_tag = VotableTag.__table__
+
+    rows = session.execute(
+        sqlalchemy.select([
+            vote.c.votable_id,
+            vote.c.numvotes,
+            votable_tag.c.tag_id,
+        ]).select_from(
+            vote.join(
+                votable_tag,
+                votable_tag.c.votable_id == vote.c.votable_id,
+            )
+        ).where(
+            vote.c.user_id == user_id
+        )
+    )
+
+    affinity = {}
+    voted = set()
+
+    for votable_id, numvotes, tag_id in rows:
+        affinity[tag_id] = affinity.get(tag_id, 0) + numvotes
+        voted.add(votable_id)
+
+    return affinity, voted
+
+
+def _affinity_top(cls, user_id, limit):
+    """Get the best scoring votables for a user's tag affinities by query.
+
+    This is used when the tag index is disabled.
+    The votables are scored as by :meth:`hapcat.tagindex.TagIndex.scores`,
+    leaving out those scoring zero and those the user has voted for.
+
+    :returns: A list of tuples of the votable UUID and its score, best
+        first.
+    """
+
+    vote = Vote.__table__
+    own_vote = vote.alias('own_vote')
+    tagged = VotableTag.__table__.alias('tagged')
+    voted = VotableTag.__table__.alias('voted')
+
+    # Each of the votable's tags scores the user's votes for the votables
+    # with it.
+    score = sqlalchemy.func.sum(vote.c.numvotes)
+
+    query = db.session.query(cls.id, score).join(
+        tagged,
+        tagged.c.votable_id == cls.id,
+    ).join(
+        voted,
+        voted.c.tag_id == tagged.c.tag_id,
+    ).join(
+        vote,
+        vote.c.votable_id == voted.c.votable_id,
+    ).filter(
+        vote.c.user_id == user_id,
+        ~sqlalchemy.exists().where(
+            own_vote.c.user_id == user_id
+        ).where(
+            own_vote.c.votable_id == cls.id
+        ),
+    ).group_by(
+        cls.id
+    ).having(
+        score > 0
+    ).order_by(
+        score.desc(),
+        cls.id,
+    )
+
+    return [
+        (votable_id, float(votablescore))
+        for votable_id, votablescore in query.limit(limit)
+    ]
+
+
+def build_recommended_suggestions(user_id, recommendations, limit=20):
+    """Build the suggestions from a user's stored recommendations.
+
+    Those the user has voted for since they were recommended are left out.
+
+    See the suggestions endpoint for the format.
+
+    :param uuid.UUID user_id: The UUID of the user.
+
+    :param recommendations: The recommended votable UUIDs, best first.
+
+    :param int limit: The most locations and the most events to include.
+    """
+
+    ranks = {
+        votable_id: rank
+        for rank, votable_id in enumerate(recommendations)
+    }
+    found = {}
+
+    for section, cls in sections:
+        found[section] = sorted(
+            db.session.query(cls).options(
+                *cls.serialize_options()
+            ).filter(
+                cls.id.in_(recommendations),
+                ~sqlalchemy.exists().where(
+                    Vote.user_id == user_id
+                ).where(
+                    Vote.votable_id == cls.id
+                ),
+            ).all(),
+            key=lambda votable: ranks[votable.id],
+        )[:limit]
+
+    suggestions = serialize_suggestions(
+        found['locations'],
+        found['events'],
+        ranks=ranks,
+    )
+    suggestions['next'] = None
+
+    return suggestions
+
+
+def build_personalized_suggestions(user_id, limit=20):
+    """Build the suggestions a user is likeliest to vote for, best first.
+
+    If :mod:`hapcat.recommend` has recommended anything for the user, those
+    are used, leaving out any they've voted for since.
+    Otherwise, every tagged event and location is scored by the user's
+    affinity for its tags at once, with the in-memory tag index, or by query
+    if ``[apiserver] tag_index`` is off, and those the user has already
+    voted for are left out.
+    Users who haven't voted for anything tagged get the regular suggestions.
+
+    See the suggestions endpoint for the format.
+
+    :param uuid.UUID user_id: The UUID of the user.
+
+    :param int limit: The most locations and the most events to include.
+    """
+
+    recommendation = Recommendation.__table__
+
+    recommendations = [
+        votable_id
+        for (votable_id,) in db.session.execute(
+            sqlalchemy.select([
+                recommendation.c.votable_id,
+            ]).where(
+                recommendation.c.user_id == user_id
+            ).order_by(
+                recommendation.c.rank
+            )
+        )
+    ]
+
+    if recommendations:
+        return build_recommended_suggestions(
+            user_id,
+            recommendations,
+            limit=limit,
+        )
+
+    affinity, voted = tag_affinity(db.session, user_id)
+
+    if not affinity:
+        suggestions = build_suggestions(limit=limit)
+        suggestions['next'] = None
+
+        return suggestions
+
+    if app.iniconfig.getboolean('apiserver', 'tag_index'):
+        scores = hapcat.tagindex.tag_index.scores(affinity, exclude=voted)
+    else:
+        scores = None
+
+    found = {}
+    ranks = {}
+
+    for section, cls in sections:
+        if scores is not None:
+            top = scores.top(section, limit)
+        else:
+            top = _affinity_top(cls, user_id, limit)
+
+        if top:
+            found[section] = db.session.query(cls).options(
+                *cls.serialize_options()
+            ).filter(
+                cls.id.in_([votable_id for votable_id, score in top])
+            ).all()
+        else:
+            found[section] = []
+
+        for votable_id, score in top:
+            ranks[votable_id] = -score
+
+    suggestions = serialize_suggestions(
+        found['locations'],
+        found['events'],
+        ranks=ranks,
+    )
+    suggestions['next'] = None
+
+    return suggestions
+
+
+def build_search_results(query, limit=20, offset=0):
+    """Build the suggestions matching a search query, best first.
+
+    See the search endpoint for the format.
+
+    :param str query: The search query.
+
+    :param int limit: The most events and locations to include.
+
+    :param int offset: The number of results to skip.
+
+    :raises hapcat.search.InvalidQuery: The query has no words.
+    """
+
+    # Get an extra result to tell whether there's another page.
+    ids = hapcat.search.search(db.session, query, limit + 1, offset)
+    more = len(ids) > limit
+    ids = ids[:limit]
+    ranks = {votable_id: rank for rank, votable_id in enumerate(ids)}
+    found = {}
+
+    for section, cls in sections:
+        if ids:
+            found[section] = db.session.query(cls).options(
+                *cls.serialize_options()
+            ).filter(
+                cls.id.in_(ids)
+            ).all()
+        else:
+            found[section] = []
+
+    results = serialize_suggestions(
+        found['locations'],
+        found['events'],
+        ranks=ranks,
+    )
+    results['next'] = (
+        hapcat.search.encode_cursor(offset + limit)
+        if more
+        else None
+    )
+
+    return results
+
+
+def serialize_suggestions(locations, events, distances=None, ranks=None):
+    """Serialize the given locations and events as suggestions.
+
+    See the suggestions endpoint for the format.
+
+    :param dict distances: The distance of each votable, by ID, to order the
+        suggestions by, nearest first.
+
+    :param dict ranks: The rank of each votable, by ID, to order the
+        suggestions by, lowest first.
+        If neither this nor ``distances`` is given, they're in a random order.
+    """
+
+    tags = set()
+    slocs = {}
+
+    for loc in locations:
+        tags.update(loc.tags)
+        slocs[str(loc.id)] = loc.serialize()
+
+    sevents = {}
+    eventlocs = {}
+
+    for event in events:
+        tags.update(event.tags)
+        sevents[str(event.id)] = event.serialize()
+        eventlocs[str(event.rawlocation.id)] = event.rawlocation.serialize()
+
+    # Retrieve our tags.
+
+    stags = {str(tag.id): tag.serialize() for tag in tags}
+
+    # Generate our order.
+
+    raworder = list(slocs.values()) + list(sevents.values())
+
+    if distances is not None:
+        raworder.sort(key=lambda x: distances[x['id']])
+    elif ranks is not None:
+        raworder.sort(key=lambda x: ranks[x['id']])
+    else:
+        random.shuffle(raworder)
+
+    order = [
+        {
+            'section': 'locations' if x['type'] == 'location' else 'events',
+            'id': x['id'],
+        }
+        for x in raworder
+    ]
+
+    if distances is not None:
+        for item in order:
+            item['distance'] = distances[item['id']]
+
+    # Add in our raw locations
+    slocs.update(eventlocs)
+
+    return {
+        'locations': slocs,
+        'events': sevents,
+        'tags': stags,
+        'order': order,
+    }
+
+
+class Payload(object):
+    """A serialized suggestions payload.
+
+    :ivar bytes body: The JSON body.
+
+    :ivar bytes gzipped: The JSON body, gzip-compressed.
+
+    :ivar float built: When the payload was built, from :func:`time.time`.
+
+    :ivar str etag: The ETag of the JSON body.
+
+    :ivar str gzip_etag: The ETag of the compressed body.
+        This differs from the uncompressed one, since it's a strong ETag for
+        different bytes.
+    """
+
+    def __init__(self, body, built):
+        self.body = body
+        self.gzipped = gzip.compress(body)
+        self.built = built
+        self.etag = hapcat.httpcache.make_etag('suggestions', body)
+        self.gzip_etag = self.etag + '-gzip'
+
+
+class SuggestionsFeed(object):
+    """The precomputed first page of suggestions for this process.
+
+    The suggestions are built and serialized once, then served as-is until
+    they're invalidated by a write, or until they're older than the
+    ``[apiserver] suggestions_ttl`` configuration, in seconds.
+    The TTL bounds how long other processes, which don't see the
+    invalidation, can serve stale suggestions.
+    They're built from the primary, since every client is served them.
+
+    Note that the suggestion order is only shuffled when the payload is
+    built.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._payload = None
+
+    def invalidate(self):
+        """Drop the current payload, rebuilding it on the next request.
+        """
+
+        with self._lock:
+            self._payload = None
+
+    def get(self):
+        """Get the current payload, building it if needed.
+        """
+
+        ttl = app.iniconfig.getfloat('apiserver', 'suggestions_ttl')
+
+        with self._lock:
+            payload = self._payload
+            now = time.time()
+
+            if payload is None or now - payload.built >= ttl:
+                with hapcat.replicas.primary():
+                    suggestions = build_suggestions(
+                        limit=app.iniconfig.getint(
+                            'apiserver',
+                            'suggestions_page_size',
+                        ),
+                    )
+
+                body = json.dumps(suggestions).encode('utf-8')
+                payload = self._payload = Payload(body, now)
+
+            return payload
+
+
+suggestions_feed = SuggestionsFeed()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat geospatial utilities.
+
+Raw locations with coordinates store their geohash, which is indexed.
+Geohashes of nearby points usually share a prefix, so the candidates for a
+radius search are found with a few index range scans over the prefixes
+covering it, and then filtered by their exact distances.
+"""
+
+from __future__ import absolute_import, division
+
+import math
+
+import numpy
+
+# The geohash alphabet.
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# The precision of the stored geohashes, in characters.
+PRECISION = 12
+
+# The mean radius of the Earth, in meters.
+EARTH_RADIUS = 6371008.8
+
+
+def _bits(precision):
+    """Get the number of latitude and longitude bits in a geohash.
+    """
+
+    bits = 5 * precision
+
+    return bits // 2, bits - bits // 2
+
+
+def _hash(latidx, lonidx, precision):
+    """Get the geohash of the cell with the given indices.
+    """
+
+    latbits, lonbits = _bits(precision)
+    value = 0
+
+    # The bits alternate, starting with longitude.
+    for i in range(5 * precision):
+        if i % 2 == 0:
+            lonbits -= 1
+            value = (value << 1) | ((lonidx >> lonbits) & 1)
+        else:
+            latbits -= 1
+            value = (value << 1) | ((latidx >> latbits) & 1)
+
+    return ''.join(
+        BASE32[(value >> (5 * (precision - 1 - i))) & 31]
+        for i in range(precision)
+    )
+
+
+def _index(value, low, high, bits):
+    """Get the index of the cell containing a value along one axis.
+    """
+
+    cells = 1 << bits
+
+    return min(int((value - low) / (high - low) * cells), cells - 1)
+
+
+def valid(latitude, longitude):
+    """Check whether coordinates are valid.
+    """
+
+    for value in (latitude, longitude):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+
+        if math.isnan(value):
+            return False
+
+    return -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    """Get the geohash of a point.
+
+    >>> encode(57.64911, 10.40744, 11)
+    'u4pruydqqvj'
+    """
+
+    latbits, lonbits = _bits(precision)
+
+    return _hash(
+        _index(latitude, -90, 90, latbits),
+        _index(longitude, -180, 180, lonbits),
+        precision,
+    )
+
+
+def cover(latitude, longitude, radius, maxcells=64):
+    """Get the geohash prefixes of the cells covering a circle.
+
+    This uses the longest prefixes for which at most ``maxcells`` cells
+    cover the circle's bounding box.
+
+    :param float radius: The radius of the circle, in meters.
+
+    :returns: A sorted list of geohash prefixes.
+    """
+
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    south = max(latitude - dlat, -90)
+    north = min(latitude + dlat, 90)
+
+    # The bounding box is widest in longitude nearest the poles.
+    widest = max(abs(south), abs(north))
+
+    if widest >= 90:
+        dlon = 180
+    else:
+        dlon = min(dlat / math.cos(math.radians(widest)), 180)
+
+    for precision in range(PRECISION, 0, -1):
+        latbits, lonbits = _bits(precision)
+
+        latidxs = range(
+            _index(south, -90, 90, latbits),
+            _index(north, -90, 90, latbits) + 1,
+        )
+
+        if dlon >= 180:
+            lonidxs = range(1 << lonbits)
+        else:
+            first = _index(
+                (longitude - dlon + 180) % 360 - 180,
+                -180,
+                180,
+                lonbits,
+            )
+            last = _index(
+                (longitude + dlon + 180) % 360 - 180,
+                -180,
+                180,
+                lonbits,
+            )
+
+            # Wrap around the antimeridian.
+            if last < first:
+                last += 1 << lonbits
+
+            lonidxs = range(first, last + 1)
+
+        if len(latidxs) * len(lonidxs) <= maxcells or precision == 1:
+            return sorted(
+                _hash(latidx, lonidx % (1 << lonbits), precision)
+                for latidx in latidxs
+                for lonidx in lonidxs
+            )
+
+
+def distances(latitude, longitude, latitudes, longitudes):
+    """Get the great-circle distances from a point to several others.
+
+    :param latitudes: An array of the other points' latitudes.
+
+    :param longitudes: An array of the other points' longitudes.
+
+    :returns: An array of the distances, in meters.
+    """
+
+    lat = math.radians(latitude)
+    lats = numpy.radians(latitudes)
+
+    a = (
+        numpy.sin((lats - lat) / 2) ** 2 +
+        math.cos(lat) * numpy.cos(lats) *
+        numpy.sin(numpy.radians(longitudes - longitude) / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))
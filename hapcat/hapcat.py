@@ -10,10 +10,10 @@ import argparse
 import os
 import sys
 
+# Only import what --version and --help need here, so they're quick, and
+# leave setting up the application until it's used.
 import hapcat
-import hapcat.apiserver
 import hapcat.config
-import hapcat.dbutil
 
 
 def make_argparser():
@@ -49,14 +49,129 @@ def make_argparser():
         help='generate a default configuration file'
     )
 
+    parser.add_argument(
+        '--dev',
+        action='store_true',
+        help='serve with the single process Werkzeug development server'
+    )
+
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help='start the application, migrating the database as configured, '
+            'and exit without serving'
+    )
+
+    return parser
+
+def make_recommend_argparser():
+    """Return an ArgumentParser for hapcat-recommend.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Recommend events and locations to the users who voted '
+            'since the last run, from the votes of people who voted like '
+            'them.',
+        add_help=True
+    )
+
+    # Version.
+    parser.add_argument(
+        '-V',
+        '--version',
+        action='version',
+        version='%(prog)s {version}'.format(version=hapcat.__version__)
+    )
+
+    parser.add_argument(
+        '-c',
+        '--config',
+        type=argparse.FileType('r'),
+        help='the configuration file to use'
+    )
+
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='find the factors from all the votes again and recommend for '
+            'everyone, even if the last ones are recent enough'
+    )
+
     return parser
 
+
+def make_calibrate_argparser():
+    """Return an ArgumentParser for hapcat-calibrate.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Measure how long argon2 takes to hash a password on '
+            'this host, and find the costs which fit in a target time.',
+        add_help=True
+    )
+
+    # Version.
+    parser.add_argument(
+        '-V',
+        '--version',
+        action='version',
+        version='%(prog)s {version}'.format(version=hapcat.__version__)
+    )
+
+    parser.add_argument(
+        '-c',
+        '--config',
+        help='the configuration file to use, and to write the costs to'
+    )
+
+    parser.add_argument(
+        '-t',
+        '--target',
+        type=float,
+        help='the longest a hash should take, in seconds '
+            '(default: [passwords] target_time)'
+    )
+
+    parser.add_argument(
+        '-m',
+        '--max-memory-cost',
+        type=int,
+        help='the most memory to use for a hash, in KiB '
+            '(default: [passwords] max_memory_cost)'
+    )
+
+    parser.add_argument(
+        '-w',
+        '--write',
+        action='store_true',
+        help='write the costs to the configuration file'
+    )
+
+    return parser
+
+
+def load_config(configfile):
+    """Load a configuration file over the defaults.
+
+    This should be done before the application is started, so it connects
+    to the configured database.
+    """
+
+    from hapcat.application import (
+        app,
+        configure_database,
+    )
+
+    with app.app_context():
+        app.iniconfig.readfp(configfile)
+
+    configure_database()
+
+
 def main():
     """Start the Hapcat daemon.
     """
 
-    from hapcat import app
-
     # Parse our arguments.
     args = make_argparser().parse_args()
 
@@ -64,24 +179,149 @@ def main():
         hapcat.config.create_config(args.genconfig)
         return
 
+    if not (args.dev or args.check) and not hasattr(os, 'fork'):
+        print('Only the --dev server is available on this platform',
+            file=sys.stderr)
+        return 1
+
     # Load our non-environment configuration.
 
     if args.config:
-        with app.app_context():
-            app.iniconfig.readfp(args.config)
+        load_config(args.config)
+
+    dev = args.dev
+    check = args.check
+
+    del args
+
+    # Start the application before forking the workers.
+    from hapcat import app
 
-        app.config['SQLALCHEMY_DATABASE_URI'] = app.iniconfig.get(
-            'database',
-            'dburl'
+    if check:
+        return 0
+
+    if dev:
+        app.run(
+            host=app.iniconfig.get('apiserver', 'address'),
+            port=app.iniconfig.getint('apiserver', 'port'),
         )
+    else:
+        import hapcat.server
+
+        hapcat.server.serve()
+
+
+def recommend_main():
+    """Update the precomputed recommendations.
+
+    This is meant to be run periodically, such as from cron.
+    """
+
+    args = make_recommend_argparser().parse_args()
+
+    if args.config:
+        load_config(args.config)
+
+    full = args.full
 
     del args
 
-    app.run(
-        host=app.iniconfig.get('apiserver', 'address'),
-        port=app.iniconfig.getint('apiserver', 'port'),
+    from hapcat import (
+        app,
+        db,
+    )
+
+    import hapcat.recommend
+
+    with app.app_context():
+        hapcat.recommend.recommend(
+            db.session,
+            factors=app.iniconfig.getint('recommender', 'factors'),
+            iterations=app.iniconfig.getint('recommender', 'iterations'),
+            count=app.iniconfig.getint('recommender', 'recommendations'),
+            batch=app.iniconfig.getint('recommender', 'batch_users'),
+            rebuild_interval=app.iniconfig.getfloat(
+                'recommender',
+                'rebuild_interval',
+            ),
+            full=full,
+        )
+
+    return 0
+
+
+def calibrate_main():
+    """Find the argon2 costs which fit this host.
+
+    This should be run on the host which will serve hapcat, when it isn't
+    busy.
+    """
+
+    parser = make_calibrate_argparser()
+    args = parser.parse_args()
+
+    if args.write and not args.config:
+        parser.error('--write needs a configuration file')
+
+    # This only needs the configuration, not the database.
+    from hapcat.application import app
+
+    import hapcat.hashing
+
+    if args.config:
+        with open(args.config) as configfile:
+            load_config(configfile)
+
+    target = args.target
+    if target is None:
+        target = app.iniconfig.getfloat('passwords', 'target_time')
+
+    max_memory_cost = args.max_memory_cost
+    if max_memory_cost is None:
+        max_memory_cost = app.iniconfig.getint('passwords', 'max_memory_cost')
+
+    current = hapcat.hashing.argon2_settings()
+
+    print('current: time_cost={0} memory_cost={1}KiB parallelism={2}: '
+        '{3:.1f}ms'.format(
+            current['rounds'],
+            current['memory_cost'],
+            current['parallelism'],
+            hapcat.hashing.measure(**current) * 1000,
+        ))
+
+    settings, elapsed = hapcat.hashing.calibrate(
+        target,
+        max_memory_cost,
+        current['parallelism'],
     )
 
+    print('calibrated: time_cost={0} memory_cost={1}KiB parallelism={2}: '
+        '{3:.1f}ms'.format(
+            settings['rounds'],
+            settings['memory_cost'],
+            settings['parallelism'],
+            elapsed * 1000,
+        ))
+
+    if elapsed > target:
+        print('warning: even the lowest costs take longer than {0:.1f}ms'
+            .format(target * 1000), file=sys.stderr)
+
+    if args.write:
+        hapcat.config.set_options(
+            args.config,
+            'passwords',
+            {
+                'argon2_time_cost': settings['rounds'],
+                'argon2_memory_cost': settings['memory_cost'],
+                'argon2_parallelism': settings['parallelism'],
+            },
+        )
+        print('wrote {0}'.format(args.config))
+
+    return 0
+
 
 if __name__ == '__main__':
     sys.exit(main())
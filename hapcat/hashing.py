@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat password hashing.
+"""
+
+from __future__ import absolute_import
+
+import concurrent.futures
+import os
+import threading
+import time
+
+import passlib.hash
+import sqlalchemy.orm
+
+from hapcat.application import app
+
+
+def argon2_settings():
+    """Get the configured argon2 settings, as passlib options.
+    """
+
+    return {
+        'rounds': app.iniconfig.getint('passwords', 'argon2_time_cost'),
+        'memory_cost': app.iniconfig.getint('passwords', 'argon2_memory_cost'),
+        'parallelism': app.iniconfig.getint('passwords', 'argon2_parallelism'),
+    }
+
+
+def password_context(**kwargs):
+    """Get the settings of the password column's passlib context.
+
+    This is called when the context is first used, so the configuration has
+    been read by then.
+    """
+
+    settings = {
+        'argon2__{0}'.format(key): value
+        for key, value in argon2_settings().items()
+    }
+
+    settings.update(kwargs)
+
+    return settings
+
+
+def needs_rehash(context, hashed):
+    """Check whether a password hash uses other than the configured settings.
+
+    :param context: The password column's passlib context.
+
+    :param hashed: The password hash.
+    """
+
+    if context.needs_update(hashed):
+        return True
+
+    current = passlib.hash.argon2.from_string(hashed)
+    settings = argon2_settings()
+
+    return (
+        current.rounds != settings['rounds'] or
+        current.memory_cost != settings['memory_cost'] or
+        current.parallelism != settings['parallelism']
+    )
+
+
+def _verify(hashed, password):
+    """Check a password against its hash, rehashing it if needed.
+
+    :returns: A tuple of whether the password is right, and its new hash if
+        it should be rehashed, or ``None``.
+    """
+
+    from hapcat.models import User
+
+    context = User.__table__.c.password.type.context
+
+    if not context.verify(password, hashed):
+        return False, None
+
+    if needs_rehash(context, hashed):
+        return True, User.hash_password(password)
+
+    return True, None
+
+
+def measure(rounds, memory_cost, parallelism, samples=3):
+    """Measure how long argon2 takes to hash a password.
+
+    :param int rounds: The time cost.
+
+    :param int memory_cost: The memory cost, in KiB.
+
+    :param int parallelism: The number of lanes.
+
+    :param int samples: The number of hashes to take the median time of.
+
+    :returns: The time, in seconds.
+    """
+
+    hasher = passlib.hash.argon2.using(
+        rounds=rounds,
+        memory_cost=memory_cost,
+        parallelism=parallelism,
+    )
+    times = []
+
+    for i in range(samples):
+        began = time.time()
+        hasher.hash('correct horse battery staple')
+        times.append(time.time() - began)
+
+    return sorted(times)[len(times) // 2]
+
+
+def calibrate(target, max_memory_cost, parallelism, samples=3):
+    """Find the argon2 settings which take up to a target time on this host.
+
+    The memory cost is as high as allowed, since that's what makes guessing
+    passwords on GPUs expensive, and only lowered if even one pass takes too
+    long.
+    The time cost is then as high as fits in the target.
+
+    :param float target: The longest a hash should take, in seconds.
+
+    :param int max_memory_cost: The most memory to use, in KiB.
+
+    :param int parallelism: The number of lanes.
+
+    :param int samples: The number of hashes to time for each setting.
+
+    :returns: A tuple of the argon2 settings, as for
+        :func:`argon2_settings`, and how long they take, in seconds.
+    """
+
+    # argon2 needs at least 8 KiB for each lane.
+    memory_cost = max(max_memory_cost, 8 * parallelism)
+
+    while True:
+        elapsed = measure(1, memory_cost, parallelism, samples)
+
+        if elapsed <= target or memory_cost // 2 < 8 * parallelism:
+            break
+
+        memory_cost //= 2
+
+    rounds = max(1, int(target / elapsed))
+    elapsed = measure(rounds, memory_cost, parallelism, samples)
+
+    while rounds > 1 and elapsed > target:
+        rounds -= 1
+        elapsed = measure(rounds, memory_cost, parallelism, samples)
+
+    return (
+        {
+            'rounds': rounds,
+            'memory_cost': memory_cost,
+            'parallelism': parallelism,
+        },
+        elapsed,
+    )
+
+
+class HashingBusy(Exception):
+    """Too many passwords are already being hashed.
+    """
+
+
+class PasswordHasher(object):
+    """Hash and check passwords on dedicated threads, a few at a time.
+
+    Hashing a password takes long enough on purpose that a burst of logins
+    would otherwise tie up every request thread.
+    Instead, at most ``[apiserver] hash_workers`` passwords are hashed at
+    once, and a request which can't start within
+    ``[apiserver] hash_queue_timeout`` seconds gives up with
+    :class:`HashingBusy`, leaving the other request threads free.
+    argon2 releases the GIL while hashing, so threads are enough.
+
+    Each process has its own threads, which are reset if it's forked.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        """Reset the hasher for the current process.
+        """
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+
+    def _start(self):
+        """Start the hashing threads if needed.
+        """
+
+        if self._pid != os.getpid():
+            self._reset()
+
+        if self._executor is not None:
+            return
+
+        with self._lock:
+            if self._executor is not None:
+                return
+
+            workers = app.iniconfig.getint('apiserver', 'hash_workers')
+
+            self._slots = threading.BoundedSemaphore(workers)
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers,
+            )
+
+    def run(self, func, *args):
+        """Call a function on a hashing thread, waiting for its result.
+
+        :raises HashingBusy: No hashing thread was free in time.
+        """
+
+        self._start()
+
+        if not self._slots.acquire(
+                timeout=app.iniconfig.getfloat(
+                    'apiserver',
+                    'hash_queue_timeout',
+                ),
+            ):
+            raise HashingBusy('Too many passwords are being hashed')
+
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Hash a new password for a user.
+
+        :returns: The hashed password, to assign to ``User.password``.
+
+        :raises HashingBusy: No hashing thread was free in time.
+        """
+
+        from hapcat.models import User
+
+        return self.run(User.hash_password, password)
+
+    def check(self, user, password):
+        """Check a user's password.
+
+        If it's right, but was hashed with other settings than the
+        configured ones, it's rehashed with them, and the caller should
+        commit the change.
+        The new hash only replaces the one checked, so if another login
+        rehashed it, or the password was changed, meanwhile, that's kept.
+
+        :returns: Whether the password is right.
+
+        :raises HashingBusy: No hashing thread was free in time.
+        """
+
+        from hapcat.models import User
+
+        # Read the hash here, so the other thread doesn't touch the session.
+        hashed = user.password
+        valid, rehashed = self.run(_verify, hashed.hash, password)
+
+        if rehashed is not None:
+            session = sqlalchemy.orm.object_session(user)
+            table = User.__table__
+
+            session.execute(
+                table.update()
+                .where(table.c.id == user.id)
+                .where(table.c.password == hashed)
+                .values(password=rehashed)
+            )
+            session.expire(user, ['password'])
+
+        return valid
+
+
+passwords = PasswordHasher()
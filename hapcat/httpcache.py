@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat HTTP caching helpers.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+
+import flask
+
+from flask import request
+
+from flask_api import status
+
+from werkzeug.http import quote_etag
+
+import hapcat
+
+
+def make_etag(*parts):
+    """Make a strong ETag from the given parts.
+
+    The backend version is included, so upgrades that change the
+    serialization invalidate any cached responses.
+
+    :returns: The unquoted ETag.
+    """
+
+    digest = hashlib.sha1(hapcat.__version__.encode('utf-8'))
+
+    for part in parts:
+        digest.update(b'\0')
+        digest.update(str(part).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def object_etag(obj):
+    """Make the ETag of a database object from its type, ID, and version.
+    """
+
+    return make_etag(obj.type, obj.id, obj.version)
+
+
+def is_fresh(*etags):
+    """Check whether the client already has any of the given ETags.
+    """
+
+    return any(request.if_none_match.contains_weak(etag) for etag in etags)
+
+
+def not_modified(etag):
+    """Make an empty ``304 Not Modified`` response with the given ETag.
+    """
+
+    response = flask.Response(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+
+    return response
+
+
+def cached(etag, serialize):
+    """Respond with a serialized object, unless the client already has it.
+
+    :param str etag: The unquoted ETag of the object.
+
+    :param serialize: A callable returning the serialized object.
+        It isn't called if the client already has the object.
+
+    :returns: A ``304 Not Modified`` response, or the serialized object, the
+        status, and an ETag header.
+    """
+
+    if is_fresh(etag):
+        return not_modified(etag)
+
+    return (
+        serialize(),
+        status.HTTP_200_OK,
+        {'ETag': quote_etag(etag)},
+    )
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat token identities.
+
+Access tokens carry the user's ID, username, and token version as claims,
+so protected endpoints know who's asking without loading the user.
+Revoking a user's tokens increments their token version, and tokens with an
+older one are refused.
+
+The current token versions are cached for ``[apiserver] identity_cache_ttl``
+seconds, so each process looks a user up at most that often.
+Revocations are seen at once by the process making them, and by the others
+once their cached version expires.
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+import uuid
+
+import sqlalchemy
+
+import hapcat.replicas
+
+from hapcat.application import (
+    app,
+    db,
+)
+
+from hapcat.models import User
+
+
+class Identity(object):
+    """A user, as known from their token.
+
+    :ivar uuid.UUID id: The user's UUID.
+
+    :ivar str username: The user's username.
+
+    :ivar int token_version: The version of the user's token.
+    """
+
+    def __init__(self, id, username, token_version):
+        self.id = id
+        self.username = username
+        self.token_version = token_version
+
+
+def current_version(session, user_id):
+    """Get a user's current token version from the database.
+
+    This reads the primary, since a lagging replica's version would be
+    cached.
+
+    :returns: The token version, or ``None`` if there's no such user.
+    """
+
+    user = User.__table__
+
+    return session.execute(
+        hapcat.replicas.on_primary(
+            sqlalchemy.select([user.c.token_version]).where(
+                user.c.id == user_id
+            )
+        )
+    ).scalar()
+
+
+class TokenVersions(object):
+    """A cache of users' current token versions.
+
+    Users who don't exist are cached too, as ``None``, so tokens of deleted
+    users are refused without looking them up every time.
+
+    Each process has its own cache, which is reset if it's forked.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        """Reset the cache for the current process.
+        """
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def get(self, session, user_id):
+        """Get a user's current token version.
+
+        :returns: The token version, or ``None`` if there's no such user.
+        """
+
+        if self._pid != os.getpid():
+            self._reset()
+
+        now = time.time()
+
+        with self._lock:
+            cached = self._versions.get(user_id)
+
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        version = current_version(session, user_id)
+        self.set(user_id, version, now, fetched=True)
+
+        return version
+
+    def set(self, user_id, version, now=None, fetched=False):
+        """Cache a user's current token version.
+
+        :param bool fetched: Whether the version was read before now, in
+            which case it's dropped if a newer one was cached meanwhile, such
+            as by a revocation.
+        """
+
+        if now is None:
+            now = time.time()
+
+        expires = now + app.iniconfig.getfloat(
+            'apiserver',
+            'identity_cache_ttl',
+        )
+        size = app.iniconfig.getint('apiserver', 'identity_cache_size')
+
+        with self._lock:
+            cached = self._versions.get(user_id)
+
+            # Token versions only go up, and a user who's gone stays gone.
+            if fetched and cached is not None and version is not None and (
+                    cached[0] is None or cached[0] > version
+                ):
+                return
+
+            if user_id not in self._versions and len(self._versions) >= size:
+                # Make room, dropping everyone if nothing has expired.
+                self._versions = {
+                    key: value
+                    for key, value in self._versions.items()
+                    if value[1] > now
+                }
+
+                if len(self._versions) >= size:
+                    self._versions = {}
+
+            self._versions[user_id] = (version, expires)
+
+    def clear(self):
+        """Forget every cached token version.
+        """
+
+        with self._lock:
+            self._versions = {}
+
+
+versions = TokenVersions()
+
+
+def from_payload(payload):
+    """Get the identity of an access token's payload.
+
+    Tokens from before the username and token version claims are taken to
+    be version 0, so revoking a user's tokens revokes those too.
+
+    :returns: The :class:`Identity`, or ``None`` if the user is gone or the
+        token was revoked.
+    """
+
+    try:
+        user_id = uuid.UUID(payload['identity'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    token_version = payload.get('version', 0)
+
+    if versions.get(db.session, user_id) != token_version:
+        return None
+
+    username = payload.get('username')
+
+    if username is None:
+        username = db.session.query(
+            User.username
+        ).filter(
+            User.id == user_id
+        ).scalar()
+
+    return Identity(user_id, username, token_version)
+
+
+def revoke(session, user_id):
+    """Revoke every token of a user, committing the session.
+
+    :returns: The user's new token version, or ``None`` if there's no such
+        user.
+    """
+
+    user = User.__table__
+
+    session.execute(
+        user.update().where(
+            user.c.id == user_id
+        ).values(
+            token_version=user.c.token_version + 1,
+        )
+    )
+
+    version = current_version(session, user_id)
+    session.commit()
+
+    versions.set(user_id, version)
+
+    return version
@@ -0,0 +1,85 @@
+"""Add votable search index
+
+Revision ID: 5a0d6e2c8b14
+Revises: d83a6f0e41c9
+Create Date: 2026-10-18 14:02:37.508114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import hapcat.types
+import sqlalchemy_utils.types
+
+
+# revision identifiers, used by Alembic.
+revision = '5a0d6e2c8b14'
+down_revision = 'd83a6f0e41c9'
+branch_labels = None
+depends_on = None
+
+
+# The index table depends on the database, so it isn't autogenerated.
+# This is a copy of hapcat.models.votable_search_ddl as of this revision.
+ddl = {
+    'sqlite': [
+        'CREATE VIRTUAL TABLE votable_search USING fts5('
+        'votable_id UNINDEXED, name, address, tags)',
+    ],
+    'postgresql': [
+        'CREATE TABLE votable_search ('
+        'votable_id UUID NOT NULL, '
+        'document TSVECTOR NOT NULL, '
+        'CONSTRAINT "pk-votable_search" PRIMARY KEY (votable_id), '
+        'CONSTRAINT "fk-votable_search-votable_id-votable-id" '
+        'FOREIGN KEY(votable_id) REFERENCES votable (id) ON DELETE CASCADE)',
+        'CREATE INDEX "ix-votable_search-document" '
+        'ON votable_search USING gin (document)',
+    ],
+}
+
+# Index the existing votables' names, addresses, and tag names, as
+# hapcat.search.reindex did as of this revision.
+backfill = {
+    'sqlite':
+        'INSERT INTO votable_search (votable_id, name, address, tags) '
+        'SELECT votable.id, votable.name, '
+        "coalesce(rawlocation.address, ''), "
+        "coalesce((SELECT group_concat(tag.name, ' ') "
+        'FROM votable_tag JOIN tag ON tag.id = votable_tag.tag_id '
+        "WHERE votable_tag.votable_id = votable.id), '') "
+        'FROM votable '
+        'LEFT OUTER JOIN location ON location.id = votable.id '
+        'LEFT OUTER JOIN event ON event.id = votable.id '
+        'LEFT OUTER JOIN rawlocation ON rawlocation.id = '
+        'coalesce(location.rawlocation_id, event.rawlocation_id)',
+    'postgresql':
+        'INSERT INTO votable_search (votable_id, document) '
+        'SELECT votable.id, '
+        "setweight(to_tsvector('simple', votable.name), 'A') || "
+        "setweight(to_tsvector('simple', "
+        "coalesce(rawlocation.address, '')), 'B') || "
+        "setweight(to_tsvector('simple', "
+        "coalesce((SELECT string_agg(tag.name, ' ' ORDER BY tag.name) "
+        'FROM votable_tag JOIN tag ON tag.id = votable_tag.tag_id '
+        "WHERE votable_tag.votable_id = votable.id), '')), 'C') "
+        'FROM votable '
+        'LEFT OUTER JOIN location ON location.id = votable.id '
+        'LEFT OUTER JOIN event ON event.id = votable.id '
+        'LEFT OUTER JOIN rawlocation ON rawlocation.id = '
+        'coalesce(location.rawlocation_id, event.rawlocation_id)',
+}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    for statement in ddl.get(dialect, []):
+        op.execute(statement)
+
+    if dialect in backfill:
+        op.execute(backfill[dialect])
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ddl:
+        op.execute('DROP TABLE votable_search')
@@ -13,12 +13,18 @@ from sqlalchemy_utils.types import (
     UUIDType,
 )
 
-from hapcat import (
+from sqlalchemy_utils.types.password import Password
+
+from hapcat.application import (
     app,
     db,
 )
 
-from zxcvbn import zxcvbn
+import hapcat.geo
+import hapcat.hashing
+import hapcat.strength
+
+import passlib.hash
 
 import sqlalchemy.ext.associationproxy
 db.association_proxy = sqlalchemy.ext.associationproxy.association_proxy
@@ -27,6 +33,11 @@ import sqlalchemy.ext.hybrid
 db.hybrid_property = sqlalchemy.ext.hybrid.hybrid_property
 db.hybrid_method = sqlalchemy.ext.hybrid.hybrid_method
 
+import sqlalchemy.event
+import sqlalchemy.orm.attributes
+
+import time
+
 # Set the constraint naming conventions.
 
 db.Model.metadata.naming_convention = {
@@ -45,12 +56,45 @@ class UUIDObject(db.Model):
     id = db.Column(UUIDType, primary_key=True)
     type = db.Column(db.String(32))
 
+    # Incremented whenever the object is updated, for ETags.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default='1',
+    )
+
     __mapper_args__ = {
         'polymorphic_identity': 'uuidobject',
-        'polymorphic_on': type
+        'polymorphic_on': type,
     }
 
 
+def bump_version(obj):
+    """Increment an object's version when it's next flushed.
+
+    This is done in SQL, rather than by the ORM's version counter, so
+    concurrent updates of an object both bump it, instead of the later one
+    failing.
+    """
+
+    state = sqlalchemy.inspect(obj)
+
+    # A new object starts at the column's default.
+    if state.persistent and not state.attrs.version.history.has_changes():
+        obj.version = UUIDObject.version + 1
+
+
+@sqlalchemy.event.listens_for(UUIDObject, 'before_update', propagate=True)
+def _bump_updated_version(mapper, connection, target):
+    """Bump the version of every object whose columns are being updated.
+    """
+
+    session = sqlalchemy.orm.object_session(target)
+
+    if session.is_modified(target, include_collections=False):
+        bump_version(target)
+
+
 class Tag(UUIDObject):
     __tablename__ = 'tag'
 
@@ -90,14 +134,41 @@ class RawLocation(UUIDObject):
         index=True,
     )
 
+    latitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    longitude = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    # The geohash of the coordinates, for finding nearby locations.
+    geohash = db.Column(
+        db.String(12),
+        nullable=True,
+        index=True,
+    )
+
     __mapper_args__ = {
         'polymorphic_identity': 'rawlocation',
     }
 
+    def set_coordinates(self, latitude, longitude):
+        """Set the coordinates of the location, along with its geohash.
+        """
+
+        self.latitude = latitude
+        self.longitude = longitude
+        self.geohash = hapcat.geo.encode(latitude, longitude)
+
     def serialize(self):
         return {
             'id': self.id,
             'address': self.address,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
             'ephemeral': True,
             'type': 'rawlocation',
         }
@@ -133,6 +204,22 @@ class Votable(UUIDObject):
         'polymorphic_identity': 'votable',
     }
 
+    @classmethod
+    def serialize_options(cls):
+        """Get the query options to eagerly load what serialize() uses.
+
+        This loads the tags, photos, and raw location of a query's votables
+        in a fixed number of queries, rather than several per votable.
+        """
+
+        return (
+            db.selectinload(cls.votable_tags).joinedload(VotableTag.tag),
+            db.selectinload(cls.votable_photos).joinedload(
+                VotablePhoto.photo
+            ),
+            db.joinedload(cls.rawlocation),
+        )
+
 
 class Location(Votable):
     __tablename__ = 'location'
@@ -147,6 +234,7 @@ class Location(Votable):
         UUIDType,
         db.ForeignKey('rawlocation.id', ondelete='cascade'),
         nullable=False,
+        index=True,
     )
 
     rawlocation = db.relationship(
@@ -161,6 +249,8 @@ class Location(Votable):
         return {
             'id': self.id,
             'address': self.rawlocation.address,
+            'latitude': self.rawlocation.latitude,
+            'longitude': self.rawlocation.longitude,
             'name': self.name,
             'ephemeral': False,
             'tags': [tag.id for tag in self.tags],
@@ -191,6 +281,15 @@ class VotableTag(db.Model):
 
     tag = db.relationship(Tag)
 
+    __table_args__ = (
+        # For finding the votables with a tag.
+        db.Index(
+            'ix-votable_tag-tag_id-votable_id',
+            'tag_id',
+            'votable_id',
+        ),
+    )
+
 
 class Event(Votable):
     __tablename__ = 'event'
@@ -205,6 +304,7 @@ class Event(Votable):
         UUIDType,
         db.ForeignKey('rawlocation.id', ondelete='cascade'),
         nullable=False,
+        index=True,
     )
 
     rawlocation = db.relationship(
@@ -321,11 +421,20 @@ class User(UUIDObject):
             ],
             default='argon2',
             deprecated=['auto'],
+            onload=hapcat.hashing.password_context,
         ),
         nullable=False,
         unique=False,
     )
 
+    # Put in the user's tokens, and incremented to revoke them.
+    token_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     votes = db.association_proxy(
         'user_votes',
         'vote',
@@ -336,6 +445,21 @@ class User(UUIDObject):
         'polymorphic_identity': 'user'
     }
 
+    @classmethod
+    def hash_password(cls, password):
+        """Hash a password with the configured argon2 settings.
+
+        Assigning the result to a user's password stores it as-is, rather
+        than hashing it again when it's flushed.
+        """
+
+        context = cls.__table__.c.password.type.context
+        hasher = passlib.hash.argon2.using(
+            **hapcat.hashing.argon2_settings()
+        )
+
+        return Password(hasher.hash(password).encode('utf8'), context)
+
     @staticmethod
     def checkpwstrength(
         password,
@@ -344,14 +468,16 @@ class User(UUIDObject):
         minscore=3,
     ):
         """Check the user's password strength.
-        """
 
-        results = zxcvbn(password, user_inputs=[username, email])
+        :raises hapcat.strength.StrengthCheckTimeout: The check took too
+            long.
+        """
 
-        if results['score'] >= minscore:
-            return (True, results['feedback'])
-        else:
-            return (False, results['feedback'])
+        return hapcat.strength.checker.check(
+            password,
+            [username, email],
+            minscore=minscore,
+        )
 
 
 class Vote(db.Model):
@@ -375,6 +501,15 @@ class Vote(db.Model):
         nullable=False,
     )
 
+    # When votes were last added, in seconds since the epoch, so
+    # hapcat.recommend can update only the users who voted since its last run.
+    updated = db.Column(
+        db.Float,
+        default=time.time,
+        onupdate=time.time,
+        index=True,
+    )
+
     votable = db.relationship(
         Votable,
     )
@@ -384,6 +519,147 @@ class Vote(db.Model):
         backref=db.backref('user_votes', cascade='all, delete-orphan'),
     )
 
+    __table_args__ = (
+        # For reading all of a user's votes.
+        db.Index(
+            'ix-vote-user_id-votable_id',
+            'user_id',
+            'votable_id',
+        ),
+    )
+
+
+class Recommendation(db.Model):
+    """An event or location recommended for a user by hapcat.recommend.
+    """
+
+    __tablename__ = 'recommendation'
+
+    user_id = db.Column(
+        UUIDType,
+        db.ForeignKey('user.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # The position of the recommendation, best first.
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    votable_id = db.Column(
+        UUIDType,
+        db.ForeignKey('votable.id', ondelete='cascade'),
+        nullable=False,
+        index=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+
+class RecommendationFactors(db.Model):
+    """An event or location's factors of the votes, from the last time
+    hapcat.recommend found them.
+    """
+
+    __tablename__ = 'recommendation_factors'
+
+    votable_id = db.Column(
+        UUIDType,
+        db.ForeignKey('votable.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # The factors, as little-endian doubles.
+    factors = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+
+class RecommendationRun(db.Model):
+    """A run of hapcat.recommend.
+    """
+
+    __tablename__ = 'recommendation_run'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # When the run started and finished, in seconds since the epoch.
+    # Runs which failed or are still going haven't finished.
+    started = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    finished = db.Column(
+        db.Float,
+    )
+
+    # Whether the run found the factors from all the votes, rather than only
+    # updating the users who voted since the run before.
+    full = db.Column(
+        db.Boolean(name='full'),
+        nullable=False,
+    )
+
+    # The number of factors asked for, which there are fewer of if there are
+    # fewer votables.
+    factors = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # The number of users recommended for.
+    users = db.Column(
+        db.Integer,
+    )
+
+
+# The full-text search index of votables, kept up to date by hapcat.search.
+# Its columns depend on the database, so it's created with DDL rather than as a
+# model.
+
+votable_search_ddl = {
+    'sqlite': [
+        'CREATE VIRTUAL TABLE votable_search USING fts5('
+        'votable_id UNINDEXED, name, address, tags)',
+    ],
+    'postgresql': [
+        'CREATE TABLE votable_search ('
+        'votable_id UUID NOT NULL, '
+        'document TSVECTOR NOT NULL, '
+        'CONSTRAINT "pk-votable_search" PRIMARY KEY (votable_id), '
+        'CONSTRAINT "fk-votable_search-votable_id-votable-id" '
+        'FOREIGN KEY(votable_id) REFERENCES votable (id) ON DELETE CASCADE)',
+        'CREATE INDEX "ix-votable_search-document" '
+        'ON votable_search USING gin (document)',
+    ],
+}
+
+for dialect, statements in votable_search_ddl.items():
+    for statement in statements:
+        sqlalchemy.event.listen(
+            db.metadata,
+            'after_create',
+            sqlalchemy.DDL(statement).execute_if(dialect=dialect),
+        )
+
+    sqlalchemy.event.listen(
+        db.metadata,
+        'before_drop',
+        sqlalchemy.DDL(
+            'DROP TABLE IF EXISTS votable_search'
+        ).execute_if(dialect=dialect),
+    )
+
 
 class Secret(db.Model):
     __tablename__ = 'secret'
@@ -397,3 +673,25 @@ class Secret(db.Model):
         db.LargeBinary,
         nullable=False,
     )
+
+
+def _touch_votable(votable, value, initiator):
+    """Bump a votable's version when its tags or photos change.
+    """
+
+    bump_version(votable)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Mapper, 'after_configured')
+def _listen_votable_collections():
+    """Listen for changes to the votable collections once they exist.
+    """
+
+    for collection in (Votable.votable_tags, Votable.votable_photos):
+        for event in ('append', 'remove'):
+            sqlalchemy.event.listen(
+                collection,
+                event,
+                _touch_votable,
+                propagate=True,
+            )
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat database connection pooling.
+
+The pool is configured by the ``[database]`` options ``pool_size``,
+``max_overflow``, ``pool_timeout``, ``pool_recycle``, and ``pool_pre_ping``,
+with SQLAlchemy's defaults for those left empty.
+
+Databases pooled in a queue, which is all of them but SQLite, unless a
+SQLite database file has a ``pool_size``, use :class:`TimedQueuePool`, which
+keeps statistics of how long getting a connection takes.
+"""
+
+from __future__ import absolute_import, division
+
+import os
+import threading
+import time
+
+import sqlalchemy.engine.url
+import sqlalchemy.exc
+import sqlalchemy.pool
+
+# The options only queued pools take.
+QUEUE_OPTIONS = ['pool_size', 'max_overflow', 'pool_timeout']
+
+
+def engine_options(config, dburl=None):
+    """Get the SQLAlchemy engine options from the configuration.
+
+    :param config: The hapcat configuration.
+
+    :param str dburl: The URL of the database, if it isn't ``[database]
+        dburl``, such as a replica's.
+
+    :returns: A dictionary of the keyword arguments for
+        :func:`sqlalchemy.create_engine`.
+    """
+
+    if dburl is None:
+        dburl = config.get('database', 'dburl')
+
+    url = sqlalchemy.engine.url.make_url(dburl)
+    options = {}
+
+    for name, get in [
+            ('pool_size', config.getint),
+            ('max_overflow', config.getint),
+            ('pool_timeout', config.getfloat),
+            ('pool_recycle', config.getint),
+        ]:
+        if config.get('database', name):
+            options[name] = get('database', name)
+
+    if config.getboolean('database', 'pool_pre_ping'):
+        options['pool_pre_ping'] = True
+
+    sqlite = url.drivername.startswith('sqlite')
+
+    if sqlite and url.database in (None, '', ':memory:'):
+        # An in-memory database has a single connection, which is kept.
+        queued = False
+    else:
+        # Flask-SQLAlchemy opens a new connection every time for SQLite
+        # database files, unless they're given a pool size.
+        queued = not sqlite or 'pool_size' in options
+
+    if queued:
+        options['poolclass'] = TimedQueuePool
+
+        if sqlite:
+            # The pooled connections are used by whichever thread gets them.
+            options['connect_args'] = {'check_same_thread': False}
+    else:
+        for name in QUEUE_OPTIONS:
+            options.pop(name, None)
+
+    return options
+
+
+class PoolStats(object):
+    """Statistics of how long getting connections from a pool takes.
+
+    Each process has its own statistics, which are reset if it's forked.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        """Reset the statistics for the current process.
+        """
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait, timedout=False):
+        """Record getting a connection.
+
+        :param float wait: How long it took, in seconds.
+
+        :param bool timedout: Whether it gave up, instead of getting one.
+        """
+
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._lock:
+            if timedout:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+                self.total_wait += wait
+
+            self.max_wait = max(self.max_wait, wait)
+
+    def average_wait(self):
+        """Get the average time getting a connection took, in seconds.
+        """
+
+        if self._pid != os.getpid() or not self.checkouts:
+            return 0.0
+
+        return self.total_wait / self.checkouts
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """A queued connection pool timing how long getting a connection takes.
+
+    :ivar PoolStats stats: The statistics, which are kept when the pool is
+        recreated.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        began = time.time()
+
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            self.stats.record(time.time() - began, timedout=True)
+            raise
+
+        self.stats.record(time.time() - began)
+
+        return connection
+
+    def recreate(self):
+        pool = super(TimedQueuePool, self).recreate()
+        pool.stats = self.stats
+
+        return pool
+
+
+def describe(pool):
+    """Describe the state of a pool in this process.
+
+    Only :class:`TimedQueuePool` pools have statistics, and the others'
+    are ``None``.
+
+    :returns: A dictionary of the pool's class name, ``size``, the number of
+        connections ``checked_in`` and ``checked_out``, the ``overflow``
+        connections past its size, the number of ``checkouts`` and
+        ``timeouts``, and the ``average_wait`` and ``max_wait`` for a
+        connection in seconds.
+    """
+
+    description = {
+        'pool': type(pool).__name__,
+        'size': None,
+        'checked_in': None,
+        'checked_out': None,
+        'overflow': None,
+        'checkouts': None,
+        'timeouts': None,
+        'average_wait': None,
+        'max_wait': None,
+    }
+
+    if isinstance(pool, sqlalchemy.pool.QueuePool):
+        description.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            # This counts down from zero while the pool fills.
+            overflow=max(pool.overflow(), 0),
+        )
+
+    if isinstance(pool, TimedQueuePool):
+        stats = pool.stats
+
+        if stats._pid != os.getpid():
+            stats._reset()
+
+        description.update(
+            checkouts=stats.checkouts,
+            timeouts=stats.timeouts,
+            average_wait=stats.average_wait(),
+            max_wait=stats.max_wait,
+        )
+
+    return description
@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat collaborative filtering recommendations.
+
+The recommendations come from a truncated SVD of the matrix of votes by user
+and votable: each user's votes are projected onto the top right singular
+vectors, so the votables which people who voted like them voted for score
+highly.
+
+The singular vectors are found by randomized subspace iteration on the
+votable by votable Gram matrix, which is multiplied out one batch of users
+at a time, streaming the votes.
+Memory use depends on the number of votables and factors and the size of
+the batches, but not on the number of users or votes.
+
+The recommendations are written to the ``recommendation`` table a batch of
+users at a time, replacing each user's previous ones in the same
+transaction, so the personalized suggestions keep working while this runs.
+
+The factors are kept in the ``recommendation_factors`` table, so most runs
+are incremental: they only read the votes of the users who voted since the
+run before, which ``vote.updated`` marks, and project them onto the stored
+factors.
+New votes shift the factors a little too, so every so often they're found
+from all the votes again and everyone's recommendations are rewritten.
+Votables added in between aren't recommended until then.
+Each run is recorded in the ``recommendation_run`` table.
+"""
+
+from __future__ import absolute_import, division
+
+import time
+
+import numpy
+import sqlalchemy
+
+from hapcat.application import app
+
+from hapcat.models import RecommendationRun
+
+# The tables read and written, without column types, so the UUIDs are passed
+# around as the database's own values rather than converted for every vote.
+
+_votable = sqlalchemy.table(
+    'votable',
+    sqlalchemy.column('id'),
+)
+
+_vote = sqlalchemy.table(
+    'vote',
+    sqlalchemy.column('votable_id'),
+    sqlalchemy.column('user_id'),
+    sqlalchemy.column('numvotes'),
+    sqlalchemy.column('updated'),
+)
+
+_recommendation = sqlalchemy.table(
+    'recommendation',
+    sqlalchemy.column('user_id'),
+    sqlalchemy.column('rank'),
+    sqlalchemy.column('votable_id'),
+    sqlalchemy.column('score'),
+)
+
+_recommendation_factors = sqlalchemy.table(
+    'recommendation_factors',
+    sqlalchemy.column('votable_id'),
+    sqlalchemy.column('factors'),
+)
+
+# The extra random vectors to find the singular vectors more accurately.
+OVERSAMPLE = 10
+
+# The fraction of a user's best score which is too small to recommend.
+NEGLIGIBLE = 1e-6
+
+# The most user and votable scores to hold at once.
+SCORE_CELLS = 1 << 22
+
+# The seconds before the last run started to look for new votes from, since
+# the votes are timed by the API servers' clocks, and may be committed after
+# the run started reading them.
+VOTE_MARGIN = 300
+
+
+class VoteBatch(object):
+    """The votes of a batch of users, as a sparse matrix.
+
+    :ivar list users: The users' IDs, in row order.
+
+    :ivar rows: The row of each vote.
+
+    :ivar columns: The votable column of each vote.
+
+    :ivar values: The weight of each vote.
+    """
+
+    def __init__(self, users, rows, columns, values):
+        self.users = users
+        self.rows = rows
+        self.columns = columns
+        self.values = values
+
+    def project(self, basis):
+        """Multiply the batch of the vote matrix by a basis.
+
+        :param basis: A votable by vector array.
+
+        :returns: A user by vector array.
+        """
+
+        weighted = self.values[:, None] * basis[self.columns]
+
+        return numpy.stack(
+            [
+                numpy.bincount(
+                    self.rows,
+                    weights=weighted[:, i],
+                    minlength=len(self.users),
+                )
+                for i in range(basis.shape[1])
+            ],
+            axis=1,
+        )
+
+    def gram_product(self, basis, numvotables):
+        """Multiply the batch's part of the Gram matrix by a basis.
+
+        :param basis: A votable by vector array.
+
+        :returns: A votable by vector array.
+        """
+
+        weighted = self.values[:, None] * self.project(basis)[self.rows]
+
+        return numpy.stack(
+            [
+                numpy.bincount(
+                    self.columns,
+                    weights=weighted[:, i],
+                    minlength=numvotables,
+                )
+                for i in range(basis.shape[1])
+            ],
+            axis=1,
+        )
+
+
+def votable_columns(session):
+    """Number the votables, for the columns of the vote matrix.
+
+    :returns: A tuple of a list of the votable IDs, by column, and a dict of
+        their columns, by ID.
+    """
+
+    ids = [
+        votable_id
+        for (votable_id,) in session.execute(
+            sqlalchemy.select([_votable.c.id]).order_by(_votable.c.id)
+        )
+    ]
+
+    return ids, {votable_id: column for column, votable_id in enumerate(ids)}
+
+
+def stored_factors(session):
+    """Load the votable factors stored by the last full run.
+
+    :returns: A tuple of a list of the votable IDs, by row, a dict of their
+        rows, by ID, and a votable by factor array.
+    """
+
+    factors = _recommendation_factors
+
+    ids = []
+    vectors = []
+
+    for votable_id, data in session.execute(
+            sqlalchemy.select([
+                factors.c.votable_id,
+                factors.c.factors,
+            ]).order_by(factors.c.votable_id)):
+        ids.append(votable_id)
+        vectors.append(numpy.frombuffer(bytes(data), dtype='<f8'))
+
+    if not ids:
+        return [], {}, numpy.zeros((0, 0))
+
+    return (
+        ids,
+        {votable_id: row for row, votable_id in enumerate(ids)},
+        numpy.stack(vectors),
+    )
+
+
+def store_factors(session, ids, vectors, batch=1000):
+    """Replace the stored votable factors.
+
+    This commits.
+
+    :param list ids: The votable IDs, by row.
+
+    :param vectors: A votable by factor array.
+
+    :param int batch: The number of votables to insert at a time.
+    """
+
+    factors = _recommendation_factors
+
+    session.execute(factors.delete())
+
+    for start in range(0, len(ids), batch):
+        session.execute(
+            factors.insert(),
+            [
+                {
+                    'votable_id': votable_id,
+                    'factors': vector.astype('<f8').tobytes(),
+                }
+                for votable_id, vector in zip(
+                    ids[start:start + batch],
+                    vectors[start:start + batch],
+                )
+            ],
+        )
+
+    session.commit()
+
+
+def vote_batches(session, columns, batch=1000, since=None):
+    """Stream the votes a batch of users at a time.
+
+    Each vote is weighted by the logarithm of its count, so users who vote
+    for something many times don't swamp everyone else.
+
+    :param dict columns: The columns of the votables, by ID.
+
+    :param int batch: The number of users in each batch.
+
+    :param float since: If given, only read the votes of users who voted
+        at or after this time, in seconds since the epoch.
+
+    :returns: An iterator of :class:`VoteBatch`.
+    """
+
+    vote = _vote
+    last = None
+
+    while True:
+        query = sqlalchemy.select([
+            vote.c.user_id,
+        ]).distinct().order_by(
+            vote.c.user_id
+        ).limit(batch)
+
+        if last is not None:
+            query = query.where(vote.c.user_id > last)
+
+        if since is not None:
+            query = query.where(vote.c.updated >= since)
+
+        users = [user_id for (user_id,) in session.execute(query)]
+
+        if not users:
+            return
+
+        if since is None:
+            # Every user in the range is in the batch.
+            where = sqlalchemy.and_(
+                vote.c.user_id >= users[0],
+                vote.c.user_id <= users[-1],
+            )
+        else:
+            where = vote.c.user_id.in_(users)
+
+        rows = session.execute(
+            sqlalchemy.select([
+                vote.c.user_id,
+                vote.c.votable_id,
+                vote.c.numvotes,
+            ]).where(where)
+        ).fetchall()
+
+        userrows = {user_id: row for row, user_id in enumerate(users)}
+        voterows = []
+        votecolumns = []
+        values = []
+
+        for user_id, votable_id, numvotes in rows:
+            column = columns.get(votable_id)
+
+            if column is None or numvotes <= 0:
+                continue
+
+            voterows.append(userrows[user_id])
+            votecolumns.append(column)
+            values.append(numvotes)
+
+        yield VoteBatch(
+            users,
+            numpy.array(voterows, dtype=numpy.int64),
+            numpy.array(votecolumns, dtype=numpy.int64),
+            numpy.log1p(numpy.array(values, dtype=numpy.float64)),
+        )
+
+        last = users[-1]
+
+
+def votable_factors(
+        session,
+        columns,
+        factors=32,
+        iterations=4,
+        batch=1000,
+        seed=0,
+    ):
+    """Find the top right singular vectors of the vote matrix.
+
+    Each iteration reads every vote once, and finding the vectors from the
+    last iteration's subspace reads them once more.
+
+    :param dict columns: The columns of the votables, by ID.
+
+    :param int factors: The number of singular vectors to find.
+
+    :param int iterations: The number of subspace iterations.
+        More are slower, but more accurate.
+
+    :param int batch: The number of users to read at a time.
+
+    :param int seed: The seed of the random starting subspace.
+
+    :returns: A votable by factor array of the singular vectors, by singular
+        value, largest first.
+    """
+
+    numvotables = len(columns)
+    width = min(numvotables, factors + OVERSAMPLE)
+
+    rng = numpy.random.RandomState(seed)
+    basis, r = numpy.linalg.qr(rng.standard_normal((numvotables, width)))
+
+    for i in range(iterations):
+        product = numpy.zeros((numvotables, width))
+
+        for votes in vote_batches(session, columns, batch):
+            product += votes.gram_product(basis, numvotables)
+
+        basis, r = numpy.linalg.qr(product)
+
+    # Find the singular vectors within the subspace.
+    small = numpy.zeros((width, width))
+
+    for votes in vote_batches(session, columns, batch):
+        projected = votes.project(basis)
+        small += projected.T.dot(projected)
+
+    values, vectors = numpy.linalg.eigh(small)
+    order = numpy.argsort(values)[::-1][:factors]
+
+    return basis.dot(vectors[:, order])
+
+
+def top_votables(scores, count, least=0):
+    """Get the best scoring votables, best first.
+
+    :param scores: The score of each votable, by column.
+
+    :param int count: The most votables to get.
+
+    :param float least: The score votables have to beat to be included.
+
+    :returns: An array of the votables' columns.
+    """
+
+    if count < len(scores):
+        top = numpy.argpartition(-scores, count - 1)[:count]
+    else:
+        top = numpy.arange(len(scores))
+
+    top = top[numpy.argsort(-scores[top], kind='stable')]
+
+    return top[scores[top] > least]
+
+
+def last_runs(session):
+    """Get the last run to finish, and the last full run to start.
+
+    :returns: A tuple of two :class:`hapcat.models.RecommendationRun`, either
+        of which may be ``None``.
+    """
+
+    runs = session.query(RecommendationRun).order_by(
+        RecommendationRun.id.desc()
+    )
+
+    last = runs.filter(RecommendationRun.finished.isnot(None)).first()
+    rebuilt = runs.filter(RecommendationRun.full).first()
+
+    return last, rebuilt
+
+
+def write_recommendations(session, votes, ids, vectors, count=100):
+    """Replace a batch of users' recommendations.
+
+    This commits.
+
+    :param VoteBatch votes: The users' votes.
+
+    :param list ids: The votable IDs, by row of ``vectors``.
+
+    :param vectors: A votable by factor array.
+
+    :param int count: The most recommendations for each user.
+    """
+
+    recommendation = _recommendation
+
+    projected = votes.project(vectors)
+    rows = []
+
+    # Score a block of users at a time, to bound the memory used.
+    block = max(1, SCORE_CELLS // len(ids))
+
+    for start in range(0, len(votes.users), block):
+        scores = projected[start:start + block].dot(vectors.T)
+
+        # Scores next to nothing compared to the best, which is usually
+        # something already voted for, are just rounding errors.
+        least = scores.max(axis=1) * NEGLIGIBLE
+
+        voted = (votes.rows >= start) & (votes.rows < start + block)
+        scores[
+            votes.rows[voted] - start,
+            votes.columns[voted],
+        ] = -numpy.inf
+
+        for i, userscores in enumerate(scores):
+            user_id = votes.users[start + i]
+
+            rows.extend(
+                {
+                    'user_id': user_id,
+                    'rank': rank,
+                    'votable_id': ids[column],
+                    'score': float(userscores[column]),
+                }
+                for rank, column in enumerate(
+                    top_votables(userscores, count, max(least[i], 0))
+                )
+            )
+
+    session.execute(
+        recommendation.delete().where(
+            recommendation.c.user_id.in_(votes.users)
+        )
+    )
+
+    if rows:
+        session.execute(recommendation.insert(), rows)
+
+    session.commit()
+
+
+def recommend(
+        session,
+        factors=32,
+        iterations=4,
+        count=100,
+        batch=1000,
+        seed=0,
+        rebuild_interval=None,
+        full=False,
+    ):
+    """Recommend events and locations to the users who voted since the last
+    run.
+
+    The factors are found from all the votes, and everyone's recommendations
+    rewritten, if ``full`` is set, if they were last found over
+    ``rebuild_interval`` seconds ago or with a different number of factors,
+    or if that last full run didn't finish.
+    Otherwise the stored factors are used, and only the users who voted since
+    :data:`VOTE_MARGIN` seconds before the last run started are updated.
+    Each batch of users' recommendations is committed separately.
+    Votables a user has already voted for aren't recommended to them.
+
+    :param session: The database session.
+
+    :param int factors: The number of singular vectors to use.
+
+    :param int iterations: The number of subspace iterations.
+
+    :param int count: The most recommendations for each user.
+
+    :param int batch: The number of users to read at a time.
+
+    :param int seed: The seed of the random starting subspace.
+
+    :param float rebuild_interval: The most seconds to keep using the same
+        factors for, or ``None`` to keep them until the number changes.
+
+    :param bool full: Whether to find the factors again regardless.
+
+    :returns: The number of users recommended for.
+    """
+
+    started = time.time()
+    last, rebuilt = last_runs(session)
+
+    full = (
+        full
+        or rebuilt is None
+        or rebuilt.finished is None
+        or rebuilt.factors != factors
+        or (
+            rebuild_interval is not None
+            and started - rebuilt.started >= rebuild_interval
+        )
+    )
+
+    if full:
+        since = None
+    else:
+        since = last.started - VOTE_MARGIN
+        ids, columns, vectors = stored_factors(session)
+
+    run = RecommendationRun(started=started, full=full, factors=factors)
+    session.add(run)
+    session.commit()
+
+    if full:
+        ids, columns = votable_columns(session)
+
+        app.logger.info(
+            'Finding %d factors of the votes for %d votables',
+            factors,
+            len(ids),
+        )
+
+        if ids:
+            vectors = votable_factors(
+                session,
+                columns,
+                factors=factors,
+                iterations=iterations,
+                batch=batch,
+                seed=seed,
+            )
+        else:
+            vectors = numpy.zeros((0, 0))
+
+        store_factors(session, ids, vectors, batch)
+    else:
+        app.logger.info(
+            'Updating the users who voted since %s, with the factors of %d '
+            'votables',
+            time.ctime(since),
+            len(ids),
+        )
+
+    numusers = 0
+
+    if ids:
+        for votes in vote_batches(session, columns, batch, since):
+            write_recommendations(session, votes, ids, vectors, count)
+            numusers += len(votes.users)
+
+    # Forget the recommendations of anyone who has no votes left.
+    recommendation = _recommendation
+    vote = _vote
+
+    session.execute(
+        recommendation.delete().where(
+            ~recommendation.c.user_id.in_(
+                sqlalchemy.select([vote.c.user_id]).distinct()
+            )
+        )
+    )
+
+    run.finished = time.time()
+    run.users = numusers
+    session.commit()
+
+    app.logger.info('Recommended for %d users', numusers)
+
+    return numusers
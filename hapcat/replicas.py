@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat read replicas.
+
+If ``[database] replica_urls`` lists replica databases, requests to the
+endpoints marked with :func:`read_only` read from them, taking turns, while
+everything else, and anything written or flushed, uses the primary.
+
+A replica is checked before it's used, at most every ``[database]
+replica_check_interval`` seconds, and skipped for that long if the check
+fails or it disconnects.
+If every replica is down, the primary is read instead.
+
+Replicas may lag behind the primary, so a request which commits sets a
+cookie which keeps its client's reads on the primary for ``[database]
+primary_stickiness`` seconds, so it sees its own changes.
+If the request was authenticated, the process also keeps that user's reads
+on the primary for as long, for clients which don't keep cookies.
+Statements marked with :func:`on_primary`, and everything read inside
+:func:`primary`, always read the primary.
+This is used for whatever each process caches for every client, which would
+otherwise stay as stale as the replica it was built from until it expired,
+even for the clients whose reads stick to the primary.
+"""
+
+from __future__ import absolute_import
+
+import contextlib
+import functools
+import os
+import re
+import threading
+import time
+
+import flask
+import flask_sqlalchemy
+import sqlalchemy
+import sqlalchemy.orm
+import sqlalchemy.sql.expression
+
+import hapcat.pool
+
+# The cookie keeping a client's reads on the primary.
+COOKIE = 'hapcat_primary'
+
+# The execution option of statements which always read the primary.
+PRIMARY_OPTION = 'hapcat_primary'
+
+# How deep each thread is in primary() blocks.
+_local = threading.local()
+
+
+def read_only(view):
+    """Mark an endpoint as only reading from the database, so it can read
+    from a replica.
+
+    This goes under the ``route`` decorator and over any others, such as
+    ``jwt_required``, so they can read from a replica too.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        flask.request.environ['hapcat.read_only'] = True
+
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def on_primary(statement):
+    """Mark a statement to read from the primary, even in a read-only
+    request, for reads which mustn't lag behind.
+
+    :returns: The marked statement.
+    """
+
+    return statement.execution_options(**{PRIMARY_OPTION: True})
+
+
+@contextlib.contextmanager
+def primary():
+    """Read from the primary inside the block, even in a read-only request.
+
+    This is for building what's shared by every request in the process,
+    which mustn't lag behind.
+    """
+
+    depth = getattr(_local, 'primary', 0)
+    _local.primary = depth + 1
+
+    try:
+        yield
+    finally:
+        _local.primary = depth
+
+
+def _request_user_id():
+    """Get the ID of the user the current request is authenticated as.
+
+    :returns: The user's UUID, or ``None`` if it isn't authenticated yet.
+    """
+
+    identity = getattr(flask._request_ctx_stack.top, 'current_identity', None)
+
+    return getattr(identity, 'id', None)
+
+
+class Replica(object):
+    """A replica database.
+
+    :ivar engine: The replica's engine.
+
+    :ivar float checked: When it was last checked.
+
+    :ivar float down_until: When to try it again after a failure.
+    """
+
+    def __init__(self, engine, interval):
+        self.engine = engine
+        self.interval = interval
+        self.checked = None
+        self.down_until = 0
+
+        sqlalchemy.event.listen(engine, 'handle_error', self._handle_error)
+
+    def _handle_error(self, context):
+        """Skip the replica for a while if it disconnects.
+        """
+
+        if context.is_disconnect:
+            self.down(time.time())
+
+    def down(self, now):
+        """Skip the replica until the next check.
+        """
+
+        self.down_until = now + self.interval
+
+    def check(self, now):
+        """Check the replica is up.
+
+        :returns: Whether it's up.
+        """
+
+        self.checked = now
+
+        try:
+            with self.engine.connect() as connection:
+                connection.scalar(sqlalchemy.select([1]))
+        except sqlalchemy.exc.DBAPIError:
+            self.down(now)
+            return False
+
+        return True
+
+
+class Replicas(object):
+    """The replica databases, read from in turn.
+
+    The replicas are connected to the first time they're used, from the
+    configuration at that time.
+    This also tracks the users whose reads stick to the primary.
+    Each process has its own connections and users, which are reset if it's
+    forked.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        """Reset the replicas for the current process.
+        """
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._replicas = None
+        self._next = 0
+
+        # When each user's reads stop sticking to the primary, by UUID.
+        self._sticky = {}
+
+    def replicas(self, config):
+        """Get the replicas, connecting to them if needed.
+
+        :param config: The hapcat configuration.
+
+        :returns: A list of :class:`Replica`.
+        """
+
+        if self._pid != os.getpid():
+            # Leave the parent's connections alone.
+            self._reset()
+
+        with self._lock:
+            if self._replicas is None:
+                interval = config.getfloat(
+                    'database',
+                    'replica_check_interval',
+                )
+
+                self._replicas = [
+                    Replica(
+                        sqlalchemy.create_engine(
+                            url,
+                            **hapcat.pool.engine_options(config, url)
+                        ),
+                        interval,
+                    )
+                    for url in re.split(
+                        r'[\s,]+',
+                        config.get('database', 'replica_urls'),
+                    )
+                    if url
+                ]
+
+            return self._replicas
+
+    def choose(self, config):
+        """Choose the next replica which is up.
+
+        :param config: The hapcat configuration.
+
+        :returns: The replica's engine, or ``None`` if there are no
+            replicas, or they're all down.
+        """
+
+        replicas = self.replicas(config)
+
+        if not replicas:
+            return None
+
+        with self._lock:
+            first = self._next
+            self._next = (self._next + 1) % len(replicas)
+
+        now = time.time()
+
+        for i in range(len(replicas)):
+            replica = replicas[(first + i) % len(replicas)]
+
+            if replica.down_until > now:
+                continue
+
+            if (
+                    replica.checked is None or
+                    now - replica.checked >= replica.interval
+                ):
+                if not replica.check(now):
+                    continue
+
+            return replica.engine
+
+        return None
+
+    def stick(self, user_id, seconds):
+        """Keep a user's reads on the primary for a while.
+        """
+
+        if self._pid != os.getpid():
+            self._reset()
+
+        now = time.time()
+
+        with self._lock:
+            if user_id not in self._sticky:
+                # Forget the users who no longer stick.
+                self._sticky = {
+                    key: until
+                    for key, until in self._sticky.items()
+                    if until > now
+                }
+
+            self._sticky[user_id] = now + seconds
+
+    def sticky(self, user_id):
+        """Check whether a user's reads stick to the primary.
+        """
+
+        if self._pid != os.getpid():
+            return False
+
+        return self._sticky.get(user_id, 0) > time.time()
+
+    def close(self):
+        """Disconnect from the replicas, reconnecting on their next use.
+        """
+
+        with self._lock:
+            replicas = self._replicas
+            self._replicas = None
+
+        if replicas and self._pid == os.getpid():
+            for replica in replicas:
+                replica.engine.dispose()
+
+
+replicas = Replicas()
+
+
+def request_replica():
+    """Get the replica the current request reads from.
+
+    This is chosen the first time it's needed in each request, so a request
+    reads from a single replica.
+
+    :returns: The replica's engine, or ``None`` to use the primary.
+    """
+
+    if not flask.has_request_context():
+        return None
+
+    environ = flask.request.environ
+
+    if 'hapcat.replica' not in environ:
+        replica = None
+
+        if (
+                environ.get('hapcat.read_only') and
+                COOKIE not in flask.request.cookies and
+                not replicas.sticky(_request_user_id())
+            ):
+            replica = replicas.choose(flask.current_app.iniconfig)
+
+        environ['hapcat.replica'] = replica
+
+    return environ['hapcat.replica']
+
+
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+    """A session reading from a replica in read-only requests.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not isinstance(
+                clause,
+                sqlalchemy.sql.expression.UpdateBase,
+            ) and not (
+                # get_execution_options() is only in newer SQLAlchemy.
+                getattr(clause, '_execution_options', {}).get(PRIMARY_OPTION)
+            ) and not getattr(_local, 'primary', 0):
+            replica = request_replica()
+
+            if replica is not None:
+                return replica
+
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+@sqlalchemy.event.listens_for(RoutingSession, 'after_commit')
+def _note_commit(session):
+    """Note that the current request wrote to the primary.
+    """
+
+    if flask.has_request_context():
+        flask.request.environ['hapcat.wrote'] = True
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions reading from replicas in read-only
+    requests.
+    """
+
+    def create_session(self, options):
+        return sqlalchemy.orm.sessionmaker(
+            class_=RoutingSession,
+            db=self,
+            **options
+        )
+
+
+def stick_to_primary(response):
+    """Keep the client's reads on the primary for a while after it writes.
+
+    This is called after each request.
+    """
+
+    config = flask.current_app.iniconfig
+
+    if (
+            flask.request.environ.get('hapcat.wrote') and
+            config.get('database', 'replica_urls')
+        ):
+        stickiness = config.getint('database', 'primary_stickiness')
+
+        response.set_cookie(
+            COOKIE,
+            '1',
+            max_age=stickiness,
+            httponly=True,
+        )
+
+        user_id = _request_user_id()
+
+        if user_id is not None:
+            replicas.stick(user_id, stickiness)
+
+    return response
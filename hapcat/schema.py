@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat database schema upgrades at startup.
+
+Every server process imports hapcat, and so checks the schema is up to date.
+Rather than loading Alembic and its revision scripts each time, the
+database's revision is compared with :data:`HEAD_REVISION`, and Alembic is
+only loaded if they differ.
+The migrations then run under a lock shared by all the processes, so only
+the first to get it migrates, and the rest find the schema up to date.
+"""
+
+from __future__ import absolute_import
+
+import contextlib
+import os
+import os.path
+import tempfile
+
+import sqlalchemy
+import sqlalchemy.exc
+
+try:
+    import fcntl
+except ImportError:
+    # There's no preforking server on Windows to share the lock with.
+    fcntl = None
+
+from hapcat.application import app
+
+# The newest revision in hapcat/migrations/versions.
+# This has to be updated along with every new migration.
+HEAD_REVISION = '7c2e5a90d3f1'
+
+# The PostgreSQL advisory lock key for migrations, 'hapcatdb'.
+LOCK_KEY = 0x6861706361746462
+
+MODES = ('check', 'always', 'never')
+
+
+def current_revision(engine):
+    """Get the database's Alembic revision.
+
+    :returns: The revision, or ``None`` if the database was never migrated.
+    """
+
+    with engine.connect() as connection:
+        try:
+            return connection.execute(
+                sqlalchemy.text('SELECT version_num FROM alembic_version')
+            ).scalar()
+        except sqlalchemy.exc.DBAPIError:
+            return None
+
+
+@contextlib.contextmanager
+def migration_lock(engine):
+    """Hold the migration lock inside the block.
+
+    On PostgreSQL this is an advisory lock, and otherwise it's the file
+    ``[database] migration_lock``, or ``hapcat-migrations.lock`` in the
+    temporary directory if that's empty.
+    """
+
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as connection:
+            connection.execute(
+                sqlalchemy.text('SELECT pg_advisory_lock(:key)'),
+                key=LOCK_KEY,
+            )
+
+            try:
+                yield
+            finally:
+                connection.execute(
+                    sqlalchemy.text('SELECT pg_advisory_unlock(:key)'),
+                    key=LOCK_KEY,
+                )
+
+        return
+
+    path = app.iniconfig.get('database', 'migration_lock') or os.path.join(
+        tempfile.gettempdir(),
+        'hapcat-migrations.lock',
+    )
+
+    with open(path, 'a') as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def upgrade(engine, mode='check'):
+    """Bring the database schema up to date, if needed.
+
+    :param engine: The database engine.
+
+    :param str mode: ``check`` to migrate unless the database is at
+        :data:`HEAD_REVISION`, ``always`` to always run Alembic, or
+        ``never`` to leave the schema alone.
+
+    :returns: Whether Alembic was run.
+
+    :raises ValueError: The mode is invalid.
+    """
+
+    if mode not in MODES:
+        raise ValueError('Invalid migrations mode {0!r}'.format(mode))
+
+    if mode == 'never':
+        return False
+
+    if mode == 'check' and current_revision(engine) == HEAD_REVISION:
+        app.logger.info('Database schema is up to date at %s', HEAD_REVISION)
+        return False
+
+    with migration_lock(engine):
+        # Another process may have migrated while this one waited.
+        if mode == 'check' and current_revision(engine) == HEAD_REVISION:
+            app.logger.info(
+                'Database schema was migrated to %s by another process',
+                HEAD_REVISION,
+            )
+            return False
+
+        import flask_migrate
+
+        import hapcat.application
+
+        hapcat.application.init_migrate()
+
+        app.logger.info('Migrating the database schema')
+        flask_migrate.upgrade()
+
+    return True
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat full-text search.
+
+Each event and location has a row in the ``votable_search`` table, with its
+name, address, and tag names.
+On SQLite this is an FTS5 table, and on PostgreSQL it holds a weighted
+``tsvector`` with a GIN index.
+Other databases fall back to unranked substring matches of the names.
+
+The rows are rewritten whenever the ORM flushes new or changed votables or
+votable tags, or renamed tags, and by :func:`hapcat.dbutil.add_votables`
+for its bulk inserts.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import binascii
+import json
+import re
+
+import sqlalchemy
+import sqlalchemy.orm
+
+
+from hapcat.models import (
+    Event,
+    Location,
+    RawLocation,
+    Tag,
+    Votable,
+    VotableTag,
+)
+
+# The search words, which are all that's kept of a query.
+_words = re.compile(r'\w+', re.UNICODE)
+
+# The most votables to reindex in one statement.
+CHUNK = 500
+
+
+class InvalidQuery(ValueError):
+    """A search query or continuation token is invalid.
+    """
+
+
+def words(query):
+    """Split a search query into its words.
+
+    >>> words(u'Pizza, "Kent" OR main*')
+    ['pizza', 'kent', 'or', 'main']
+    """
+
+    return [word.lower() for word in _words.findall(query)]
+
+
+def encode_cursor(offset):
+    """Encode the offset of the next page as an opaque continuation token.
+    """
+
+    raw = json.dumps({'offset': offset}).encode('utf-8')
+
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(token):
+    """Decode a continuation token from :func:`encode_cursor`.
+
+    :raises InvalidQuery: The token is invalid.
+    """
+
+    try:
+        raw = base64.urlsafe_b64decode(
+            (token + '=' * (-len(token) % 4)).encode('ascii')
+        )
+        offset = json.loads(raw.decode('utf-8'))['offset']
+
+    except (
+            KeyError,
+            TypeError,
+            UnicodeError,
+            ValueError,
+            binascii.Error,
+        ):
+        raise InvalidQuery('Invalid cursor')
+
+    if isinstance(offset, bool) or not isinstance(offset, int) or offset < 0:
+        raise InvalidQuery('Invalid cursor')
+
+    return offset
+
+
+def _dialect(connection):
+    """Get the name of the database dialect of a connection or session.
+    """
+
+    if hasattr(connection, 'get_bind'):
+        return connection.get_bind().dialect.name
+
+    return connection.dialect.name
+
+
+def _documents(connection, ids):
+    """Get the name, address, and tag names of the given votables.
+
+    :param ids: The votable UUIDs, or ``None`` for all of them.
+
+    :returns: A list of tuples of the UUID, name, address, and tag names.
+    """
+
+    votable = Votable.__table__
+    location = Location.__table__
+    event = Event.__table__
+    rawlocation = RawLocation.__table__
+    votable_tag = VotableTag.__table__
+    tag = Tag.__table__
+
+    docs = sqlalchemy.select([
+        votable.c.id,
+        votable.c.name,
+        rawlocation.c.address,
+    ]).select_from(
+        votable.outerjoin(
+            location,
+            location.c.id == votable.c.id,
+        ).outerjoin(
+            event,
+            event.c.id == votable.c.id,
+        ).outerjoin(
+            rawlocation,
+            rawlocation.c.id == sqlalchemy.func.coalesce(
+                location.c.rawlocation_id,
+                event.c.rawlocation_id,
+            ),
+        )
+    )
+
+    tags = sqlalchemy.select([
+        votable_tag.c.votable_id,
+        tag.c.name,
+    ]).select_from(
+        votable_tag.join(tag, tag.c.id == votable_tag.c.tag_id)
+    )
+
+    if ids is not None:
+        docs = docs.where(votable.c.id.in_(ids))
+        tags = tags.where(votable_tag.c.votable_id.in_(ids))
+
+    tagnames = {}
+
+    for votable_id, name in connection.execute(tags):
+        tagnames.setdefault(votable_id, []).append(name)
+
+    return [
+        (
+            votable_id,
+            name,
+            address or u'',
+            u' '.join(sorted(tagnames.get(votable_id, []))),
+        )
+        for votable_id, name, address in connection.execute(docs)
+    ]
+
+
+def reindex(connection, ids=None):
+    """Rewrite the search index rows of the given votables.
+
+    :param connection: A database connection or session.
+
+    :param ids: The votable UUIDs, or ``None`` to rebuild the whole index.
+    """
+
+    dialect = _dialect(connection)
+
+    if dialect not in ('sqlite', 'postgresql'):
+        return
+
+    idtype = Votable.__table__.c.id.type
+
+    if ids is None:
+        connection.execute(sqlalchemy.text('DELETE FROM votable_search'))
+        chunks = [None]
+    else:
+        ids = list(set(ids))
+        chunks = [ids[i:i + CHUNK] for i in range(0, len(ids), CHUNK)]
+
+    if dialect == 'sqlite':
+        insert = sqlalchemy.text(
+            'INSERT INTO votable_search (votable_id, name, address, tags) '
+            'VALUES (:votable_id, :name, :address, :tags)'
+        )
+    else:
+        insert = sqlalchemy.text(
+            'INSERT INTO votable_search (votable_id, document) '
+            "VALUES (:votable_id, "
+            "setweight(to_tsvector('simple', :name), 'A') || "
+            "setweight(to_tsvector('simple', :address), 'B') || "
+            "setweight(to_tsvector('simple', :tags), 'C'))"
+        )
+
+    insert = insert.bindparams(
+        sqlalchemy.bindparam('votable_id', type_=idtype),
+    )
+
+    for chunk in chunks:
+        if chunk is not None:
+            connection.execute(
+                sqlalchemy.text(
+                    'DELETE FROM votable_search WHERE votable_id IN :ids'
+                ).bindparams(
+                    sqlalchemy.bindparam('ids', expanding=True, type_=idtype),
+                ),
+                {'ids': chunk},
+            )
+
+        params = [
+            {
+                'votable_id': votable_id,
+                'name': name,
+                'address': address,
+                'tags': tags,
+            }
+            for votable_id, name, address, tags in _documents(
+                connection,
+                chunk,
+            )
+        ]
+
+        if params:
+            connection.execute(insert, params)
+
+
+def clear(connection):
+    """Remove everything from the search index.
+
+    :param connection: A database connection or session.
+    """
+
+    if _dialect(connection) in ('sqlite', 'postgresql'):
+        connection.execute(sqlalchemy.text('DELETE FROM votable_search'))
+
+
+def search(session, query, limit, offset=0):
+    """Search the events and locations.
+
+    Every word of the query has to match, and the last word also matches as
+    a prefix, so partial words find results as they're typed.
+    Matches in names rank above those in addresses, which rank above those in
+    tag names.
+
+    :param session: The database session.
+
+    :param str query: The search query.
+
+    :param int limit: The most results to get.
+
+    :param int offset: The number of results to skip.
+
+    :returns: A list of the matching votable UUIDs, best first.
+
+    :raises InvalidQuery: The query has no words.
+    """
+
+    terms = words(query)
+
+    if not terms:
+        raise InvalidQuery('Invalid query')
+
+    dialect = _dialect(session)
+    idtype = Votable.__table__.c.id.type
+
+    if dialect == 'sqlite':
+        match = u' '.join(u'"{0}"'.format(term) for term in terms) + u'*'
+
+        stmt = sqlalchemy.text(
+            'SELECT votable_id FROM votable_search '
+            'WHERE votable_search MATCH :match '
+            'ORDER BY bm25(votable_search, 0.0, 10.0, 5.0, 2.0), votable_id '
+            'LIMIT :limit OFFSET :offset'
+        )
+
+    elif dialect == 'postgresql':
+        match = u' & '.join(terms) + u':*'
+
+        stmt = sqlalchemy.text(
+            'SELECT votable_id FROM votable_search '
+            "WHERE document @@ to_tsquery('simple', :match) "
+            "ORDER BY ts_rank(document, to_tsquery('simple', :match)) DESC, "
+            'votable_id '
+            'LIMIT :limit OFFSET :offset'
+        )
+
+    else:
+        votable = Votable.__table__
+
+        stmt = sqlalchemy.select([votable.c.id]).where(
+            sqlalchemy.and_(*[
+                votable.c.name.ilike(u'%{0}%'.format(term))
+                for term in terms
+            ])
+        ).order_by(votable.c.id).limit(limit).offset(offset)
+
+        return [votable_id for (votable_id,) in session.execute(stmt)]
+
+    stmt = stmt.columns(
+        sqlalchemy.column('votable_id', idtype),
+    )
+
+    return [
+        votable_id
+        for (votable_id,) in session.execute(
+            stmt,
+            {
+                'match': match,
+                'limit': limit,
+                'offset': offset,
+            },
+        )
+    ]
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_flush')
+def _reindex_flushed(session, flush_context):
+    """Reindex the votables whose names or tags were just flushed, or whose
+    tags were renamed.
+
+    Deleted votables are found to be missing, and removed from the index.
+    """
+
+    ids = set()
+    renamed = set()
+
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Votable):
+            ids.add(obj.id)
+        elif (
+                isinstance(obj, Tag) and
+                obj in session.dirty and
+                sqlalchemy.inspect(obj).attrs.name.history.has_changes()
+            ):
+            renamed.add(obj.id)
+
+    for obj in session.new | session.deleted:
+        if isinstance(obj, VotableTag):
+            ids.add(obj.votable_id)
+
+    if renamed:
+        votable_tag = VotableTag.__table__
+
+        ids.update(
+            votable_id
+            for (votable_id,) in session.execute(
+                sqlalchemy.select([votable_tag.c.votable_id]).where(
+                    votable_tag.c.tag_id.in_(renamed),
+                )
+            )
+        )
+
+    ids.discard(None)
+
+    if ids:
+        reindex(session, ids)
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat's preforking production server.
+
+The parent process starts the application, so the database is migrated and
+the JWT secret loaded once, opens the listening socket, and forks ``[uwsgi]
+processes`` workers.
+Each worker serves up to ``[uwsgi] threads`` requests at once with
+Werkzeug's threaded server, and stops accepting connections while they're
+all busy, leaving them to the other workers.
+Workers which die are replaced, after a delay which grows while they keep
+dying soon after they start.
+
+The parent handles these signals:
+
+- ``SIGHUP`` reloads gracefully: the parent runs itself again, keeping the
+  listening socket, so it loads the code and configuration anew, starts new
+  workers, and then stops the old ones, which finish the requests they're
+  serving first.
+  No connections are refused meanwhile.
+  The new code is started in a separate process first, and if that fails,
+  the parent carries on serving as before.
+
+- ``SIGTERM`` and ``SIGINT`` stop the workers, once they've finished the
+  requests they're serving, and then the parent.
+  Each worker writes the votes it has buffered before it exits.
+
+This needs :func:`os.fork`, so it isn't available on Windows.
+"""
+
+from __future__ import absolute_import
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import werkzeug.serving
+
+from hapcat.application import (
+    app,
+    release_connections,
+)
+
+import hapcat.strength
+import hapcat.votebuffer
+
+# The environment variables handing the socket and the old workers to the
+# reloaded parent.
+LISTEN_FD = 'HAPCAT_LISTEN_FD'
+RETIRING_WORKERS = 'HAPCAT_RETIRING_WORKERS'
+
+# Workers exiting sooner than this many seconds after they started are
+# replaced after a delay, starting at RESPAWN_DELAY seconds and doubling each
+# time, up to MAX_RESPAWN_DELAY.
+MIN_WORKER_LIFETIME = 5
+RESPAWN_DELAY = 0.1
+MAX_RESPAWN_DELAY = 10
+
+
+class WorkerServer(werkzeug.serving.ThreadedWSGIServer):
+    """A worker's server, serving a limited number of requests at once.
+
+    :param int threads: The most requests to serve at once.
+    """
+
+    multiprocess = True
+
+    # Let the requests being served finish when stopping.
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, host, fd, app, threads):
+        super(WorkerServer, self).__init__(host, 0, app, fd=fd)
+
+        self._slots = threading.BoundedSemaphore(threads)
+
+    def get_request(self):
+        connection, address = super(WorkerServer, self).get_request()
+
+        # The listening socket is nonblocking, so the workers can all
+        # accept from it, but each connection is served blocking.
+        connection.setblocking(True)
+
+        return connection, address
+
+    def process_request(self, request, client_address):
+        # Wait for a free thread before accepting more connections.
+        self._slots.acquire()
+
+        try:
+            super(WorkerServer, self).process_request(
+                request,
+                client_address,
+            )
+        except Exception:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super(WorkerServer, self).process_request_thread(
+                request,
+                client_address,
+            )
+        finally:
+            self._slots.release()
+
+
+def listen(host, port):
+    """Open the listening socket, or take over the one the parent had before
+    it reloaded.
+
+    :returns: The socket.
+    """
+
+    fd = os.environ.pop(LISTEN_FD, None)
+
+    if fd is not None:
+        sock = socket.fromfd(
+            int(fd),
+            werkzeug.serving.select_address_family(host, port),
+            socket.SOCK_STREAM,
+        )
+        os.close(int(fd))
+    else:
+        sock = socket.socket(
+            werkzeug.serving.select_address_family(host, port),
+            socket.SOCK_STREAM,
+        )
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(werkzeug.serving.get_sockaddr(
+            host,
+            port,
+            sock.family,
+        ))
+        sock.listen(werkzeug.serving.LISTEN_QUEUE)
+
+    sock.setblocking(False)
+
+    return sock
+
+
+class PreforkServer(object):
+    """Serve the application from several forked worker processes.
+
+    :param str host: The address to listen on.
+
+    :param int port: The port to listen on.
+
+    :param int processes: The number of worker processes.
+
+    :param int threads: The most requests each worker serves at once.
+    """
+
+    def __init__(self, host, port, processes, threads):
+        self.host = host
+        self.port = port
+        self.processes = processes
+        self.threads = threads
+
+        self.socket = None
+        self.workers = set()
+        self.retiring = set()
+
+        # When each worker was started, by process ID.
+        self._spawned = {}
+
+        # The number of workers to replace, when, and the delay before it.
+        self._missing = 0
+        self._respawn_at = 0
+        self._delay = 0
+
+        self._stopping = False
+        self._reloading = False
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _reload(self, signum, frame):
+        self._reloading = True
+
+    def spawn(self):
+        """Fork a worker process.
+        """
+
+        pid = os.fork()
+
+        if pid:
+            self.workers.add(pid)
+            self._spawned[pid] = time.time()
+            return
+
+        status = 0
+
+        try:
+            self.work()
+        except BaseException:
+            app.logger.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            # This skips the atexit handlers, and unwinding the parent's
+            # stack, so work() cleans up itself.
+            os._exit(status)
+
+    def work(self):
+        """Serve requests in a worker process, until it's told to stop.
+        """
+
+        server = WorkerServer(
+            self.host,
+            self.socket.fileno(),
+            app,
+            self.threads,
+        )
+
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever() to return, so it can't be
+            # called from its thread.
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        try:
+            # This closes the server, waiting for the requests being served.
+            server.serve_forever()
+        finally:
+            self.finish()
+
+    def finish(self):
+        """Clean up a worker process before it exits.
+
+        This writes the votes it has buffered, and stops its password
+        strength checking processes, which would otherwise be done at exit.
+        """
+
+        try:
+            hapcat.votebuffer.votes.flush()
+        finally:
+            hapcat.strength.checker.close()
+
+    def reap(self):
+        """Collect the workers which have exited, scheduling replacements
+        for any which shouldn't have.
+        """
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                # There are no workers left.
+                return
+
+            if not pid:
+                return
+
+            started = self._spawned.pop(pid, None)
+
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif pid in self.workers:
+                self.workers.discard(pid)
+
+                if not self._stopping:
+                    self.lost(started)
+
+                    app.logger.warning(
+                        'Worker %d exited with status %d, replacing it in '
+                        '%.1f seconds',
+                        pid,
+                        status,
+                        self._delay,
+                    )
+
+    def lost(self, started):
+        """Schedule replacing a worker which exited.
+
+        :param float started: When the worker was started.
+        """
+
+        now = time.time()
+
+        if started is not None and now - started < MIN_WORKER_LIFETIME:
+            self._delay = min(
+                max(self._delay * 2, RESPAWN_DELAY),
+                MAX_RESPAWN_DELAY,
+            )
+        else:
+            self._delay = 0
+
+        self._missing += 1
+        self._respawn_at = max(self._respawn_at, now + self._delay)
+
+    def respawn(self):
+        """Replace the workers which exited, once it's time.
+        """
+
+        if self._missing and time.time() >= self._respawn_at:
+            missing, self._missing = self._missing, 0
+
+            for i in range(missing):
+                self.spawn()
+
+    def retire(self, pids):
+        """Stop workers, once they've finished the requests they're serving.
+        """
+
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                continue
+
+            self.retiring.add(pid)
+
+    def reexec(self):
+        """Run the parent again, handing over the socket and workers.
+
+        The workers keep serving until the new parent has started its own.
+        If the new code or configuration fails to start, this carries on
+        instead.
+        """
+
+        self._reloading = False
+
+        app.logger.info('Reloading')
+
+        # Run the module, rather than sys.argv[0], which may be a wrapper
+        # script or, with python -m, the module's file.
+        command = [sys.executable, '-m', 'hapcat.hapcat'] + sys.argv[1:]
+
+        # Once this process is replaced, nothing would be left to look after
+        # the workers if the new parent failed to start.
+        if subprocess.call(command + ['--check']) != 0:
+            app.logger.error('Not reloading, since starting failed')
+            return
+
+        self.socket.set_inheritable(True)
+
+        os.environ[LISTEN_FD] = str(self.socket.fileno())
+        os.environ[RETIRING_WORKERS] = ','.join(
+            str(pid) for pid in self.workers | self.retiring
+        )
+
+        try:
+            os.execv(sys.executable, command)
+        except OSError:
+            app.logger.exception('Failed to reload')
+
+            self.socket.set_inheritable(False)
+            os.environ.pop(LISTEN_FD, None)
+            os.environ.pop(RETIRING_WORKERS, None)
+
+    def run(self):
+        """Serve until stopped.
+        """
+
+        self.socket = listen(self.host, self.port)
+
+        inherited = [
+            int(pid)
+            for pid in os.environ.pop(RETIRING_WORKERS, '').split(',')
+            if pid
+        ]
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+
+        for i in range(self.processes):
+            self.spawn()
+
+        # The old parent's workers are ours now, since reloading kept the
+        # process.
+        self.retire(inherited)
+
+        app.logger.info(
+            'Serving on %s:%d with %d processes of %d threads',
+            self.host,
+            self.socket.getsockname()[1],
+            self.processes,
+            self.threads,
+        )
+
+        while not self._stopping:
+            if self._reloading:
+                self.reexec()
+
+            self.reap()
+            self.respawn()
+            time.sleep(0.1)
+
+        self.retire(self.workers)
+        self.workers.clear()
+
+        while self.retiring:
+            self.reap()
+            time.sleep(0.1)
+
+        self.socket.close()
+
+
+def serve():
+    """Serve the application with a :class:`PreforkServer`, as configured.
+    """
+
+    # Close the parent's database connections, so the workers don't share
+    # them.
+    release_connections()
+
+    PreforkServer(
+        app.iniconfig.get('apiserver', 'address'),
+        app.iniconfig.getint('apiserver', 'port'),
+        app.iniconfig.getint('uwsgi', 'processes'),
+        app.iniconfig.getint('uwsgi', 'threads'),
+    ).run()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat password strength checks.
+
+zxcvbn takes time growing steeply with the length of the password, so only
+the first ``[passwords] strength_max_length`` characters are checked, and
+the checks run in a pool of worker processes.
+A check which takes longer than ``[passwords] strength_timeout`` seconds,
+including waiting for a worker, gives up with :class:`StrengthCheckTimeout`,
+and the pool is killed so the stuck worker doesn't keep running.
+
+zxcvbn is only imported by the worker processes, when they first check a
+password.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import multiprocessing
+import os
+import signal
+import threading
+
+from hapcat.application import app
+
+
+class StrengthCheckTimeout(Exception):
+    """A password strength check took too long.
+    """
+
+
+def score(password, user_inputs, max_length):
+    """Score a password's strength with zxcvbn.
+
+    This runs in the worker processes.
+
+    :param str password: The password.
+
+    :param list user_inputs: Other things the user entered, which the
+        password shouldn't resemble.
+
+    :param int max_length: The most characters of the password to check.
+
+    :returns: A tuple of the score, from 0 to 4, and zxcvbn's feedback.
+    """
+
+    from zxcvbn import zxcvbn
+
+    results = zxcvbn(
+        password[:max_length],
+        user_inputs=[value[:max_length] for value in user_inputs],
+    )
+
+    return results['score'], results['feedback']
+
+
+def _init_worker():
+    """Set up a worker process.
+
+    It's forked from a process which may stop gracefully on ``SIGTERM``,
+    such as one of hapcatd's, but terminating the pool needs ``SIGTERM`` to
+    kill it.
+    """
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+class StrengthChecker(object):
+    """Check password strengths in a pool of worker processes.
+
+    Each process has its own pool, started when it first checks a password,
+    and reset if it's forked.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        """Reset the checker for the current process.
+        """
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _start(self):
+        """Start the worker processes if needed.
+
+        :returns: The pool.
+        """
+
+        if self._pid != os.getpid():
+            self._reset()
+
+        with self._lock:
+            if self._pool is None:
+                # Forking, rather than spawning, so the workers don't import
+                # hapcat again, which would connect to the database.
+                self._pool = multiprocessing.get_context('fork').Pool(
+                    app.iniconfig.getint('passwords', 'strength_workers'),
+                    _init_worker,
+                )
+
+                atexit.register(self.close)
+
+            return self._pool
+
+    def _kill(self, pool):
+        """Kill a pool's worker processes, if it's still in use.
+        """
+
+        with self._lock:
+            if self._pool is not pool:
+                return
+
+            self._pool = None
+
+        pool.terminate()
+
+    def run(self, func, *args):
+        """Call a function in a worker process, waiting for its result.
+
+        :raises StrengthCheckTimeout: The result didn't come in time.
+        """
+
+        pool = self._start()
+        result = pool.apply_async(func, args)
+
+        try:
+            return result.get(
+                app.iniconfig.getfloat('passwords', 'strength_timeout'),
+            )
+        except multiprocessing.TimeoutError:
+            self._kill(pool)
+            raise StrengthCheckTimeout('Password strength check timed out')
+
+    def check(self, password, user_inputs, minscore=3):
+        """Check a password is strong enough.
+
+        :param str password: The password.
+
+        :param list user_inputs: Other things the user entered, which the
+            password shouldn't resemble.
+
+        :param int minscore: The lowest acceptable zxcvbn score.
+
+        :returns: A tuple of whether the password is strong enough, and
+            zxcvbn's feedback.
+
+        :raises StrengthCheckTimeout: The check took too long.
+        """
+
+        passwordscore, feedback = self.run(
+            score,
+            password,
+            list(user_inputs),
+            app.iniconfig.getint('passwords', 'strength_max_length'),
+        )
+
+        return passwordscore >= minscore, feedback
+
+    def close(self):
+        """Stop the worker processes, if they're running.
+        """
+
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+
+        if pool is not None and self._pid == os.getpid():
+            pool.terminate()
+            pool.join()
+
+
+checker = StrengthChecker()
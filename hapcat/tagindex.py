@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat in-memory tag index.
+"""
+
+from __future__ import absolute_import
+
+import functools
+import threading
+import time
+
+import numpy
+import sqlalchemy
+
+import hapcat.replicas
+
+from hapcat.application import (
+    app,
+    db,
+)
+
+from hapcat.models import (
+    UUIDObject,
+    VotableTag,
+)
+
+# The section of the suggestions each type of votable is in.
+sections = {
+    'location': 'locations',
+    'event': 'events',
+}
+
+# The codes for each section in the index.
+section_codes = {
+    'locations': 0,
+    'events': 1,
+}
+
+_empty = numpy.array([], dtype=numpy.int64)
+
+_low64 = (1 << 64) - 1
+
+
+def _split(votable_id):
+    """Split a UUID into its high and low 64 bits, which order like it.
+    """
+
+    return votable_id.int >> 64, votable_id.int & _low64
+
+
+class TagMatches(object):
+    """The votables matching a tag query.
+
+    This keeps the index arrays as of the query, so later additions don't
+    affect it.
+    """
+
+    def __init__(self, numbers, ids, codes, high, low):
+        self._numbers = numbers
+        self._ids = ids
+        self._codes = codes
+        self._high = high
+        self._low = low
+
+    def page(self, section, limit, after=None):
+        """Get a page of the matching votables in a section, by UUID.
+
+        Only the UUIDs on the page are looked up, so this takes about the
+        same time however deep the page is.
+
+        :param str section: ``locations`` or ``events``.
+
+        :param int limit: The most UUIDs to get.
+
+        :param uuid.UUID after: The UUID to continue after, if any.
+
+        :returns: A sorted list of the matching votable UUIDs.
+        """
+
+        numbers = self._numbers[
+            self._codes[self._numbers] == section_codes[section]
+        ]
+        high = self._high[numbers]
+        low = self._low[numbers]
+
+        if after is not None:
+            afterhigh, afterlow = (numpy.uint64(x) for x in _split(after))
+            keep = (high > afterhigh) | (
+                (high == afterhigh) & (low > afterlow)
+            )
+
+            numbers = numbers[keep]
+            high = high[keep]
+            low = low[keep]
+
+        if len(numbers) > limit:
+            # Only sort the candidates for the page.
+            cutoff = numpy.partition(high, limit - 1)[limit - 1]
+            keep = high <= cutoff
+
+            numbers = numbers[keep]
+            high = high[keep]
+            low = low[keep]
+
+        order = numpy.lexsort((low, high))[:limit]
+
+        return self._ids[numbers[order]].tolist()
+
+
+class TagScores(object):
+    """The scores of the indexed votables for a user's tag affinities.
+    """
+
+    def __init__(self, scores, ids, codes):
+        self._scores = scores
+        self._ids = ids
+        self._codes = codes
+
+    def top(self, section, limit):
+        """Get the best scoring votables in a section.
+
+        Votables scoring zero aren't included.
+
+        :param str section: ``locations`` or ``events``.
+
+        :param int limit: The most votables to get.
+
+        :returns: A list of tuples of the votable UUID and its score, best
+            first.
+        """
+
+        numbers = numpy.flatnonzero(
+            (self._scores > 0) &
+            (self._codes == section_codes[section])
+        )
+
+        if len(numbers) > limit:
+            # Only sort the candidates for the top.
+            keep = numpy.argpartition(-self._scores[numbers], limit - 1)
+            numbers = numpy.sort(numbers[keep[:limit]])
+
+        scores = self._scores[numbers]
+        order = numpy.argsort(-scores, kind='stable')
+
+        return list(zip(
+            self._ids[numbers[order]].tolist(),
+            scores[order].tolist(),
+        ))
+
+
+class TagIndex(object):
+    """An inverted index from tags to the votables tagged with them.
+
+    Each tagged votable is numbered in the order it was indexed, and each tag
+    has a sorted array of the numbers of its votables, so the votables with
+    any or all of several tags are found by merging the arrays, without
+    touching the database.
+
+    The index is built from the database the first time it's used, and
+    rebuilt once it's older than the ``[apiserver] tag_index_ttl``
+    configuration, in seconds.
+    Votables added by this process are indexed by the next query, which
+    merges everything added since the last one at once, but the TTL bounds
+    how long other processes' additions are missing.
+
+    The same postings make up a sparse votable by tag matrix, which scores
+    every votable against a vector of tag weights at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._built = None
+        self._load([], [], {}, {})
+
+    def _load(self, ids, codes, numbers, postings):
+        """Replace the index contents.
+
+        :param list ids: The votable UUIDs, by number.
+
+        :param list codes: The section code of each votable, by number.
+
+        :param dict numbers: The votable numbers, by UUID.
+
+        :param dict postings: The sorted arrays of votable numbers, by tag
+            UUID.
+        """
+
+        self._ids = numpy.empty(len(ids), dtype=object)
+        self._ids[:] = ids
+        self._sections = numpy.array(codes, dtype=numpy.uint8)
+
+        # The UUIDs as pairs of integers, for ordering them quickly.
+        split = [_split(votable_id) for votable_id in ids]
+        self._high = numpy.array([x[0] for x in split], dtype=numpy.uint64)
+        self._low = numpy.array([x[1] for x in split], dtype=numpy.uint64)
+
+        self._numbers = numbers
+        self._postings = postings
+        self._matrix = None
+
+        # The votables added since the last query, to merge in at once.
+        self._pending = []
+
+    def invalidate(self):
+        """Drop the index, rebuilding it on its next use.
+        """
+
+        with self._lock:
+            self._built = None
+
+    def _build(self):
+        """Build the index from the database.
+
+        This reads the primary, since every request uses the index.
+        The caller must hold the lock.
+        """
+
+        votable_tag = VotableTag.__table__
+        uuidobject = UUIDObject.__table__
+
+        rows = db.session.execute(
+            hapcat.replicas.on_primary(sqlalchemy.select([
+                votable_tag.c.votable_id,
+                votable_tag.c.tag_id,
+                uuidobject.c.type,
+            ]).select_from(
+                votable_tag.join(
+                    uuidobject,
+                    uuidobject.c.id == votable_tag.c.votable_id,
+                )
+            ))
+        )
+
+        ids = []
+        codes = []
+        numbers = {}
+        postings = {}
+
+        for votable_id, tag_id, type_ in rows:
+            number = numbers.get(votable_id)
+
+            if number is None:
+                number = numbers[votable_id] = len(ids)
+                ids.append(votable_id)
+                codes.append(section_codes[sections[type_]])
+
+            postings.setdefault(tag_id, []).append(number)
+
+        self._load(
+            ids,
+            codes,
+            numbers,
+            {
+                tag_id: numpy.unique(numpy.array(votables, dtype=numpy.int64))
+                for tag_id, votables in postings.items()
+            },
+        )
+        self._built = time.time()
+
+    def _ensure(self):
+        """Build the index if needed.
+
+        The caller must hold the lock.
+        """
+
+        ttl = app.iniconfig.getfloat('apiserver', 'tag_index_ttl')
+
+        if self._built is None or time.time() - self._built >= ttl:
+            self._build()
+        else:
+            self._merge()
+
+    def add(self, votable_id, type_, tags):
+        """Index a new votable.
+
+        This only notes it, and it's merged into the index by the next
+        query, with anything else added meanwhile, so adding many votables
+        doesn't copy the index for each one.
+
+        :param uuid.UUID votable_id: The UUID of the event or location.
+
+        :param str type_: ``event`` or ``location``.
+
+        :param tags: The UUIDs of its tags.
+        """
+
+        with self._lock:
+            # If there's no index yet, this is picked up when it's built.
+            if self._built is None or not tags:
+                return
+
+            self._pending.append((
+                votable_id,
+                section_codes[sections[type_]],
+                set(tags),
+            ))
+
+    def _merge(self):
+        """Merge the votables added since the last query into the index.
+
+        The caller must hold the lock.
+        """
+
+        if not self._pending:
+            return
+
+        ids = []
+        codes = []
+        added = {}
+
+        for votable_id, code, tags in self._pending:
+            number = self._numbers.get(votable_id)
+
+            if number is None:
+                number = self._numbers[votable_id] = len(self._ids) + len(ids)
+                ids.append(votable_id)
+                codes.append(code)
+
+            for tag_id in tags:
+                added.setdefault(tag_id, []).append(number)
+
+        self._pending = []
+
+        # The arrays are replaced rather than changed, so any matches
+        # already found keep using the old ones.
+
+        if ids:
+            newids = numpy.empty(len(ids), dtype=object)
+            newids[:] = ids
+            split = [_split(votable_id) for votable_id in ids]
+
+            self._ids = numpy.concatenate([self._ids, newids])
+            self._sections = numpy.concatenate([
+                self._sections,
+                numpy.array(codes, dtype=numpy.uint8),
+            ])
+            self._high = numpy.concatenate([
+                self._high,
+                numpy.array([x[0] for x in split], dtype=numpy.uint64),
+            ])
+            self._low = numpy.concatenate([
+                self._low,
+                numpy.array([x[1] for x in split], dtype=numpy.uint64),
+            ])
+
+        for tag_id, numbers in added.items():
+            self._postings[tag_id] = numpy.union1d(
+                self._postings.get(tag_id, _empty),
+                numpy.array(numbers, dtype=numpy.int64),
+            )
+
+        self._matrix = None
+
+    def match(self, tags, mode='any'):
+        """Find the votables with any or all of the given tags.
+
+        :param tags: The tag UUIDs.
+
+        :param str mode: ``any`` or ``all``.
+
+        :rtype: TagMatches
+        """
+
+        with self._lock:
+            self._ensure()
+
+            ids = self._ids
+            codes = self._sections
+            high = self._high
+            low = self._low
+            postings = [
+                self._postings.get(tag_id, _empty)
+                for tag_id in set(tags)
+            ]
+
+        if not postings:
+            numbers = _empty
+        elif mode == 'all':
+            # Intersect the smallest arrays first to keep the work down.
+            postings.sort(key=len)
+            numbers = functools.reduce(
+                lambda a, b: numpy.intersect1d(a, b, assume_unique=True),
+                postings,
+            )
+        else:
+            numbers = numpy.unique(numpy.concatenate(postings))
+
+        return TagMatches(numbers, ids, codes, high, low)
+
+    def _ensure_matrix(self):
+        """Build the votable by tag matrix if needed.
+
+        The caller must hold the lock.
+
+        :returns: A tuple of the column of each tag, by UUID, and the rows and
+            columns of the nonzero entries.
+        """
+
+        if self._matrix is None:
+            tags = list(self._postings)
+            rows = [self._postings[tag_id] for tag_id in tags]
+
+            self._matrix = (
+                {tag_id: column for column, tag_id in enumerate(tags)},
+                numpy.concatenate(rows) if rows else _empty,
+                numpy.repeat(
+                    numpy.arange(len(tags)),
+                    [len(votables) for votables in rows],
+                ),
+            )
+
+        return self._matrix
+
+    def scores(self, weights, exclude=()):
+        """Score the votables by the total weight of their tags.
+
+        :param dict weights: The weight of each tag, by UUID.
+
+        :param exclude: The UUIDs of votables to score zero.
+
+        :rtype: TagScores
+        """
+
+        with self._lock:
+            self._ensure()
+
+            columns, rows, cols = self._ensure_matrix()
+            ids = self._ids
+            codes = self._sections
+            excluded = [
+                self._numbers[votable_id]
+                for votable_id in exclude
+                if votable_id in self._numbers
+            ]
+
+        vector = numpy.zeros(len(columns))
+
+        for tag_id, weight in weights.items():
+            column = columns.get(tag_id)
+
+            if column is not None:
+                vector[column] = weight
+
+        # Multiply the matrix by the vector.
+        scores = numpy.bincount(
+            rows,
+            weights=vector[cols],
+            minlength=len(ids),
+        )
+        scores[excluded] = 0
+
+        return TagScores(scores, ids, codes)
+
+
+tag_index = TagIndex()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat username availability.
+
+Registering checks the username is free before checking and hashing the
+password, which are slow on purpose.
+Most new usernames aren't taken, so a Bloom filter of the known usernames
+answers for them without touching the database, and only the usernames it
+might contain are looked up.
+"""
+
+from __future__ import absolute_import, division
+
+import hashlib
+import math
+import struct
+import threading
+import time
+
+import numpy
+import sqlalchemy
+
+import hapcat.replicas
+
+from hapcat.application import app
+
+from hapcat.models import User
+
+
+def _hashes(username):
+    """Get the two base hashes of a username for a Bloom filter.
+    """
+
+    digest = hashlib.sha1(username.encode('utf-8')).digest()
+
+    # The second hash is odd, so the probes cover every bit.
+    first, second = struct.unpack('<QQ', digest[:16])
+
+    return first, second | 1
+
+
+class BloomFilter(object):
+    """A set of strings which may have false positives, but no false
+    negatives.
+
+    :param int capacity: The number of strings it's sized for.
+
+    :param float error: The false positive rate at that capacity.
+    """
+
+    def __init__(self, capacity, error):
+        capacity = max(capacity, 1)
+
+        self.size = max(
+            64,
+            int(math.ceil(-capacity * math.log(error) / math.log(2) ** 2)),
+        )
+        self.probes = max(1, int(round(self.size / capacity * math.log(2))))
+        self._bits = numpy.zeros((self.size + 7) // 8, dtype=numpy.uint8)
+
+    def _positions(self, value):
+        """Get the bits of a string.
+        """
+
+        first, second = _hashes(value)
+
+        return [
+            (first + i * second) % self.size
+            for i in range(self.probes)
+        ]
+
+    def add(self, value):
+        """Add a string.
+        """
+
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def update(self, values):
+        """Add several strings at once.
+        """
+
+        hashes = numpy.array(
+            [_hashes(value) for value in values],
+            dtype=numpy.uint64,
+        ).reshape(-1, 2)
+
+        # Reduce first, so the sums can't overflow.
+        size = numpy.uint64(self.size)
+        first = hashes[:, 0] % size
+        second = hashes[:, 1] % size
+
+        for i in range(self.probes):
+            positions = (first + numpy.uint64(i) * second % size) % size
+
+            numpy.bitwise_or.at(
+                self._bits,
+                (positions >> numpy.uint64(3)).astype(numpy.int64),
+                (
+                    numpy.uint8(1) <<
+                    (positions & numpy.uint64(7)).astype(numpy.uint8)
+                ),
+            )
+
+    def __contains__(self, value):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+
+def username_exists(session, username):
+    """Check whether a username is taken, with its unique index.
+    """
+
+    user = User.__table__
+
+    return session.execute(
+        sqlalchemy.select([
+            sqlalchemy.exists().where(user.c.username == username),
+        ])
+    ).scalar()
+
+
+class UsernameIndex(object):
+    """The known usernames, for checking availability quickly.
+
+    The Bloom filter is built from the database the first time it's used,
+    and rebuilt once it's older than the ``[apiserver] username_filter_ttl``
+    configuration, in seconds, sized for twice as many users as there are,
+    at a false positive rate of ``[apiserver] username_filter_error``.
+    Usernames registered by this process are added immediately, but the TTL
+    bounds how long other processes' registrations are missing, so a
+    username may be reported free when it was just taken elsewhere.
+    Registering still fails then, when the user is added.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._built = None
+        self._filter = None
+        self._generation = 0
+
+        # The usernames added while the filter is being built.
+        self._added = None
+
+    def invalidate(self):
+        """Drop the filter, rebuilding it on its next use.
+        """
+
+        with self._lock:
+            self._built = None
+            self._filter = None
+            self._generation += 1
+
+    def _build(self, session):
+        """Build the filter from the database, and swap it in.
+
+        The caller must hold the build lock, but not the lock, so usernames
+        are checked against the old filter while the table is read.
+        The table is read from the primary, since every request uses the
+        filter.
+
+        :returns: The new filter.
+        """
+
+        with self._lock:
+            generation = self._generation
+            self._added = []
+
+        try:
+            user = User.__table__
+
+            usernames = [
+                username
+                for (username,) in session.execute(
+                    hapcat.replicas.on_primary(
+                        sqlalchemy.select([user.c.username])
+                    )
+                )
+            ]
+
+            bloom = BloomFilter(
+                max(2 * len(usernames), 1024),
+                app.iniconfig.getfloat('apiserver', 'username_filter_error'),
+            )
+            bloom.update(usernames)
+
+            with self._lock:
+                # The read may have missed usernames registered meanwhile.
+                bloom.update(self._added)
+
+                # Keep the filter dropped if it was invalidated meanwhile.
+                if generation == self._generation:
+                    self._filter = bloom
+                    self._built = time.time()
+        finally:
+            with self._lock:
+                self._added = None
+
+        return bloom
+
+    def _ensure(self, session):
+        """Build the filter if needed, returning it.
+        """
+
+        ttl = app.iniconfig.getfloat('apiserver', 'username_filter_ttl')
+
+        with self._lock:
+            bloom = self._filter
+            fresh = (
+                self._built is not None and
+                time.time() - self._built < ttl
+            )
+
+        if fresh:
+            return bloom
+
+        # One thread rebuilds the filter, while the others carry on with the
+        # old one, or wait if there isn't one.
+        if not self._build_lock.acquire(bloom is None):
+            return bloom
+
+        try:
+            with self._lock:
+                # Another thread may have built it while this one waited.
+                if (
+                        self._built is not None and
+                        time.time() - self._built < ttl
+                    ):
+                    return self._filter
+
+            return self._build(session)
+        finally:
+            self._build_lock.release()
+
+    def add(self, username):
+        """Add a newly registered username.
+        """
+
+        with self._lock:
+            # If there's no filter yet, this is picked up when it's built.
+            if self._filter is not None:
+                self._filter.add(username)
+
+            if self._added is not None:
+                self._added.append(username)
+
+    def taken(self, session, username):
+        """Check whether a username is taken.
+
+        :param session: The database session, to look the username up in if
+            the filter might have it.
+        """
+
+        if username not in self._ensure(session):
+            return False
+
+        return username_exists(session, username)
+
+
+usernames = UsernameIndex()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Hapcat buffered votes.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import os
+import threading
+
+import sqlalchemy
+import sqlalchemy.orm
+
+import hapcat.dbutil
+
+from hapcat.application import (
+    app,
+    db,
+)
+
+from hapcat.models import (
+    User,
+    Votable,
+    Vote,
+)
+
+
+def stored_votes(votable_ids, user_id):
+    """Get the stored votes of a user for several votables, in one query.
+
+    :returns: A dictionary of the number of votes, by votable UUID, leaving
+        out any votables which don't exist, and empty if there is no such
+        user.
+    """
+
+    votable = Votable.__table__
+    vote = Vote.__table__
+    user = User.__table__
+
+    rows = db.session.execute(
+        sqlalchemy.select([
+            votable.c.id,
+            vote.c.numvotes,
+        ]).select_from(
+            votable.outerjoin(
+                vote,
+                sqlalchemy.and_(
+                    vote.c.votable_id == votable.c.id,
+                    vote.c.user_id == user_id,
+                ),
+            )
+        ).where(
+            sqlalchemy.and_(
+                votable.c.id.in_(list(votable_ids)),
+                sqlalchemy.exists().where(user.c.id == user_id),
+            )
+        )
+    )
+
+    return {votable_id: numvotes or 0 for votable_id, numvotes in rows}
+
+
+class VoteBuffer(object):
+    """Collect votes in memory, writing them to the database in batches.
+
+    Votes for the same votable by the same user are combined into a single
+    increment, and written along with the others when the
+    ``[apiserver] vote_flush_interval`` (in seconds) passes, or when combined
+    votes for ``[apiserver] vote_flush_size`` votable and user pairs are
+    waiting.
+    Anything left is written when the process exits.
+
+    Each process has its own buffer, which is reset if it's forked.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        """Reset the buffer for the current process.
+        """
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+        # Held while writing, so flushes take turns.
+        self._flush_lock = threading.Lock()
+
+        self._wakeup = threading.Event()
+        self._thread = None
+
+        # The votes waiting to be written.
+        self._pending = {}
+
+        # The votes being written.
+        self._flushing = {}
+
+        # The stored votes, as of when they were first buffered.
+        self._stored = {}
+
+    def _start(self):
+        """Start the flushing thread if needed.
+        """
+
+        if self._pid != os.getpid():
+            self._reset()
+
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(
+                target=self._run,
+                name='hapcat-votebuffer',
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+        atexit.register(self.flush)
+
+    def _run(self):
+        """Flush the buffer periodically.
+        """
+
+        while True:
+            self._wakeup.wait(
+                app.iniconfig.getfloat('apiserver', 'vote_flush_interval')
+            )
+            self._wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Failed to flush buffered votes')
+
+    def add(self, votable_id, user_id, numvotes=1):
+        """Buffer votes for a votable by a user.
+
+        This reads the stored votes the first time a user votes for a votable
+        since the last flush, and doesn't touch the database otherwise.
+
+        :returns: The projected total votes of the user for the votable, or
+            ``None`` if there is no such votable or user.
+        """
+
+        return self.add_many({votable_id: numvotes}, user_id)[votable_id]
+
+    def add_many(self, counts, user_id):
+        """Buffer votes for several votables by a user.
+
+        The stored votes of all the votables the user hasn't voted for since
+        the last flush are read in one query.
+
+        :param dict counts: The number of votes to add, by votable UUID.
+
+        :returns: A dictionary of the projected total votes of the user, or
+            ``None`` if there is no such votable or user, by votable UUID.
+        """
+
+        self._start()
+
+        with self._lock:
+            unknown = [
+                votable_id
+                for votable_id in counts
+                if (votable_id, user_id) not in self._stored
+            ]
+
+        if unknown:
+            stored = stored_votes(unknown, user_id)
+
+            with self._lock:
+                for votable_id, numvotes in stored.items():
+                    self._stored.setdefault((votable_id, user_id), numvotes)
+
+        projected = {}
+
+        with self._lock:
+            for votable_id, numvotes in counts.items():
+                key = (votable_id, user_id)
+
+                if key not in self._stored:
+                    projected[votable_id] = None
+                    continue
+
+                pending = self._pending.get(key, 0) + numvotes
+                self._pending[key] = pending
+
+                projected[votable_id] = (
+                    self._stored[key] +
+                    self._flushing.get(key, 0) +
+                    pending
+                )
+
+            full = len(self._pending) >= app.iniconfig.getint(
+                'apiserver',
+                'vote_flush_size',
+            )
+
+        if full:
+            self._wakeup.set()
+
+        return projected
+
+    def flush(self):
+        """Write the buffered votes to the database.
+
+        If another thread is already writing, this waits for it to finish,
+        and then writes whatever was buffered meanwhile, so nothing is left
+        behind when flushing at exit.
+        Votes buffered before the process was forked are left to the process
+        they were buffered in.
+        """
+
+        if self._pid != os.getpid():
+            return
+
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        """Write the buffered votes to the database.
+
+        The caller must hold the flush lock.
+        """
+
+        with self._lock:
+            if not self._pending:
+                return
+
+            self._flushing, self._pending = self._pending, {}
+            flushing = self._flushing
+
+        try:
+            # Use a separate session, so this doesn't disturb any request in
+            # progress on this thread.
+            with app.app_context():
+                session = sqlalchemy.orm.Session(bind=db.engine)
+
+                try:
+                    hapcat.dbutil.add_votes_many(
+                        session,
+                        (
+                            (votable_id, user_id, numvotes)
+                            for (votable_id, user_id), numvotes
+                            in flushing.items()
+                        ),
+                    )
+                    session.commit()
+                finally:
+                    session.close()
+
+        except Exception:
+            # Put the votes back to try again later.
+            with self._lock:
+                for key, numvotes in flushing.items():
+                    self._pending[key] = (
+                        self._pending.get(key, 0) + numvotes
+                    )
+
+                self._flushing = {}
+
+            raise
+
+        with self._lock:
+            # Forget the stored votes of anything written, since other
+            # processes may have changed them.
+            for key in flushing:
+                if key not in self._pending:
+                    self._stored.pop(key, None)
+                else:
+                    self._stored[key] += flushing[key]
+
+            self._flushing = {}
+
+
+votes = VoteBuffer()
@@ -132,6 +132,7 @@ setup(
         'flask_sqlalchemy',
         'furl',
         'httpstatus35; python_version<"3.5"',
+        'numpy',
         'passlib',
         'sqlalchemy_utils',
         'tox',
@@ -155,6 +156,7 @@ setup(
         'flask_sqlalchemy',
         'furl',
         'httpstatus35; python_version<"3.5"',
+        'numpy',
         'passlib',
         'sqlalchemy_utils',
         'zxcvbn',
@@ -168,6 +170,8 @@ setup(
     entry_points={
         'console_scripts': [
             'hapcatd=hapcat.hapcat:main',
+            'hapcat-recommend=hapcat.hapcat:recommend_main',
+            'hapcat-calibrate=hapcat.hapcat:calibrate_main',
         ],
     }
 )
@@ -0,0 +1,2767 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.apiserver module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import contextlib
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+import flask_jwt
+import passlib.hash
+import sqlalchemy
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.apiserver
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.apiserver
+
+import hapcat.dbutil
+import hapcat.feed
+import hapcat.hashing
+import hapcat.identity
+import hapcat.replicas
+import hapcat.tagindex
+import hapcat.usernames
+import hapcat.votebuffer
+
+from hapcat import (
+    app,
+    db,
+    jwt,
+)
+
+from hapcat.models import (
+    Event,
+    Location,
+    Photo,
+    RawLocation,
+    Recommendation,
+    Tag,
+    User,
+    UUIDObject,
+    Vote,
+    VotableTag,
+)
+
+
+@contextlib.contextmanager
+def count_queries():
+    """Count the SQL statements executed inside the block.
+
+    This yields a list which has the statements appended to it.
+    """
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(
+        db.engine,
+        'before_cursor_execute',
+        before_cursor_execute,
+    )
+
+    try:
+        yield statements
+    finally:
+        sqlalchemy.event.remove(
+            db.engine,
+            'before_cursor_execute',
+            before_cursor_execute,
+        )
+
+
+class APITestCase(unittest.TestCase):
+    """A base for tests using a fresh database with the test data.
+    """
+
+    def setUp(self):
+        """Set up a fresh database and test client.
+        """
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        hapcat.dbutil.load_test_data()
+        hapcat.feed.suggestions_feed.invalidate()
+        hapcat.tagindex.tag_index.invalidate()
+        hapcat.identity.versions.clear()
+        hapcat.usernames.usernames.invalidate()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Remove the database session.
+        """
+
+        db.session.remove()
+        self.ctx.pop()
+
+    def get_json(self, url, **kwargs):
+        """GET the given URL, returning the response and its JSON.
+        """
+
+        response = self.client.get(url, **kwargs)
+
+        return response, json.loads(response.get_data(as_text=True))
+
+    def make_user(self, username=u'user', password=u'correct horse battery'):
+        """Create a user, returning it and its authorization headers.
+        """
+
+        user = User(
+            id=uuid.uuid4(),
+            username=username,
+            email=u'{0}@example.com'.format(username),
+            date_of_birth=datetime.date(1999, 9, 9),
+            password=password,
+        )
+
+        db.session.add(user)
+        db.session.commit()
+
+        token = jwt.jwt_encode_callback(user)
+
+        if not isinstance(token, str):
+            token = token.decode('ascii')
+
+        return user, {'Authorization': 'JWT {0}'.format(token)}
+
+    def add_votables(self, count, tagcount=3, photocount=2):
+        """Add the given number of new locations and events.
+        """
+
+        tags = [
+            Tag(id=uuid.uuid4(), name=u'tag {0}'.format(i))
+            for i in range(tagcount)
+        ]
+
+        db.session.add_all(tags)
+
+        for i in range(count):
+            rawloc = RawLocation(
+                id=uuid.uuid4(),
+                address=u'{0} Test St'.format(i),
+            )
+
+            for cls in (Location, Event):
+                votable = cls(
+                    id=uuid.uuid4(),
+                    name=u'{0} {1}'.format(cls.__name__, i),
+                    rawlocation=rawloc,
+                )
+
+                photos = [
+                    Photo(
+                        id=uuid.uuid4(),
+                        photourl=u'http://example.com/{0}.png'.format(
+                            uuid.uuid4()
+                        ),
+                    )
+                    for j in range(photocount)
+                ]
+
+                db.session.add_all(photos)
+
+                votable.tags.extend(tag.id for tag in tags)
+                votable.photos.extend(photo.id for photo in photos)
+
+                db.session.add(votable)
+
+        db.session.commit()
+        db.session.expunge_all()
+
+
+class TestSuggestions(APITestCase):
+    """Test the suggestions endpoint.
+    """
+
+    def test_suggestions_content(self):
+        """Test the suggestions include everything they refer to.
+        """
+
+        response, data = self.get_json('/api/v0/suggestions/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['order'])
+
+        for item in data['order']:
+            suggestion = data[item['section']][item['id']]
+
+            for tag in suggestion['tags']:
+                self.assertIn(tag, data['tags'])
+
+            if item['section'] == 'events':
+                self.assertIn(suggestion['location'], data['locations'])
+
+    def test_suggestions_query_count(self):
+        """Test the number of queries doesn't grow with the suggestions.
+        """
+
+        db.session.expunge_all()
+
+        with count_queries() as few:
+            self.get_json('/api/v0/suggestions/')
+
+        self.add_votables(20)
+        hapcat.feed.suggestions_feed.invalidate()
+
+        with count_queries() as many:
+            response, data = self.get_json('/api/v0/suggestions/')
+
+        self.assertEqual(len(data['order']), 40)
+        self.assertEqual(len(few), len(many))
+        self.assertLessEqual(len(many), 6)
+
+    def test_suggestions_cached(self):
+        """Test repeated suggestions don't touch the database.
+        """
+
+        response, first = self.get_json('/api/v0/suggestions/')
+
+        with count_queries() as statements:
+            response, second = self.get_json('/api/v0/suggestions/')
+
+        self.assertEqual(statements, [])
+        self.assertEqual(first, second)
+
+    def test_suggestions_gzip(self):
+        """Test the suggestions are compressed if the client accepts it.
+        """
+
+        plain = self.client.get('/api/v0/suggestions/')
+        compressed = self.client.get(
+            '/api/v0/suggestions/',
+            headers={'Accept-Encoding': 'gzip'},
+        )
+
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            gzip.decompress(compressed.get_data()),
+            plain.get_data(),
+        )
+
+    def test_suggestions_invalidated_by_addevent(self):
+        """Test adding an event rebuilds the suggestions.
+        """
+
+        user, headers = self.make_user()
+
+        self.get_json('/api/v0/suggestions/')
+
+        response = self.client.post(
+            '/api/v0/addevent/',
+            data=json.dumps({
+                'type': 'event',
+                'name': u'New event',
+                'address': u'1 New St',
+            }),
+            headers=headers,
+        )
+
+        self.assertEqual(response.status_code, 200)
+
+        votable = json.loads(response.get_data(as_text=True))['votable']
+
+        response, data = self.get_json('/api/v0/suggestions/')
+
+        self.assertIn(votable['id'], data['events'])
+
+
+class TestSuggestionPages(APITestCase):
+    """Test paginating the suggestions.
+    """
+
+    def get_pages(self, limit):
+        """Get every page of suggestions at the given size.
+        """
+
+        pages = []
+        url = '/api/v0/suggestions/?limit={0}'.format(limit)
+
+        while url is not None:
+            response, data = self.get_json(url)
+
+            self.assertEqual(response.status_code, 200)
+            pages.append(data)
+
+            if data['next'] is None:
+                url = None
+            else:
+                url = '/api/v0/suggestions/?limit={0}&cursor={1}'.format(
+                    limit,
+                    data['next'],
+                )
+
+        return pages
+
+    def test_pages(self):
+        """Test paging through the suggestions sees each votable once.
+        """
+
+        self.add_votables(7)
+
+        seen = []
+
+        for page in self.get_pages(3):
+            self.assertLessEqual(len(page['events']), 3)
+
+            for item in page['order']:
+                seen.append(item['id'])
+
+        expected = [
+            str(votableid)
+            for cls in (Location, Event)
+            for (votableid,) in db.session.query(cls.id)
+        ]
+
+        self.assertEqual(sorted(seen), sorted(expected))
+
+    def test_first_page(self):
+        """Test the precomputed first page continues onto the next.
+        """
+
+        self.add_votables(25)
+
+        response, first = self.get_json('/api/v0/suggestions/')
+        response, second = self.get_json(
+            '/api/v0/suggestions/?cursor={0}'.format(first['next'])
+        )
+
+        self.assertEqual(len(first['events']), 20)
+        self.assertTrue(second['events'])
+        self.assertFalse(set(first['events']) & set(second['events']))
+
+    def test_deep_page_query_count(self):
+        """Test deep pages take as many queries as the first.
+        """
+
+        self.add_votables(10)
+
+        with count_queries() as few:
+            self.get_json('/api/v0/suggestions/?limit=2')
+
+        # Find the deepest page with both locations and events left.
+        deepest = [
+            page['next']
+            for page in self.get_pages(2)
+            if page['next'] is not None and None not in
+                hapcat.feed.decode_cursor(page['next']).values()
+        ][-1]
+
+        db.session.expunge_all()
+
+        with count_queries() as many:
+            self.get_json(
+                '/api/v0/suggestions/?limit=2&cursor={0}'.format(deepest)
+            )
+
+        self.assertEqual(len(few), len(many))
+
+    def test_limit_capped(self):
+        """Test the page size is capped.
+        """
+
+        self.add_votables(110)
+
+        response, data = self.get_json('/api/v0/suggestions/?limit=1000')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data['events']), 100)
+
+    def test_invalid(self):
+        """Test invalid limits and cursors are rejected.
+        """
+
+        for query in (
+                'limit=0',
+                'limit=ten',
+                'cursor=bad',
+                'cursor=',
+                'cursor=W10',
+            ):
+            response, data = self.get_json(
+                '/api/v0/suggestions/?{0}'.format(query)
+            )
+
+            self.assertEqual(response.status_code, 400)
+
+
+class TestNearbySuggestions(APITestCase):
+    """Test the suggestions near a point.
+    """
+
+    def test_nearby(self):
+        """Test nearby suggestions are within the radius, nearest first.
+        """
+
+        user, headers = self.make_user()
+
+        # A line of events going north from the origin, 1km apart.
+        items = [
+            {
+                'type': 'event',
+                'name': u'Event {0}'.format(i),
+                'address': u'{0} North St'.format(i),
+                'latitude': i * 0.008993,
+                'longitude': 0.0,
+            }
+            for i in range(10)
+        ]
+
+        items.append({
+            'type': 'location',
+            'name': u'Faraway',
+            'address': u'1 Faraway St',
+            'latitude': 45.0,
+            'longitude': 45.0,
+        })
+
+        response = self.client.post(
+            '/api/v0/addevents/',
+            data=json.dumps(items),
+            headers=headers,
+        )
+
+        self.assertEqual(response.status_code, 200)
+
+        response, data = self.get_json(
+            '/api/v0/suggestions/?near=0,0&radius=4500'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [data['events'][item['id']]['name'] for item in data['order']],
+            [u'Event {0}'.format(i) for i in range(5)],
+        )
+
+        distances = [item['distance'] for item in data['order']]
+
+        self.assertEqual(distances, sorted(distances))
+        self.assertLessEqual(distances[-1], 4500)
+
+        response, data = self.get_json(
+            '/api/v0/suggestions/?near=0,0&radius=4500&limit=2'
+        )
+
+        self.assertEqual(len(data['events']), 2)
+
+    def test_nearby_invalid(self):
+        """Test invalid nearby suggestions are rejected.
+        """
+
+        for query in (
+                'near=0',
+                'near=a,b',
+                'near=91,0',
+                'near=0,0,0',
+                'near=0,0&radius=-1',
+                'near=0,0&cursor=bad',
+            ):
+            response, data = self.get_json(
+                '/api/v0/suggestions/?{0}'.format(query)
+            )
+
+            self.assertEqual(response.status_code, 400)
+
+
+class TestTaggedSuggestions(APITestCase):
+    """Test filtering the suggestions by tag with the tag index.
+    """
+
+    tag_index = 'yes'
+
+    def setUp(self):
+        """Set whether to use the tag index, and add some tagged votables.
+        """
+
+        super(TestTaggedSuggestions, self).setUp()
+
+        self.oldconfig = dict(app.iniconfig.items('apiserver'))
+
+        app.iniconfig.set('apiserver', 'tag_index', self.tag_index)
+
+        self.add_votables(5)
+
+        # The tags of the added votables.
+        self.tags = [
+            str(tagid)
+            for (tagid,) in db.session.query(Tag.id).filter(
+                Tag.name.like(u'tag %')
+            ).order_by(Tag.name)
+        ]
+
+        # The most used tag in the test data.
+        self.popular = str(db.session.query(VotableTag.tag_id).join(
+            Tag
+        ).filter(
+            ~Tag.name.like(u'tag %')
+        ).group_by(
+            VotableTag.tag_id
+        ).order_by(
+            sqlalchemy.func.count().desc()
+        ).first()[0])
+
+    def tearDown(self):
+        """Restore the configuration.
+        """
+
+        app.iniconfig.set('apiserver', 'tag_index', self.oldconfig['tag_index'])
+
+        super(TestTaggedSuggestions, self).tearDown()
+
+    def expected(self, tags, mode):
+        """Get the IDs of the votables with any or all of the tags.
+        """
+
+        expected = set()
+
+        for cls in (Location, Event):
+            for votable in db.session.query(cls):
+                votabletags = {str(tag.id) for tag in votable.tags}
+
+                if mode == 'any' and votabletags & set(tags):
+                    expected.add(str(votable.id))
+                elif mode == 'all' and votabletags >= set(tags):
+                    expected.add(str(votable.id))
+
+        return expected
+
+    def get_ids(self, query, limit=3):
+        """Get the IDs on every page of the given tagged suggestions.
+        """
+
+        ids = []
+        url = '/api/v0/suggestions/?limit={0}&{1}'.format(limit, query)
+
+        while url is not None:
+            response, data = self.get_json(url)
+
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item['id'] for item in data['order'])
+
+            for votable in list(data['locations'].values()) + list(
+                    data['events'].values()):
+                if votable['type'] != 'rawlocation':
+                    self.assertTrue(votable['tags'])
+
+            if data['next'] is None:
+                url = None
+            else:
+                url = '/api/v0/suggestions/?limit={0}&{1}&cursor={2}'.format(
+                    limit,
+                    query,
+                    data['next'],
+                )
+
+        self.assertEqual(len(ids), len(set(ids)))
+
+        return set(ids)
+
+    def test_any(self):
+        """Test getting the votables with any of the tags.
+        """
+
+        tags = [self.popular, self.tags[0]]
+        expected = self.expected(tags, 'any')
+
+        self.assertGreater(len(expected), 10)
+        self.assertEqual(
+            self.get_ids('tags={0}'.format(','.join(tags))),
+            expected,
+        )
+
+    def test_all(self):
+        """Test getting the votables with all of the tags.
+        """
+
+        for tags in (
+                self.tags,
+                self.tags[:2],
+                [self.popular],
+                [self.popular, self.tags[0]],
+            ):
+            expected = self.expected(tags, 'all')
+
+            self.assertEqual(
+                self.get_ids('tags={0}&mode=all'.format(','.join(tags))),
+                expected,
+            )
+
+    def test_added(self):
+        """Test added events are found by their tags.
+        """
+
+        user, headers = self.make_user()
+        tags = self.tags[:2]
+
+        self.get_ids('tags={0}'.format(tags[0]))
+
+        response = self.client.post(
+            '/api/v0/addevent/',
+            data=json.dumps({
+                'type': 'event',
+                'name': u'New event',
+                'address': u'1 New St',
+                'tags': tags,
+            }),
+            headers=headers,
+        )
+
+        votable = json.loads(response.get_data(as_text=True))['votable']
+
+        self.assertIn(
+            votable['id'],
+            self.get_ids('tags={0}&mode=all'.format(','.join(tags))),
+        )
+
+    def test_invalid(self):
+        """Test invalid tags and modes are rejected.
+        """
+
+        for query in (
+                'tags=bad',
+                'tags=',
+                'tags={0}&mode=some'.format(self.tags[0]),
+                'tags={0}&near=0,0'.format(self.tags[0]),
+            ):
+            response, data = self.get_json(
+                '/api/v0/suggestions/?{0}'.format(query)
+            )
+
+            self.assertEqual(response.status_code, 400)
+
+
+class TestTaggedSuggestionsByQuery(TestTaggedSuggestions):
+    """Test filtering the suggestions by tag without the tag index.
+    """
+
+    tag_index = 'no'
+
+
+class TestPersonalizedSuggestions(APITestCase):
+    """Test the suggestions ranked by a user's votes with the tag index.
+    """
+
+    tag_index = 'yes'
+
+    def setUp(self):
+        """Set whether to use the tag index, and add some votables with new
+        tags.
+        """
+
+        super(TestPersonalizedSuggestions, self).setUp()
+
+        self.oldconfig = dict(app.iniconfig.items('apiserver'))
+
+        app.iniconfig.set('apiserver', 'tag_index', self.tag_index)
+
+        self.spelunking = Tag(id=uuid.uuid4(), name=u'spelunking')
+        self.origami = Tag(id=uuid.uuid4(), name=u'origami')
+        rawloc = RawLocation(id=uuid.uuid4(), address=u'1 Hobby Ln')
+
+        db.session.add_all([self.spelunking, self.origami, rawloc])
+
+        self.votables = {}
+
+        for name, cls, tags in (
+                ('voted_spelunking', Location, [self.spelunking]),
+                ('voted_origami', Location, [self.origami]),
+                ('both', Location, [self.spelunking, self.origami]),
+                ('spelunking_location', Location, [self.spelunking]),
+                ('spelunking_event', Event, [self.spelunking]),
+                ('origami', Event, [self.origami]),
+                ('untagged', Location, []),
+            ):
+            votable = cls(id=uuid.uuid4(), name=name, rawlocation=rawloc)
+            votable.tags.extend(tag.id for tag in tags)
+
+            db.session.add(votable)
+            self.votables[name] = str(votable.id)
+
+        db.session.commit()
+
+        self.origami = str(self.origami.id)
+
+        db.session.expunge_all()
+
+        self.user, self.headers = self.make_user()
+
+    def tearDown(self):
+        """Restore the configuration.
+        """
+
+        app.iniconfig.set('apiserver', 'tag_index', self.oldconfig['tag_index'])
+
+        super(TestPersonalizedSuggestions, self).tearDown()
+
+    def vote(self, name, times):
+        """Vote for one of the votables.
+        """
+
+        for i in range(times):
+            response, data = self.get_json(
+                '/api/v0/vote/{0}/'.format(self.votables[name]),
+                headers=self.headers,
+            )
+
+            self.assertEqual(response.status_code, 200)
+
+    def get_order(self):
+        """Get the IDs of the personalized suggestions in order.
+        """
+
+        response, data = self.get_json(
+            '/api/v0/suggestions/personalized/',
+            headers=self.headers,
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(data['next'])
+
+        for item in data['order']:
+            self.assertIn(item['id'], data[item['section']])
+
+        return [item['id'] for item in data['order']]
+
+    def test_personalized(self):
+        """Test the suggestions are ranked by the user's tag affinity.
+        """
+
+        self.vote('voted_spelunking', 2)
+        self.vote('voted_origami', 1)
+
+        order = self.get_order()
+
+        self.assertEqual(order[0], self.votables['both'])
+        self.assertEqual(
+            sorted(order[1:3]),
+            sorted([
+                self.votables['spelunking_location'],
+                self.votables['spelunking_event'],
+            ]),
+        )
+        self.assertEqual(order[3:], [self.votables['origami']])
+
+    def test_added(self):
+        """Test newly added votables are scored.
+        """
+
+        self.get_order()
+        self.vote('voted_origami', 1)
+
+        response = self.client.post(
+            '/api/v0/addevent/',
+            data=json.dumps({
+                'type': 'event',
+                'name': u'Folding',
+                'address': u'2 Hobby Ln',
+                'tags': [self.origami],
+            }),
+            headers=self.headers,
+        )
+
+        added = json.loads(response.get_data(as_text=True))['votable']['id']
+
+        self.assertIn(added, self.get_order())
+
+    def test_recommendations(self):
+        """Test stored recommendations come before tag affinity.
+        """
+
+        self.vote('voted_spelunking', 1)
+
+        for rank, name in enumerate(('origami', 'voted_origami', 'untagged')):
+            db.session.add(Recommendation(
+                user_id=self.user.id,
+                rank=rank,
+                votable_id=uuid.UUID(self.votables[name]),
+                score=3.0 - rank,
+            ))
+
+        db.session.commit()
+
+        self.assertEqual(
+            self.get_order(),
+            [
+                self.votables['origami'],
+                self.votables['voted_origami'],
+                self.votables['untagged'],
+            ],
+        )
+
+    def test_recommendations_voted(self):
+        """Test recommendations the user has voted for since are left out.
+        """
+
+        for rank, name in enumerate(('origami', 'voted_origami', 'untagged')):
+            db.session.add(Recommendation(
+                user_id=self.user.id,
+                rank=rank,
+                votable_id=uuid.UUID(self.votables[name]),
+                score=3.0 - rank,
+            ))
+
+        db.session.commit()
+
+        self.vote('voted_origami', 1)
+
+        self.assertEqual(
+            self.get_order(),
+            [self.votables['origami'], self.votables['untagged']],
+        )
+
+    def test_no_votes(self):
+        """Test users without votes get the regular suggestions.
+        """
+
+        self.assertTrue(self.get_order())
+
+    def test_unauthorized(self):
+        """Test the personalized suggestions need authorization.
+        """
+
+        response = self.client.get('/api/v0/suggestions/personalized/')
+
+        self.assertEqual(response.status_code, 401)
+
+
+class TestPersonalizedSuggestionsByQuery(TestPersonalizedSuggestions):
+    """Test the suggestions ranked by a user's votes without the tag index.
+    """
+
+    tag_index = 'no'
+
+    def test_no_index(self):
+        """Test the tag index isn't built.
+        """
+
+        self.vote('voted_origami', 1)
+
+        self.assertEqual(
+            sorted(self.get_order()),
+            sorted([self.votables['both'], self.votables['origami']]),
+        )
+        self.assertIsNone(hapcat.tagindex.tag_index._built)
+
+
+class TestSearch(APITestCase):
+    """Test searching the events and locations.
+    """
+
+    def setUp(self):
+        """Add some events and locations to search for.
+        """
+
+        super(TestSearch, self).setUp()
+
+        tag = Tag(id=uuid.uuid4(), name=u'zymurgy')
+        harbor = RawLocation(id=uuid.uuid4(), address=u'12 Quayside Rd')
+        main = RawLocation(id=uuid.uuid4(), address=u'3 Main St')
+
+        self.cafe = Location(
+            id=uuid.uuid4(),
+            name=u'Blue Door Cafe',
+            rawlocation=harbor,
+        )
+        self.grill = Location(
+            id=uuid.uuid4(),
+            name=u'Quayside Grill',
+            rawlocation=main,
+        )
+        self.trivia = Event(
+            id=uuid.uuid4(),
+            name=u'Trivia Night',
+            rawlocation=harbor,
+        )
+
+        db.session.add(tag)
+        db.session.add_all([self.cafe, self.grill, self.trivia])
+        self.trivia.tags.append(tag.id)
+        db.session.commit()
+
+        self.cafe, self.grill, self.trivia = (
+            str(votable.id)
+            for votable in (self.cafe, self.grill, self.trivia)
+        )
+
+        db.session.expunge_all()
+
+    def search(self, query):
+        """Search for the given query, returning the result IDs in order.
+        """
+
+        response, data = self.get_json(
+            '/api/v0/search/?q={0}'.format(query)
+        )
+
+        self.assertEqual(response.status_code, 200)
+
+        for item in data['order']:
+            self.assertIn(item['id'], data[item['section']])
+
+        return [item['id'] for item in data['order']]
+
+    def test_search(self):
+        """Test searching by name, address, and tag name.
+        """
+
+        self.assertEqual(self.search('blue'), [self.cafe])
+        self.assertEqual(self.search('zymurgy'), [self.trivia])
+        self.assertEqual(self.search('cafe quayside'), [self.cafe])
+        self.assertEqual(self.search('nothingmatchesthis'), [])
+
+    def test_ranking(self):
+        """Test matches by name come before matches by address.
+        """
+
+        results = self.search('quayside')
+
+        self.assertEqual(results[0], self.grill)
+        self.assertEqual(
+            sorted(results[1:]),
+            sorted([self.cafe, self.trivia]),
+        )
+
+    def test_prefix(self):
+        """Test the last word of the query matches as a prefix.
+        """
+
+        self.assertEqual(self.search('quay')[0], self.grill)
+        self.assertEqual(self.search('trivia nig'), [self.trivia])
+        self.assertEqual(self.search('triv night'), [])
+
+    def test_pages(self):
+        """Test paging through the results sees each match once.
+        """
+
+        self.add_votables(7)
+
+        seen = []
+        url = '/api/v0/search/?q=test+st&limit=3'
+
+        while url is not None:
+            response, data = self.get_json(url)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(data['order']), 3)
+
+            seen.extend(item['id'] for item in data['order'])
+
+            if data['next'] is None:
+                url = None
+            else:
+                url = '/api/v0/search/?q=test+st&limit=3&cursor={0}'.format(
+                    data['next'],
+                )
+
+        expected = [
+            str(votableid)
+            for cls in (Location, Event)
+            for (votableid,) in db.session.query(cls.id).join(
+                cls.rawlocation
+            ).filter(
+                RawLocation.address.like(u'% Test St')
+            )
+        ]
+
+        self.assertEqual(len(expected), 14)
+        self.assertEqual(sorted(seen), sorted(expected))
+
+    def test_changes(self):
+        """Test added, renamed, and deleted votables are reindexed.
+        """
+
+        user, headers = self.make_user()
+
+        response = self.client.post(
+            '/api/v0/addevents/',
+            data=json.dumps([{
+                'type': 'location',
+                'name': u'Ptarmigan Diner',
+                'address': u'9 Quayside Rd',
+            }]),
+            headers=headers,
+        )
+
+        self.assertEqual(response.status_code, 200)
+
+        added = json.loads(
+            response.get_data(as_text=True)
+        )['results'][0]['votable']['id']
+
+        self.assertEqual(self.search('ptarmigan'), [added])
+
+        db.session.query(Location).get(uuid.UUID(self.cafe)).name = (
+            u'Red Door Bistro'
+        )
+        db.session.delete(db.session.query(Event).get(uuid.UUID(self.trivia)))
+        db.session.commit()
+
+        self.assertEqual(self.search('bistro'), [self.cafe])
+        self.assertEqual(self.search('blue'), [])
+        self.assertEqual(self.search('zymurgy'), [])
+
+    def test_tag_renamed(self):
+        """Test the votables carrying a renamed tag are reindexed.
+        """
+
+        db.session.query(Tag).filter(Tag.name == u'zymurgy').one().name = (
+            u'oenology'
+        )
+        db.session.commit()
+
+        self.assertEqual(self.search('oenology'), [self.trivia])
+        self.assertEqual(self.search('zymurgy'), [])
+
+    def test_invalid(self):
+        """Test invalid queries, limits, and cursors are rejected.
+        """
+
+        for query in (
+                '',
+                'q=',
+                'q=%22*%22',
+                'q=cafe&limit=0',
+                'q=cafe&cursor=bad',
+                'q=cafe&cursor=eyJvZmZzZXQiOiAtMX0',
+            ):
+            response, data = self.get_json(
+                '/api/v0/search/?{0}'.format(query)
+            )
+
+            self.assertEqual(response.status_code, 400)
+
+
+class TestMultiGet(APITestCase):
+    """Test getting several tags, locations, or events at once.
+    """
+
+    def test_multiget(self):
+        """Test the multi-get endpoints match the single ones.
+        """
+
+        for section, cls in [
+                ('tags', Tag),
+                ('locations', RawLocation),
+                ('events', Event),
+            ]:
+            single = section[:-1]
+            ids = [str(objid) for (objid,) in db.session.query(cls.id)]
+            missing = str(uuid.uuid4())
+
+            with count_queries() as statements:
+                response, data = self.get_json(
+                    '/api/v0/{0}/?ids={1}'.format(
+                        section,
+                        ','.join(ids + [missing, 'bad']),
+                    )
+                )
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(sorted(data['found']), sorted(ids))
+            self.assertEqual(data['missing'], [missing])
+            self.assertEqual(data['invalid'], ['bad'])
+            self.assertLessEqual(len(statements), 3)
+
+            for objid in ids[:3]:
+                response, obj = self.get_json(
+                    '/api/v0/{0}/{1}'.format(single, objid)
+                )
+
+                self.assertEqual(data['found'][objid], obj)
+
+    def test_multiget_too_many(self):
+        """Test requests for too many IDs are rejected.
+        """
+
+        maxids = app.iniconfig.getint('apiserver', 'max_multiget_ids')
+
+        response, data = self.get_json(
+            '/api/v0/tags/?ids={0}'.format(
+                ','.join(str(uuid.uuid4()) for i in range(maxids + 1))
+            )
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+
+class TestPoolStats(APITestCase):
+    """Test the database connection pool statistics.
+    """
+
+    def setUp(self):
+        """Enable the statistics.
+        """
+
+        super(TestPoolStats, self).setUp()
+
+        app.iniconfig.set('apiserver', 'poolstats', 'yes')
+
+    def tearDown(self):
+        """Disable the statistics again.
+        """
+
+        app.iniconfig.set('apiserver', 'poolstats', 'no')
+
+        super(TestPoolStats, self).tearDown()
+
+    def test_poolstats(self):
+        """Test the statistics describe the answering process's pool.
+        """
+
+        response, data = self.get_json('/api/v0/poolstats/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['pid'], os.getpid())
+        self.assertEqual(data['pool'], type(db.engine.pool).__name__)
+
+        for key in [
+                'size',
+                'checked_in',
+                'checked_out',
+                'overflow',
+                'checkouts',
+                'timeouts',
+                'average_wait',
+                'max_wait',
+            ]:
+            self.assertIn(key, data)
+
+    def test_disabled(self):
+        """Test the statistics aren't served unless they're enabled.
+        """
+
+        app.iniconfig.set('apiserver', 'poolstats', 'no')
+
+        response, data = self.get_json('/api/v0/poolstats/')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('pid', data)
+
+
+class TestReplicas(APITestCase):
+    """Test reading from replicas.
+    """
+
+    def setUp(self):
+        """Set up two SQLite replicas, each with a tag named after it.
+        """
+
+        super(TestReplicas, self).setUp()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.tagid = uuid.uuid4()
+        self.urls = []
+
+        for name in ['a', 'b']:
+            url = 'sqlite:///{0}'.format(
+                os.path.join(self.tmpdir, '{0}.db'.format(name)),
+            )
+            engine = sqlalchemy.create_engine(url)
+            db.metadata.create_all(engine)
+
+            session = sqlalchemy.orm.Session(bind=engine)
+            session.add(Tag(id=self.tagid, name=name))
+            session.commit()
+            session.close()
+            engine.dispose()
+
+            self.urls.append(url)
+
+        self.oldurls = app.iniconfig.get('database', 'replica_urls')
+        self.use_replicas(self.urls)
+
+    def tearDown(self):
+        """Restore the replicas, and remove the replica databases.
+        """
+
+        self.use_replicas([self.oldurls])
+        shutil.rmtree(self.tmpdir)
+
+        super(TestReplicas, self).tearDown()
+
+    def use_replicas(self, urls):
+        """Configure the replicas.
+        """
+
+        app.iniconfig.set('database', 'replica_urls', ' '.join(urls))
+        hapcat.replicas.replicas.close()
+
+    def get_tag_name(self):
+        """Get the replicas' tag, returning its name, or ``None`` if it was
+        read from the primary, which doesn't have it.
+        """
+
+        # Each request would have its own session.
+        db.session.remove()
+
+        response, data = self.get_json(
+            '/api/v0/tag/{0}'.format(self.tagid),
+        )
+
+        return data.get('name')
+
+    def test_round_robin(self):
+        """Test reads take turns between the replicas.
+        """
+
+        names = [self.get_tag_name() for i in range(4)]
+
+        self.assertEqual(sorted(names), ['a', 'a', 'b', 'b'])
+        self.assertNotEqual(names[0], names[1])
+
+        app.iniconfig.set('apiserver', 'poolstats', 'yes')
+
+        try:
+            response, data = self.get_json('/api/v0/poolstats/')
+        finally:
+            app.iniconfig.set('apiserver', 'poolstats', 'no')
+
+        self.assertEqual(len(data['replicas']), 2)
+
+    def test_replica_down(self):
+        """Test replicas which are down are skipped, and the primary used if
+        they all are.
+        """
+
+        missing = 'sqlite:///{0}'.format(
+            os.path.join(self.tmpdir, 'missing', 'c.db'),
+        )
+
+        self.use_replicas([missing, self.urls[0]])
+
+        self.assertEqual(
+            [self.get_tag_name() for i in range(3)],
+            ['a', 'a', 'a'],
+        )
+
+        self.use_replicas([missing])
+
+        self.assertIsNone(self.get_tag_name())
+
+    def test_writes(self):
+        """Test writes go to the primary, and then reads stick to it.
+        """
+
+        user, headers = self.make_user()
+
+        self.assertIsNotNone(self.get_tag_name())
+
+        response = self.client.post(
+            '/api/v0/login/',
+            data=json.dumps({
+                'username': u'user',
+                'password': u'correct horse battery',
+            }),
+            content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            hapcat.replicas.COOKIE,
+            response.headers.get('Set-Cookie', ''),
+        )
+
+        self.assertIsNone(self.get_tag_name())
+
+    def test_unmarked(self):
+        """Test endpoints not marked read-only use the primary.
+        """
+
+        user, headers = self.make_user()
+        eventid = db.session.query(Event.id).first()[0]
+        db.session.remove()
+
+        response = self.client.get(
+            '/api/v0/vote/{0}/'.format(eventid),
+            headers=headers,
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            hapcat.replicas.COOKIE,
+            response.headers.get('Set-Cookie', ''),
+        )
+
+    def get_personalized(self, headers):
+        """Get the user's personalized suggestions, returning how many there
+        are, which is none if they were read from a replica.
+        """
+
+        db.session.remove()
+
+        response, data = self.get_json(
+            '/api/v0/suggestions/personalized/',
+            headers=headers,
+        )
+
+        self.assertEqual(response.status_code, 200)
+
+        return len(data['order'])
+
+    def test_identity_on_primary(self):
+        """Test token versions are read from the primary, which has the
+        user, rather than from a replica, which doesn't.
+        """
+
+        user, headers = self.make_user()
+        hapcat.identity.versions.clear()
+
+        self.assertEqual(self.get_personalized(headers), 0)
+
+    def test_user_sticks(self):
+        """Test a user's reads stick to the primary after they write, even
+        without the cookie.
+        """
+
+        user, headers = self.make_user()
+        eventid = db.session.query(Event.id).first()[0]
+
+        self.assertEqual(self.get_personalized(headers), 0)
+
+        db.session.remove()
+
+        response = self.client.get(
+            '/api/v0/vote/{0}/'.format(eventid),
+            headers=headers,
+        )
+
+        self.assertEqual(response.status_code, 200)
+
+        self.client.cookie_jar.clear()
+
+        self.assertGreater(self.get_personalized(headers), 0)
+
+        other, otherheaders = self.make_user(username=u'other')
+
+        self.assertEqual(self.get_personalized(otherheaders), 0)
+
+    def test_shared_caches(self):
+        """Test what's cached for every client is built from the primary,
+        even by a request reading from a replica, so clients whose reads
+        stick to the primary see its data.
+        """
+
+        self.make_user()
+
+        tagid = db.session.query(VotableTag.tag_id).first()[0]
+        events = min(
+            db.session.query(Event).count(),
+            app.iniconfig.getint('apiserver', 'suggestions_page_size'),
+        )
+
+        db.session.remove()
+
+        hapcat.feed.suggestions_feed.invalidate()
+        hapcat.tagindex.tag_index.invalidate()
+        hapcat.usernames.usernames.invalidate()
+
+        # These read from the replicas, which have none of it, and build the
+        # caches.
+        self.assertIsNotNone(self.get_tag_name())
+        self.get_json('/api/v0/suggestions/')
+        self.get_json('/api/v0/suggestions/?tags={0}'.format(tagid))
+        self.get_json('/api/v0/username-available/?username=user')
+
+        self.client.set_cookie('localhost', hapcat.replicas.COOKIE, '1')
+
+        self.assertIsNone(self.get_tag_name())
+
+        response, data = self.get_json('/api/v0/suggestions/')
+
+        self.assertEqual(len(data['events']), events)
+
+        response, data = self.get_json(
+            '/api/v0/suggestions/?tags={0}'.format(tagid),
+        )
+
+        self.assertTrue(data['order'])
+
+        response, data = self.get_json(
+            '/api/v0/username-available/?username=user',
+        )
+
+        self.assertFalse(data['available'])
+
+
+class TestConditionalGet(APITestCase):
+    """Test ETags and conditional GETs.
+    """
+
+    eventid = 'b0a28a40-b8ad-4131-8c64-071f3fd45bee'
+
+    def assertNotModified(self, url, **kwargs):
+        """Check a URL is only sent again once it's changed.
+        """
+
+        first = self.client.get(url, **kwargs)
+        etag = first.headers['ETag']
+
+        self.assertEqual(first.status_code, 200)
+
+        headers = dict(kwargs.pop('headers', {}))
+        headers['If-None-Match'] = etag
+
+        second = self.client.get(url, headers=headers, **kwargs)
+
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.get_data(), b'')
+        self.assertEqual(second.headers['ETag'], etag)
+
+        return etag
+
+    def test_serverinfo(self):
+        """Test the server info has a constant ETag.
+        """
+
+        self.assertNotModified('/api/v0/serverinfo/')
+
+    def test_entities(self):
+        """Test tags, locations, and events can be conditionally fetched.
+        """
+
+        for url in (
+                '/api/v0/tag/d927d94f-beb8-4295-ac78-5c00e6dc217c',
+                '/api/v0/location/cbedf9e2-4a1a-44b9-9e3f-6fe870405329',
+                '/api/v0/event/{0}'.format(self.eventid),
+            ):
+            self.assertNotModified(url)
+
+    def test_event_not_serialized(self):
+        """Test a matching event isn't serialized.
+        """
+
+        url = '/api/v0/event/{0}'.format(self.eventid)
+        etag = self.client.get(url).headers['ETag']
+
+        db.session.expunge_all()
+
+        with count_queries() as statements:
+            response = self.client.get(url, headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(statements), 1)
+
+    def test_event_changed(self):
+        """Test an event's ETag changes with its tags.
+        """
+
+        url = '/api/v0/event/{0}'.format(self.eventid)
+        etag = self.assertNotModified(url)
+
+        event = db.session.query(Event).get(uuid.UUID(self.eventid))
+        event.tags.remove(event.tags[0])
+        db.session.commit()
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_concurrent_updates(self):
+        """Test concurrent updates of an object both bump its version.
+        """
+
+        tagid = db.session.query(Tag.id).first()[0]
+        version = db.session.query(Tag.version).filter(Tag.id == tagid).scalar()
+        db.session.remove()
+
+        first = sqlalchemy.orm.Session(bind=db.engine)
+        second = sqlalchemy.orm.Session(bind=db.engine)
+
+        firsttag = first.query(Tag).get(tagid)
+        secondtag = second.query(Tag).get(tagid)
+
+        firsttag.name = u'first'
+        first.commit()
+
+        secondtag.name = u'second'
+        second.commit()
+
+        first.close()
+        second.close()
+
+        tag = db.session.query(Tag).get(tagid)
+
+        self.assertEqual(tag.name, u'second')
+        self.assertEqual(tag.version, version + 2)
+
+    def test_touch_unloaded(self):
+        """Test changing the tags of an event without its columns loaded.
+        """
+
+        event = db.session.query(Event).options(
+            sqlalchemy.orm.load_only('id'),
+        ).get(uuid.UUID(self.eventid))
+        version = db.session.query(Event.version).filter(
+            Event.id == event.id,
+        ).scalar()
+
+        event.tags.remove(event.tags[0])
+        db.session.commit()
+
+        self.assertEqual(event.version, version + 1)
+
+    def test_suggestions(self):
+        """Test the suggestions can be conditionally fetched.
+        """
+
+        plain = self.assertNotModified('/api/v0/suggestions/')
+        compressed = self.assertNotModified(
+            '/api/v0/suggestions/',
+            headers={'Accept-Encoding': 'gzip'},
+        )
+
+        self.assertNotEqual(plain, compressed)
+
+        hapcat.feed.suggestions_feed.invalidate()
+        self.add_votables(1)
+
+        response = self.client.get(
+            '/api/v0/suggestions/',
+            headers={'If-None-Match': plain},
+        )
+
+        self.assertEqual(response.status_code, 200)
+
+
+class TestAddEvents(APITestCase):
+    """Test adding events and locations.
+    """
+
+    def post_json(self, url, data, headers):
+        """POST the given JSON, returning the response and its JSON.
+        """
+
+        response = self.client.post(
+            url,
+            data=json.dumps(data),
+            headers=headers,
+        )
+
+        return response, json.loads(response.get_data(as_text=True))
+
+    def make_votables(self, count, tags):
+        """Make the JSON for the given number of events and locations.
+        """
+
+        return [
+            {
+                'type': 'event' if i % 2 else 'location',
+                'name': u'Votable {0}'.format(i),
+                'address': u'{0} Bulk St'.format(i // 2),
+                'tags': tags,
+                'photos': [
+                    u'http://example.com/shared.png',
+                    u'http://example.com/{0}.png'.format(i),
+                ],
+            }
+            for i in range(count)
+        ]
+
+    def test_addevent(self):
+        """Test adding a single event.
+        """
+
+        user, headers = self.make_user()
+        tag = str(db.session.query(Tag.id).first()[0])
+
+        response, data = self.post_json(
+            '/api/v0/addevent/',
+            {
+                'type': 'event',
+                'name': u'Event',
+                'address': u'1 Event St',
+                'tags': [tag],
+                'photos': [u'http://example.com/event.png'],
+            },
+            headers,
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['votable']['tags'], [tag])
+        self.assertEqual(
+            data['votable']['photos'],
+            [u'http://example.com/event.png'],
+        )
+
+        response, event = self.get_json(
+            '/api/v0/event/{0}'.format(data['votable']['id'])
+        )
+
+        self.assertEqual(event, data['votable'])
+
+    def test_addevent_invalid_tag(self):
+        """Test adding an event with a nonexistent tag fails.
+        """
+
+        user, headers = self.make_user()
+
+        response, data = self.post_json(
+            '/api/v0/addevent/',
+            {
+                'type': 'event',
+                'name': u'Event',
+                'address': u'1 Event St',
+                'tags': [str(uuid.uuid4())],
+            },
+            headers,
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'Invalid tag')
+
+    def test_addevents(self):
+        """Test adding events and locations in bulk.
+        """
+
+        user, headers = self.make_user()
+        tags = [str(tagid) for (tagid,) in db.session.query(Tag.id).limit(2)]
+
+        items = self.make_votables(4, tags)
+        items.append({'type': 'event', 'name': u'No address'})
+        items.append(dict(items[0], tags=[str(uuid.uuid4())]))
+
+        response, data = self.post_json('/api/v0/addevents/', items, headers)
+
+        self.assertEqual(response.status_code, 200)
+
+        results = data['results']
+
+        self.assertEqual(
+            [result['success'] for result in results],
+            [True, True, True, True, False, False],
+        )
+        self.assertEqual(results[4]['message'], 'Invalid request JSON')
+        self.assertEqual(results[5]['message'], 'Invalid tag')
+
+        for item, result in zip(items, results[:4]):
+            votable = result['votable']
+
+            self.assertEqual(votable['type'], item['type'])
+            self.assertEqual(votable['name'], item['name'])
+            self.assertEqual(sorted(votable['tags']), sorted(tags))
+            self.assertEqual(sorted(votable['photos']), sorted(item['photos']))
+
+        # Pairs of events and locations share an address.
+        response, rawlocation = self.get_json(
+            '/api/v0/location/{0}'.format(results[1]['votable']['location'])
+        )
+
+        self.assertEqual(
+            results[0]['votable']['address'],
+            rawlocation['address'],
+        )
+
+        response, event = self.get_json(
+            '/api/v0/event/{0}'.format(results[1]['votable']['id'])
+        )
+
+        self.assertEqual(event, results[1]['votable'])
+
+    def test_addevents_same_photo(self):
+        """Test photo URLs written differently are stored once.
+        """
+
+        user, headers = self.make_user()
+
+        ids = set()
+
+        for url in (
+                u'http://Example.com:80/same photo.png',
+                u'http://example.com/same%20photo.png',
+            ):
+            response, data = self.post_json(
+                '/api/v0/addevents/',
+                [{
+                    'type': 'event',
+                    'name': u'Event',
+                    'address': u'1 Photo St',
+                    'photos': [url],
+                }],
+                headers,
+            )
+
+            self.assertTrue(data['results'][0]['success'])
+
+            ids.update(
+                photoid
+                for (photoid,) in db.session.query(Photo.id).filter(
+                    Photo.photourl == u'http://example.com/same%20photo.png'
+                )
+            )
+
+        self.assertEqual(len(ids), 1)
+        self.assertEqual(
+            data['results'][0]['votable']['photos'],
+            [u'http://example.com/same%20photo.png'],
+        )
+
+    def test_addevents_added_meanwhile(self):
+        """Test addresses and photos inserted by others meanwhile are used.
+        """
+
+        rawlocation = RawLocation(id=uuid.uuid4(), address=u'1 Race St')
+        photo = Photo(id=uuid.uuid4(), photourl=u'http://example.com/race.png')
+
+        db.session.add_all([rawlocation, photo])
+        db.session.commit()
+
+        objects = db.session.query(UUIDObject).count()
+
+        rawlocs = hapcat.dbutil._insert_unique(
+            db.session,
+            RawLocation,
+            'address',
+            [
+                {'id': uuid.uuid4(), 'address': u'1 Race St'},
+                {'id': uuid.uuid4(), 'address': u'2 Race St'},
+            ],
+        )
+        photos = hapcat.dbutil._insert_unique(
+            db.session,
+            Photo,
+            'photourl',
+            [{'id': uuid.uuid4(), 'photourl': u'http://example.com/race.png'}],
+            key=hapcat.dbutil.normalize_url,
+        )
+        db.session.commit()
+
+        self.assertEqual(rawlocs[u'1 Race St'], rawlocation.id)
+        self.assertEqual(photos[u'http://example.com/race.png'], photo.id)
+
+        # Only the new address was added.
+        self.assertEqual(db.session.query(UUIDObject).count(), objects + 1)
+
+    def test_addevents_query_count(self):
+        """Test the number of queries doesn't grow with the items added.
+        """
+
+        user, headers = self.make_user()
+        tags = [str(tagid) for (tagid,) in db.session.query(Tag.id).limit(2)]
+
+        # Cache the user's token version first, so both requests are alike.
+        self.get_json('/debug/protectedtest/', headers=headers)
+
+        with count_queries() as few:
+            self.post_json(
+                '/api/v0/addevents/',
+                self.make_votables(2, tags),
+                headers,
+            )
+
+        with count_queries() as many:
+            response, data = self.post_json(
+                '/api/v0/addevents/',
+                self.make_votables(20, tags),
+                headers,
+            )
+
+        self.assertTrue(all(result['success'] for result in data['results']))
+        self.assertEqual(len(few), len(many))
+
+
+class TestLogin(APITestCase):
+    """Test registering and logging in.
+    """
+
+    def setUp(self):
+        """Use a single hashing thread, and give up on it quickly.
+        """
+
+        super(TestLogin, self).setUp()
+
+        self.oldconfig = dict(app.iniconfig.items('apiserver'))
+
+        app.iniconfig.set('apiserver', 'hash_workers', '1')
+        app.iniconfig.set('apiserver', 'hash_queue_timeout', '0.1')
+
+        self.oldpasswords = dict(app.iniconfig.items('passwords'))
+
+        hapcat.hashing.passwords = hapcat.hashing.PasswordHasher()
+
+    def tearDown(self):
+        """Restore the configuration.
+        """
+
+        for key in ('hash_workers', 'hash_queue_timeout'):
+            app.iniconfig.set('apiserver', key, self.oldconfig[key])
+
+        for key, value in self.oldpasswords.items():
+            app.iniconfig.set('passwords', key, value)
+
+        hapcat.hashing.passwords = hapcat.hashing.PasswordHasher()
+
+        super(TestLogin, self).tearDown()
+
+    def post_json(self, url, data):
+        """POST the given JSON, returning the response and its JSON.
+        """
+
+        response = self.client.post(url, data=json.dumps(data))
+
+        return response, json.loads(response.get_data(as_text=True))
+
+    def register(self, username, password):
+        """Register a user.
+        """
+
+        return self.post_json(
+            '/api/v0/register/',
+            {
+                'username': username,
+                'password': password,
+                'email': u'{0}@example.com'.format(username),
+                'date_of_birth': {'year': 1999, 'month': 9, 'day': 9},
+            },
+        )
+
+    def login(self, username, password):
+        """Log in as a user.
+        """
+
+        return self.post_json(
+            '/api/v0/login/',
+            {
+                'username': username,
+                'password': password,
+            },
+        )
+
+    @contextlib.contextmanager
+    def busy(self):
+        """Keep the hashing thread busy inside the block.
+        """
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            started.set()
+            release.wait()
+
+        thread = threading.Thread(
+            target=hapcat.hashing.passwords.run,
+            args=(hold,),
+        )
+        thread.start()
+        started.wait()
+
+        try:
+            yield
+        finally:
+            release.set()
+            thread.join()
+
+    def test_login(self):
+        """Test logging in with the password registered with.
+        """
+
+        password = u'correct horse battery staple'
+
+        response, data = self.register(u'user', password)
+
+        self.assertEqual(response.status_code, 200)
+
+        response, data = self.login(u'user', password)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['access_token'])
+
+        response, data = self.login(u'user', password + u'!')
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_long_password(self):
+        """Test registering with a password too long for zxcvbn to check.
+        """
+
+        password = u'correct horse battery staple ' * 10
+
+        response, data = self.register(u'user', password)
+
+        self.assertEqual(response.status_code, 200)
+
+        response, data = self.login(u'user', password)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_rehash(self):
+        """Test passwords are rehashed with newer costs when logging in.
+        """
+
+        password = u'correct horse battery staple'
+
+        self.register(u'user', password)
+
+        app.iniconfig.set('passwords', 'argon2_time_cost', '1')
+        app.iniconfig.set('passwords', 'argon2_memory_cost', '1024')
+        app.iniconfig.set('passwords', 'argon2_parallelism', '1')
+
+        response, data = self.login(u'user', password)
+
+        self.assertEqual(response.status_code, 200)
+
+        db.session.remove()
+        hashed = passlib.hash.argon2.from_string(
+            User.query.filter_by(username=u'user').one().password.hash
+        )
+
+        self.assertEqual(hashed.rounds, 1)
+        self.assertEqual(hashed.memory_cost, 1024)
+        self.assertEqual(hashed.parallelism, 1)
+
+        response, data = self.login(u'user', password)
+
+        self.assertEqual(response.status_code, 200)
+
+        response, data = self.login(u'user', password + u'!')
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_concurrent_rehash(self):
+        """Test logins rehashing the same password at once both succeed.
+        """
+
+        password = u'correct horse battery staple'
+
+        self.register(u'user', password)
+
+        app.iniconfig.set('passwords', 'argon2_time_cost', '1')
+        app.iniconfig.set('passwords', 'argon2_memory_cost', '1024')
+        app.iniconfig.set('passwords', 'argon2_parallelism', '1')
+
+        db.session.remove()
+
+        first = sqlalchemy.orm.Session(bind=db.engine)
+        second = sqlalchemy.orm.Session(bind=db.engine)
+
+        firstuser = first.query(User).filter_by(username=u'user').one()
+        seconduser = second.query(User).filter_by(username=u'user').one()
+
+        self.assertTrue(hapcat.hashing.passwords.check(firstuser, password))
+        first.commit()
+
+        self.assertTrue(hapcat.hashing.passwords.check(seconduser, password))
+        second.commit()
+
+        first.close()
+        second.close()
+
+        hashed = passlib.hash.argon2.from_string(
+            User.query.filter_by(username=u'user').one().password.hash
+        )
+
+        self.assertEqual(hashed.rounds, 1)
+
+        response, data = self.login(u'user', password)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_duplicate(self):
+        """Test taken usernames are refused without hashing the password.
+        """
+
+        password = u'correct horse battery staple'
+
+        self.register(u'user', password)
+
+        with self.busy():
+            response, data = self.register(u'user', password)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(data['message'], u'Username already exists')
+
+    def test_duplicate_elsewhere(self):
+        """Test usernames taken since the filter was built are still refused.
+        """
+
+        password = u'correct horse battery staple'
+
+        self.get_json('/api/v0/username-available/?username=user')
+        self.make_user(u'user')
+
+        response, data = self.register(u'user', password)
+
+        self.assertEqual(response.status_code, 409)
+
+    def test_username_available(self):
+        """Test checking usernames before registering them.
+        """
+
+        response, data = self.get_json(
+            '/api/v0/username-available/?username=user',
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, {'username': u'user', 'available': True})
+
+        self.register(u'user', u'correct horse battery staple')
+
+        response, data = self.get_json(
+            '/api/v0/username-available/?username=user',
+        )
+
+        self.assertEqual(data, {'username': u'user', 'available': False})
+
+        response, data = self.get_json('/api/v0/username-available/')
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_busy(self):
+        """Test logins and registrations give up while hashing is busy.
+        """
+
+        password = u'correct horse battery staple'
+
+        self.register(u'user', password)
+
+        with self.busy():
+            response, data = self.login(u'user', password)
+
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+
+            response, data = self.register(u'other', password)
+
+            self.assertEqual(response.status_code, 503)
+
+        # The read endpoints aren't affected.
+        with self.busy():
+            response, data = self.get_json('/api/v0/suggestions/')
+
+            self.assertEqual(response.status_code, 200)
+
+        response, data = self.login(u'user', password)
+
+        self.assertEqual(response.status_code, 200)
+
+
+class TestIdentity(APITestCase):
+    """Test identifying users by their tokens' claims.
+    """
+
+    def protected(self, headers):
+        """GET the protected test endpoint.
+        """
+
+        return self.get_json('/debug/protectedtest/', headers=headers)
+
+    def test_claims(self):
+        """Test the user isn't loaded once their token version is cached.
+        """
+
+        user, headers = self.make_user()
+
+        response, data = self.protected(headers)
+
+        self.assertEqual(response.status_code, 200)
+
+        with count_queries() as statements:
+            response, data = self.protected(headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['id'], str(user.id))
+        self.assertEqual(data['username'], u'user')
+        self.assertEqual(statements, [])
+
+    def test_logout(self):
+        """Test logging out revokes the user's tokens.
+        """
+
+        user, headers = self.make_user()
+        user, otherheaders = self.make_user(u'other')
+
+        response = self.client.post('/api/v0/logout/', headers=headers)
+
+        self.assertEqual(response.status_code, 200)
+
+        response, data = self.protected(headers)
+
+        self.assertEqual(response.status_code, 401)
+
+        # Other users' tokens still work.
+        response, data = self.protected(otherheaders)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_revoked_in_other_process(self):
+        """Test revocations elsewhere are seen once the cache expires.
+        """
+
+        user, headers = self.make_user()
+        userid = user.id
+
+        self.assertEqual(self.protected(headers)[0].status_code, 200)
+
+        db.session.query(User).filter(User.id == userid).update(
+            {'token_version': User.token_version + 1},
+        )
+        db.session.commit()
+
+        # The cached version is trusted until it expires.
+        self.assertEqual(self.protected(headers)[0].status_code, 200)
+
+        hapcat.identity.versions.clear()
+
+        self.assertEqual(self.protected(headers)[0].status_code, 401)
+
+    def test_revoked_during_lookup(self):
+        """Test a lookup which read the old version doesn't undo a
+        revocation made meanwhile.
+        """
+
+        user, headers = self.make_user()
+        userid = user.id
+
+        hapcat.identity.versions.clear()
+
+        current_version = hapcat.identity.current_version
+        looked_up = threading.Event()
+        revoked = threading.Event()
+
+        def slow_version(session, user_id):
+            version = current_version(session, user_id)
+
+            if threading.current_thread() is lookup:
+                looked_up.set()
+                revoked.wait(10)
+
+            return version
+
+        def look_up():
+            session = sqlalchemy.orm.Session(bind=db.engine)
+
+            try:
+                hapcat.identity.versions.get(session, userid)
+            finally:
+                session.close()
+
+        lookup = threading.Thread(target=look_up)
+        hapcat.identity.current_version = slow_version
+
+        try:
+            lookup.start()
+
+            self.assertTrue(looked_up.wait(10))
+
+            hapcat.identity.revoke(db.session, userid)
+        finally:
+            revoked.set()
+            lookup.join(10)
+            hapcat.identity.current_version = current_version
+
+        self.assertEqual(self.protected(headers)[0].status_code, 401)
+
+    def test_legacy_token(self):
+        """Test tokens without the claims still work, until revoked.
+        """
+
+        user, headers = self.make_user()
+        userid = user.id
+
+        token = jwt.jwt_encode_callback(user)
+        payload = jwt.jwt_decode_callback(token)
+
+        del payload['username']
+        del payload['version']
+
+        token = flask_jwt.jwt.encode(
+            payload,
+            app.config['SECRET_KEY'],
+            algorithm=app.config['JWT_ALGORITHM'],
+        )
+
+        if not isinstance(token, str):
+            token = token.decode('ascii')
+
+        headers = {'Authorization': 'JWT {0}'.format(token)}
+
+        response, data = self.protected(headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['username'], u'user')
+
+        hapcat.identity.revoke(db.session, userid)
+
+        self.assertEqual(self.protected(headers)[0].status_code, 401)
+
+    def test_deleted_user(self):
+        """Test deleted users' tokens are refused.
+        """
+
+        user, headers = self.make_user()
+
+        db.session.delete(user)
+        db.session.commit()
+
+        self.assertEqual(self.protected(headers)[0].status_code, 401)
+
+
+class TestVote(APITestCase):
+    """Test the vote endpoint.
+    """
+
+    def test_vote(self):
+        """Test votes are counted per user and votable.
+        """
+
+        user, headers = self.make_user()
+        other, otherheaders = self.make_user(username=u'other')
+
+        locations = [
+            str(locid)
+            for (locid,) in db.session.query(Location.id).limit(2)
+        ]
+
+        url = '/api/v0/vote/{0}/'
+
+        for i in range(3):
+            response, data = self.get_json(
+                url.format(locations[0]),
+                headers=headers,
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['numvotes'], 3)
+        self.assertEqual(data['username'], u'user')
+
+        response, data = self.get_json(
+            url.format(locations[1]),
+            headers=headers,
+        )
+
+        self.assertEqual(data['numvotes'], 1)
+
+        response, data = self.get_json(
+            url.format(locations[0]),
+            headers=otherheaders,
+        )
+
+        self.assertEqual(data['numvotes'], 1)
+
+    def test_vote_updated(self):
+        """Test votes record when they were last added to.
+        """
+
+        user, headers = self.make_user()
+        userid = user.id
+
+        location = db.session.query(Location.id).first()[0]
+        url = '/api/v0/vote/{0}/'.format(location)
+
+        def updated():
+            return db.session.query(Vote.updated).filter(
+                Vote.votable_id == location,
+                Vote.user_id == userid,
+            ).scalar()
+
+        before = time.time()
+        self.get_json(url, headers=headers)
+        db.session.commit()
+
+        self.assertGreaterEqual(updated(), before)
+
+        db.session.query(Vote).update(
+            {Vote.updated: 0},
+            synchronize_session=False,
+        )
+        db.session.commit()
+
+        self.get_json(url, headers=headers)
+        db.session.commit()
+
+        self.assertGreaterEqual(updated(), before)
+
+    def test_vote_invalid(self):
+        """Test votes for invalid or nonexistent votables fail.
+        """
+
+        user, headers = self.make_user()
+
+        response, data = self.get_json(
+            '/api/v0/vote/{0}/'.format(uuid.uuid4()),
+            headers=headers,
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'No such votable')
+
+        response, data = self.get_json(
+            '/api/v0/vote/bad/',
+            headers=headers,
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'Invalid UUID')
+
+    def test_vote_deleted_user(self):
+        """Test votes by a user deleted since their token was checked fail.
+        """
+
+        user, headers = self.make_user()
+        userid = user.id
+
+        location = str(db.session.query(Location.id).first()[0])
+        url = '/api/v0/vote/{0}/'.format(location)
+
+        response, data = self.get_json(url, headers=headers)
+
+        self.assertEqual(response.status_code, 200)
+
+        db.session.delete(user)
+        db.session.commit()
+
+        response, data = self.get_json(url, headers=headers)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'No such user')
+        self.assertEqual(
+            db.session.query(Vote).filter(Vote.user_id == userid).count(),
+            0,
+        )
+
+    def test_vote_without_upsert(self):
+        """Test votes are counted on SQLite versions without upserts.
+        """
+
+        sqlite_upsert = hapcat.dbutil.sqlite_upsert
+        vote_upserts = dict(hapcat.dbutil._vote_upserts)
+
+        def restore():
+            hapcat.dbutil.sqlite_upsert = sqlite_upsert
+            hapcat.dbutil._vote_upserts.clear()
+            hapcat.dbutil._vote_upserts.update(vote_upserts)
+
+        self.addCleanup(restore)
+
+        hapcat.dbutil.sqlite_upsert = False
+        hapcat.dbutil._vote_upserts.clear()
+
+        user, headers = self.make_user()
+        userid = user.id
+
+        location = str(db.session.query(Location.id).first()[0])
+
+        for i in range(2):
+            response, data = self.get_json(
+                '/api/v0/vote/{0}/'.format(location),
+                headers=headers,
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['numvotes'], 2)
+        self.assertIsNotNone(
+            db.session.query(Vote.updated).filter(
+                Vote.user_id == userid,
+            ).scalar()
+        )
+
+        response, data = self.get_json(
+            '/api/v0/vote/{0}/'.format(uuid.uuid4()),
+            headers=headers,
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'No such votable')
+
+
+class TestBatchVote(APITestCase):
+    """Test the batch vote endpoint.
+    """
+
+    def post_votes(self, votes, headers):
+        """POST the given votes, returning the response and its JSON.
+        """
+
+        response = self.client.post(
+            '/api/v0/votes/',
+            data=json.dumps({'votes': votes}),
+            headers=headers,
+        )
+
+        return response, json.loads(response.get_data(as_text=True))
+
+    def test_batch_vote(self):
+        """Test each vote in a batch gets its own result.
+        """
+
+        user, headers = self.make_user()
+
+        locations = [
+            str(locid)
+            for (locid,) in db.session.query(Location.id).limit(2)
+        ]
+
+        with count_queries() as statements:
+            response, data = self.post_votes(
+                [
+                    {'votable': locations[0], 'count': 2},
+                    {'votable': locations[1]},
+                    {'votable': str(uuid.uuid4())},
+                    {'votable': 'bad'},
+                    {'votable': locations[1], 'count': 0},
+                    {'votable': locations[0]},
+                ],
+                headers,
+            )
+
+        self.assertEqual(response.status_code, 200)
+
+        results = data['results']
+
+        self.assertEqual(
+            [result['success'] for result in results],
+            [True, True, False, False, False, True],
+        )
+        self.assertEqual(results[0]['numvotes'], 3)
+        self.assertEqual(results[1]['numvotes'], 1)
+        self.assertEqual(results[2]['message'], 'No such votable')
+        self.assertEqual(results[3]['message'], 'Invalid UUID')
+        self.assertEqual(results[4]['message'], 'Invalid count')
+        self.assertEqual(results[5]['numvotes'], 3)
+
+        # The user, the votables, the votes, and the totals.
+        self.assertLessEqual(len(statements), 4)
+
+        response, data = self.post_votes(
+            [{'votable': locations[0]}],
+            headers,
+        )
+
+        self.assertEqual(data['results'][0]['numvotes'], 4)
+
+    def test_batch_vote_large_count(self):
+        """Test counts adding up to too many votes are rejected.
+        """
+
+        user, headers = self.make_user()
+
+        location = str(db.session.query(Location.id).first()[0])
+        maxvotes = app.iniconfig.getint('apiserver', 'max_batch_votes')
+
+        for votes in (
+                [{'votable': location, 'count': 10 ** 20}],
+                [
+                    {'votable': location, 'count': maxvotes},
+                    {'votable': location},
+                ],
+            ):
+            response, data = self.post_votes(votes, headers)
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(data['message'], 'Too many votes')
+
+        response, data = self.post_votes(
+            [{'votable': location, 'count': maxvotes}],
+            headers,
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['results'][0]['numvotes'], maxvotes)
+
+    def test_batch_vote_deleted_user(self):
+        """Test batches by a user deleted since their token was checked fail.
+        """
+
+        user, headers = self.make_user()
+
+        location = str(db.session.query(Location.id).first()[0])
+
+        response, data = self.post_votes([{'votable': location}], headers)
+
+        self.assertEqual(response.status_code, 200)
+
+        db.session.delete(user)
+        db.session.commit()
+
+        response, data = self.post_votes([{'votable': location}], headers)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'No such user')
+
+    def test_batch_vote_too_many(self):
+        """Test batches over the configured size are rejected.
+        """
+
+        user, headers = self.make_user()
+
+        maxvotes = app.iniconfig.getint('apiserver', 'max_batch_votes')
+
+        response, data = self.post_votes(
+            [{'votable': str(uuid.uuid4())}] * (maxvotes + 1),
+            headers,
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'Too many votes')
+
+
+class TestBufferedVote(APITestCase):
+    """Test the vote endpoint with buffered votes.
+    """
+
+    def setUp(self):
+        """Enable buffered votes, without flushing in the background.
+        """
+
+        super(TestBufferedVote, self).setUp()
+
+        self.oldconfig = dict(app.iniconfig.items('apiserver'))
+
+        app.iniconfig.set('apiserver', 'buffer_votes', 'yes')
+        app.iniconfig.set('apiserver', 'vote_flush_interval', '3600')
+
+        hapcat.votebuffer.votes = hapcat.votebuffer.VoteBuffer()
+
+    def tearDown(self):
+        """Restore the configuration.
+        """
+
+        for key in ('buffer_votes', 'vote_flush_interval'):
+            app.iniconfig.set('apiserver', key, self.oldconfig[key])
+
+        super(TestBufferedVote, self).tearDown()
+
+    def test_buffered_vote(self):
+        """Test votes are projected, and only written when flushed.
+        """
+
+        user, headers = self.make_user()
+
+        location = str(db.session.query(Location.id).first()[0])
+        url = '/api/v0/vote/{0}/'.format(location)
+
+        db.session.add(Vote(votable_id=location, user_id=user.id, numvotes=2))
+        db.session.commit()
+
+        for i in range(3):
+            response, data = self.get_json(url, headers=headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['numvotes'], 5)
+        self.assertEqual(db.session.query(Vote.numvotes).scalar(), 2)
+
+        hapcat.votebuffer.votes.flush()
+        db.session.expire_all()
+
+        self.assertEqual(db.session.query(Vote.numvotes).scalar(), 5)
+
+        response, data = self.get_json(url, headers=headers)
+
+        self.assertEqual(data['numvotes'], 6)
+
+        hapcat.votebuffer.votes.flush()
+        db.session.expire_all()
+
+        self.assertEqual(db.session.query(Vote.numvotes).scalar(), 6)
+
+    def stored(self, user):
+        """Get the user's stored votes, by votable ID.
+        """
+
+        db.session.expire_all()
+
+        return dict(
+            db.session.query(Vote.votable_id, Vote.numvotes).filter(
+                Vote.user_id == user.id,
+            )
+        )
+
+    def wait_for(self, user, expected):
+        """Wait for the background thread to store the user's votes.
+        """
+
+        deadline = time.time() + 5
+
+        while self.stored(user) != expected and time.time() < deadline:
+            time.sleep(0.05)
+
+        self.assertEqual(self.stored(user), expected)
+
+    def test_flush_size(self):
+        """Test enough buffered votes wake the background thread up.
+        """
+
+        user, headers = self.make_user()
+        locations = [
+            locationid
+            for (locationid,) in db.session.query(Location.id).limit(2)
+        ]
+
+        app.iniconfig.set('apiserver', 'vote_flush_size', '2')
+        self.addCleanup(
+            app.iniconfig.set,
+            'apiserver',
+            'vote_flush_size',
+            self.oldconfig['vote_flush_size'],
+        )
+
+        hapcat.votebuffer.votes.add(locations[0], user.id)
+
+        time.sleep(0.2)
+
+        self.assertEqual(self.stored(user), {})
+
+        hapcat.votebuffer.votes.add(locations[1], user.id)
+
+        self.wait_for(user, {locations[0]: 1, locations[1]: 1})
+
+    def test_background_flush(self):
+        """Test buffered votes are written after the flush interval.
+        """
+
+        user, headers = self.make_user()
+        location = db.session.query(Location.id).first()[0]
+
+        app.iniconfig.set('apiserver', 'vote_flush_interval', '0.1')
+
+        hapcat.votebuffer.votes.add(location, user.id)
+
+        self.wait_for(user, {location: 1})
+
+    def test_flush_waits(self):
+        """Test a flush waits for one in progress, and then writes the rest.
+        """
+
+        user, headers = self.make_user()
+        locations = [
+            locationid
+            for (locationid,) in db.session.query(Location.id).limit(2)
+        ]
+
+        writing = threading.Event()
+        release = threading.Event()
+        add_votes_many = hapcat.dbutil.add_votes_many
+
+        def slow_add_votes_many(session, votes):
+            votes = list(votes)
+            writing.set()
+            release.wait(5)
+
+            return add_votes_many(session, votes)
+
+        hapcat.dbutil.add_votes_many = slow_add_votes_many
+        self.addCleanup(
+            setattr,
+            hapcat.dbutil,
+            'add_votes_many',
+            add_votes_many,
+        )
+
+        buffer = hapcat.votebuffer.votes
+
+        buffer.add(locations[0], user.id)
+
+        first = threading.Thread(target=buffer.flush)
+        first.start()
+        writing.wait(5)
+
+        buffer.add(locations[1], user.id)
+
+        second = threading.Thread(target=buffer.flush)
+        second.start()
+        second.join(0.2)
+
+        self.assertTrue(second.is_alive())
+
+        release.set()
+        first.join(5)
+        second.join(5)
+
+        self.assertEqual(
+            self.stored(user),
+            {locations[0]: 1, locations[1]: 1},
+        )
+
+    def test_buffered_batch_vote(self):
+        """Test a buffered batch reads the stored votes in one query.
+        """
+
+        user, headers = self.make_user()
+
+        locations = [
+            locationid
+            for (locationid,) in db.session.query(Location.id).limit(5)
+        ]
+
+        db.session.add(
+            Vote(votable_id=locations[0], user_id=user.id, numvotes=2)
+        )
+        db.session.commit()
+
+        # Cache the user's token version first.
+        self.get_json('/debug/protectedtest/', headers=headers)
+
+        votes = [{'votable': str(locationid)} for locationid in locations]
+        votes.append({'votable': str(uuid.uuid4())})
+
+        with count_queries() as statements:
+            response = self.client.post(
+                '/api/v0/votes/',
+                data=json.dumps({'votes': votes}),
+                headers=headers,
+            )
+
+        results = json.loads(response.get_data(as_text=True))['results']
+
+        self.assertEqual(
+            [result.get('numvotes') for result in results],
+            [3, 1, 1, 1, 1, None],
+        )
+        self.assertEqual(results[-1]['message'], 'No such votable')
+
+        # The votables, and their stored votes.
+        self.assertLessEqual(len(statements), 2)
+
+    def test_buffered_vote_invalid(self):
+        """Test buffered votes for nonexistent votables fail immediately.
+        """
+
+        user, headers = self.make_user()
+
+        response, data = self.get_json(
+            '/api/v0/vote/{0}/'.format(uuid.uuid4()),
+            headers=headers,
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'No such votable')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.application module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import sqlalchemy
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.application
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.application
+
+from hapcat import (
+    app,
+    db,
+)
+
+from hapcat.models import Secret
+
+
+class TestJWTSecret(unittest.TestCase):
+    """Test loading the JWT secret.
+    """
+
+    def setUp(self):
+        """Set up a directory for key files, and keep the current secret.
+        """
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'jwtsecret')
+
+        self.oldpath = app.iniconfig.get('apiserver', 'jwt_secret_file')
+
+        with app.app_context():
+            self.oldsecret = db.session.query(Secret).get(u'jwtsecret')
+            db.session.expunge_all()
+
+    def tearDown(self):
+        """Restore the secret and configuration, and remove the key files.
+        """
+
+        app.iniconfig.set('apiserver', 'jwt_secret_file', self.oldpath)
+
+        with app.app_context():
+            db.session.query(Secret).delete()
+
+            if self.oldsecret is not None:
+                db.session.add(self.oldsecret)
+
+            db.session.commit()
+
+        shutil.rmtree(self.tmpdir)
+
+    def count_statements(self):
+        """Count the SQL statements executed from now on.
+
+        :returns: The list the statements are appended to.
+        """
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(
+            db.engine,
+            'before_cursor_execute',
+            before_cursor_execute,
+        )
+
+        self.addCleanup(
+            sqlalchemy.event.remove,
+            db.engine,
+            'before_cursor_execute',
+            before_cursor_execute,
+        )
+
+        return statements
+
+    def test_database(self):
+        """Test the secret is generated once, and then read in one query.
+        """
+
+        with app.app_context():
+            db.session.query(Secret).delete()
+            db.session.commit()
+
+            secret = hapcat.application.makejwtsecret()
+
+            self.assertEqual(len(secret), 64)
+            self.assertEqual(db.session.query(Secret).count(), 1)
+
+            statements = self.count_statements()
+
+            self.assertEqual(hapcat.application.makejwtsecret(), secret)
+            self.assertEqual(len(statements), 1)
+
+    def test_insert_existing(self):
+        """Test inserting a secret keeps one that's already there.
+        """
+
+        with app.app_context():
+            db.session.query(Secret).delete()
+            db.session.commit()
+
+            hapcat.application.insertsecret(db.session, u'test', b'first')
+            hapcat.application.insertsecret(db.session, u'test', b'second')
+
+            self.assertEqual(
+                hapcat.application.loadsecret(db.session, u'test'),
+                b'first',
+            )
+
+    def test_file(self):
+        """Test the key file is written from the database, and then read
+        without querying.
+        """
+
+        app.iniconfig.set('apiserver', 'jwt_secret_file', self.path)
+
+        with app.app_context():
+            secret = hapcat.application.loadsecret(db.session, u'jwtsecret')
+
+            self.assertEqual(hapcat.application.makejwtsecret(), secret)
+            self.assertTrue(os.path.exists(self.path))
+
+            statements = self.count_statements()
+
+            self.assertEqual(hapcat.application.makejwtsecret(), secret)
+            self.assertEqual(statements, [])
+
+    def test_file_existing(self):
+        """Test a key file isn't replaced.
+        """
+
+        with open(self.path, 'w') as secretfile:
+            secretfile.write('00ff\n')
+
+        self.assertEqual(
+            hapcat.application.writesecretfile(self.path, b'\x01'),
+            b'\x00\xff',
+        )
+
+        self.assertEqual(os.listdir(self.tmpdir), ['jwtsecret'])
+
+
+class TestStart(unittest.TestCase):
+    """Test starting the application.
+    """
+
+    def setUp(self):
+        """Keep the real JWT secret loader, and leave the schema alone.
+        """
+
+        self.makejwtsecret = hapcat.application.makejwtsecret
+        self.oldmigrations = app.iniconfig.get('database', 'migrations')
+
+        app.iniconfig.set('database', 'migrations', 'never')
+
+    def tearDown(self):
+        """Restore the JWT secret loader and configuration, and make sure
+        the application is started.
+        """
+
+        hapcat.application.makejwtsecret = self.makejwtsecret
+        hapcat.application.start()
+
+        app.iniconfig.set('database', 'migrations', self.oldmigrations)
+
+    def test_retry(self):
+        """Test a failed start is tried again.
+        """
+
+        failures = []
+
+        def fail():
+            failures.append(True)
+            hapcat.application.makejwtsecret = self.makejwtsecret
+
+            raise RuntimeError('Failed to load the JWT secret')
+
+        hapcat.application._started = False
+        hapcat.application.makejwtsecret = fail
+
+        with self.assertRaises(RuntimeError):
+            hapcat.application.start()
+
+        self.assertFalse(hapcat.application._started)
+
+        hapcat.application.start()
+
+        self.assertEqual(failures, [True])
+        self.assertTrue(hapcat.application._started)
+        self.assertEqual(len(app.config['SECRET_KEY']), 64)
+
+    def test_release_connections(self):
+        """Test starting closes the pooled connections before forking.
+        """
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        configpath = os.path.join(tmpdir, 'hapcatd.conf')
+
+        with open(configpath, 'w') as configfile:
+            configfile.write(
+                '[database]\n'
+                'dburl = sqlite:///{0}\n'
+                'migrations = never\n'
+                'pool_size = 2\n'
+                .format(os.path.join(tmpdir, 'hapcat.db'))
+            )
+
+        env = dict(os.environ)
+        env['HAPCAT_FLASK_CONFIG'] = configpath
+        env['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(hapcat.application.__file__),
+        )
+
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                '-c',
+                'import hapcat.application, hapcat.models\n'
+                'with hapcat.application.app.app_context():\n'
+                '    hapcat.application.db.create_all()\n'
+                'print(hapcat.application.db.engine.pool.checkedin())\n'
+                'hapcat.application.start()\n'
+                'print(hapcat.application.db.engine.pool.checkedin())\n',
+            ],
+            env=env,
+        )
+
+        self.assertEqual(output.decode('ascii').split(), ['1', '0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.config module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.config
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.config
+
+
+CONFIG = u'''# The passwords.
+[passwords]
+
+# The number of passes.
+argon2_time_cost = 3
+
+#argon2_memory_cost = 1024
+
+
+# The database.
+[database]
+dburl = sqlite://
+'''
+
+
+class TestSetOptions(unittest.TestCase):
+    """Test setting options in a configuration file.
+    """
+
+    def setUp(self):
+        """Write a configuration file.
+        """
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'hapcatd.conf')
+
+        with open(self.filename, 'w') as conffile:
+            conffile.write(CONFIG)
+
+    def tearDown(self):
+        """Remove the configuration file.
+        """
+
+        shutil.rmtree(self.tmpdir)
+
+    def read(self):
+        """Read the configuration file back.
+        """
+
+        with open(self.filename) as conffile:
+            return conffile.read()
+
+    def test_set_options(self):
+        """Test options are changed in place, or added to their section.
+        """
+
+        hapcat.config.set_options(
+            self.filename,
+            'passwords',
+            {
+                'argon2_time_cost': 2,
+                'argon2_memory_cost': 4096,
+            },
+        )
+
+        self.assertEqual(
+            self.read(),
+            CONFIG.replace(
+                u'argon2_time_cost = 3\n',
+                u'argon2_time_cost = 2\nargon2_memory_cost = 4096\n',
+            ),
+        )
+
+    def test_new_section(self):
+        """Test a missing section is added to the end.
+        """
+
+        hapcat.config.set_options(
+            self.filename,
+            'recommender',
+            {'factors': 16},
+        )
+
+        self.assertEqual(
+            self.read(),
+            CONFIG + u'\n[recommender]\nfactors = 16\n',
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.dbutil module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import uuid
+
+import sqlalchemy
+import sqlalchemy.orm
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.dbutil
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.dbutil
+
+from hapcat import db
+
+from hapcat.models import (
+    Location,
+    RawLocation,
+    User,
+    Vote,
+)
+
+
+class TestAddVotes(unittest.TestCase):
+    """Test adding votes.
+    """
+
+    def setUp(self):
+        """Set up a database file with a user and a location.
+
+        This uses its own database file, rather than the application's
+        in-memory database, so each thread can have its own connection.
+        """
+
+        self.tmpdir = tempfile.mkdtemp()
+
+        self.engine = sqlalchemy.create_engine(
+            'sqlite:///{0}'.format(os.path.join(self.tmpdir, 'votes.db')),
+            connect_args={'timeout': 30},
+        )
+
+        db.metadata.create_all(self.engine)
+
+        self.Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
+
+        session = self.Session()
+
+        self.userid = uuid.uuid4()
+        self.locationid = uuid.uuid4()
+
+        user = User(
+            id=self.userid,
+            username=u'user',
+            email=u'user@example.com',
+            date_of_birth=datetime.date(1999, 9, 9),
+            password=u'correct horse battery',
+        )
+
+        location = Location(
+            id=self.locationid,
+            name=u'Location',
+            rawlocation=RawLocation(id=uuid.uuid4(), address=u'1 Main St'),
+        )
+
+        session.add_all([user, location])
+        session.commit()
+        session.close()
+
+    def tearDown(self):
+        """Remove the database file.
+        """
+
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_add_votes(self):
+        """Test votes are added to the existing total.
+        """
+
+        session = self.Session()
+
+        self.assertEqual(
+            hapcat.dbutil.add_votes(session, self.locationid, self.userid),
+            1,
+        )
+        self.assertEqual(
+            hapcat.dbutil.add_votes(
+                session,
+                self.locationid,
+                self.userid,
+                numvotes=4,
+            ),
+            5,
+        )
+
+        session.commit()
+
+        self.assertEqual(session.query(Vote.numvotes).scalar(), 5)
+
+    def test_add_votes_no_votable(self):
+        """Test votes for a nonexistent votable aren't added.
+        """
+
+        session = self.Session()
+
+        self.assertIsNone(
+            hapcat.dbutil.add_votes(session, uuid.uuid4(), self.userid)
+        )
+
+        session.commit()
+
+        self.assertEqual(session.query(Vote).count(), 0)
+
+    def test_add_votes_contention(self):
+        """Test concurrent votes for the same votable aren't lost.
+        """
+
+        numthreads = 8
+        numvotes = 25
+        errors = []
+
+        def voter():
+            session = self.Session()
+
+            try:
+                for i in range(numvotes):
+                    hapcat.dbutil.add_votes(
+                        session,
+                        self.locationid,
+                        self.userid,
+                    )
+                    session.commit()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                session.close()
+
+        threads = [
+            threading.Thread(target=voter)
+            for i in range(numthreads)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        session = self.Session()
+
+        self.assertEqual(
+            session.query(Vote.numvotes).scalar(),
+            numthreads * numvotes,
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.geo module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import math
+import random
+import unittest
+
+import numpy
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.geo
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.geo
+
+
+class TestGeo(unittest.TestCase):
+    """Test the geospatial utilities.
+    """
+
+    def test_encode(self):
+        """Test known geohashes.
+        """
+
+        self.assertEqual(
+            hapcat.geo.encode(57.64911, 10.40744, 11),
+            'u4pruydqqvj',
+        )
+        self.assertEqual(hapcat.geo.encode(-90, -180, 4), '0000')
+        self.assertEqual(hapcat.geo.encode(90, 180, 4), 'zzzz')
+
+    def test_distances(self):
+        """Test great-circle distances.
+        """
+
+        distances = hapcat.geo.distances(
+            0,
+            0,
+            numpy.array([0.0, 0.0, 90.0]),
+            numpy.array([0.0, 1.0, 0.0]),
+        )
+
+        self.assertAlmostEqual(distances[0], 0)
+        self.assertAlmostEqual(distances[1], 111195, delta=1)
+        self.assertAlmostEqual(
+            distances[2],
+            math.pi / 2 * hapcat.geo.EARTH_RADIUS,
+            delta=1,
+        )
+
+    def test_cover(self):
+        """Test the cells covering a circle contain every point in it.
+        """
+
+        rng = random.Random(1234)
+
+        for latitude, longitude, radius in (
+                (41.15, -81.36, 1000),
+                (41.15, -81.36, 50000),
+                (0.0, 179.999, 5000),
+                (-89.99, 12.0, 5000),
+                (60.0, 0.0, 200),
+            ):
+            prefixes = tuple(hapcat.geo.cover(latitude, longitude, radius))
+
+            self.assertLessEqual(len(prefixes), 32)
+
+            dlat = math.degrees(radius / hapcat.geo.EARTH_RADIUS)
+
+            for i in range(500):
+                lat = latitude + rng.uniform(-dlat, dlat)
+                lat = min(max(lat, -90), 90)
+
+                lon = longitude + rng.uniform(-2 * dlat, 2 * dlat)
+                lon = (lon + 180) % 360 - 180
+
+                distance = hapcat.geo.distances(
+                    latitude,
+                    longitude,
+                    numpy.array([lat]),
+                    numpy.array([lon]),
+                )[0]
+
+                if distance <= radius:
+                    self.assertTrue(
+                        hapcat.geo.encode(lat, lon).startswith(prefixes)
+                    )
+
+    def test_valid(self):
+        """Test coordinate validation.
+        """
+
+        self.assertTrue(hapcat.geo.valid(41.15, -81.36))
+        self.assertFalse(hapcat.geo.valid(91, 0))
+        self.assertFalse(hapcat.geo.valid(0, -181))
+        self.assertFalse(hapcat.geo.valid(float('nan'), 0))
+        self.assertFalse(hapcat.geo.valid(True, 0))
+        self.assertFalse(hapcat.geo.valid('1', 0))
+        self.assertFalse(hapcat.geo.valid(None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
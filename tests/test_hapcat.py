@@ -15,6 +15,9 @@ prone to issues, and doesn't nice and pretty output.
 See README.rst for details.
 """
 
+import os
+import subprocess
+import sys
 import unittest
 
 # If this file is run directly by a user we need to shove the path of the src
@@ -46,5 +49,35 @@ class TestThing(unittest.TestCase):
         pass
 
 
+class TestLazyStart(unittest.TestCase):
+    """Test importing the package doesn't start the application.
+    """
+
+    def test_import(self):
+        """Test the commands can be imported without importing Flask.
+        """
+
+        source = os.path.dirname(os.path.dirname(hapcat.hapcat.__file__))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = source
+
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                '-c',
+                'import sys, hapcat.hapcat; '
+                'print(hapcat.__version__); '
+                'print("hapcat.application" in sys.modules); '
+                'print("flask" in sys.modules)',
+            ],
+            env=env,
+        )
+
+        self.assertEqual(
+            output.decode('ascii').split(),
+            [hapcat.__version__, 'False', 'False'],
+        )
+
+
 if __name__ == '__main__':
     unittest.main()
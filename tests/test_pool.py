@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.pool module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import configparser
+import os
+import shutil
+import tempfile
+import unittest
+
+import sqlalchemy
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.pool
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.pool
+
+
+def make_config(**options):
+    """Make a configuration with the given database options.
+    """
+
+    database = {
+        'dburl': 'postgresql://localhost/hapcat',
+        'pool_size': '',
+        'max_overflow': '',
+        'pool_timeout': '',
+        'pool_recycle': '',
+        'pool_pre_ping': 'no',
+    }
+    database.update(options)
+
+    config = configparser.ConfigParser()
+    config.read_dict({'database': database})
+
+    return config
+
+
+class TestEngineOptions(unittest.TestCase):
+    """Test making the engine options from the configuration.
+    """
+
+    def test_defaults(self):
+        """Test empty options are left to SQLAlchemy.
+        """
+
+        self.assertEqual(
+            hapcat.pool.engine_options(make_config()),
+            {'poolclass': hapcat.pool.TimedQueuePool},
+        )
+
+    def test_options(self):
+        """Test the options are passed on.
+        """
+
+        self.assertEqual(
+            hapcat.pool.engine_options(make_config(
+                pool_size='2',
+                max_overflow='3',
+                pool_timeout='1.5',
+                pool_recycle='3600',
+                pool_pre_ping='yes',
+            )),
+            {
+                'poolclass': hapcat.pool.TimedQueuePool,
+                'pool_size': 2,
+                'max_overflow': 3,
+                'pool_timeout': 1.5,
+                'pool_recycle': 3600,
+                'pool_pre_ping': True,
+            },
+        )
+
+    def test_sqlite(self):
+        """Test SQLite databases only get a queued pool with a pool size.
+        """
+
+        self.assertEqual(
+            hapcat.pool.engine_options(make_config(
+                dburl='sqlite:///hapcat.db',
+                max_overflow='3',
+                pool_recycle='60',
+            )),
+            {'pool_recycle': 60},
+        )
+
+        self.assertEqual(
+            hapcat.pool.engine_options(make_config(
+                dburl='sqlite://',
+                pool_size='2',
+            )),
+            {},
+        )
+
+        options = hapcat.pool.engine_options(make_config(
+            dburl='sqlite:///hapcat.db',
+            pool_size='2',
+        ))
+
+        self.assertEqual(options['poolclass'], hapcat.pool.TimedQueuePool)
+        self.assertEqual(options['pool_size'], 2)
+
+
+class TestTimedQueuePool(unittest.TestCase):
+    """Test the pool statistics.
+    """
+
+    def setUp(self):
+        """Set up an engine with a small pool.
+        """
+
+        self.tmpdir = tempfile.mkdtemp()
+
+        self.engine = sqlalchemy.create_engine(
+            'sqlite:///{0}'.format(os.path.join(self.tmpdir, 'pool.db')),
+            poolclass=hapcat.pool.TimedQueuePool,
+            pool_size=1,
+            max_overflow=1,
+            pool_timeout=0.05,
+        )
+
+    def tearDown(self):
+        """Close the engine and remove the database.
+        """
+
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_stats(self):
+        """Test checkouts, overflow, and timeouts are counted.
+        """
+
+        first = self.engine.connect()
+        second = self.engine.connect()
+
+        description = hapcat.pool.describe(self.engine.pool)
+
+        self.assertEqual(description['pool'], 'TimedQueuePool')
+        self.assertEqual(description['size'], 1)
+        self.assertEqual(description['checked_out'], 2)
+        self.assertEqual(description['overflow'], 1)
+        self.assertEqual(description['checkouts'], 2)
+
+        with self.assertRaises(sqlalchemy.exc.TimeoutError):
+            self.engine.connect()
+
+        description = hapcat.pool.describe(self.engine.pool)
+
+        self.assertEqual(description['timeouts'], 1)
+        self.assertGreaterEqual(description['max_wait'], 0.05)
+        self.assertLess(description['average_wait'], 0.05)
+
+        first.close()
+        second.close()
+
+        description = hapcat.pool.describe(self.engine.pool)
+
+        self.assertEqual(description['checked_out'], 0)
+        self.assertEqual(description['checked_in'], 1)
+
+    def test_recreate(self):
+        """Test the statistics are kept when the pool is recreated.
+        """
+
+        self.engine.connect().close()
+        self.engine.dispose()
+
+        self.assertEqual(
+            hapcat.pool.describe(self.engine.pool)['checkouts'],
+            1,
+        )
+
+    def test_other_pool(self):
+        """Test other pools have no statistics.
+        """
+
+        description = hapcat.pool.describe(
+            sqlalchemy.create_engine(
+                'sqlite://',
+                poolclass=sqlalchemy.pool.StaticPool,
+            ).pool,
+        )
+
+        self.assertEqual(description['pool'], 'StaticPool')
+        self.assertIsNone(description['checkouts'])
+
+
+if __name__ == '__main__':
+    unittest.main()
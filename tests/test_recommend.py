@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.recommend module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+import sqlalchemy
+import sqlalchemy.orm
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.recommend
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.recommend
+
+from hapcat import db
+
+from hapcat.models import (
+    Location,
+    RawLocation,
+    Recommendation,
+    RecommendationRun,
+    User,
+    Vote,
+)
+
+
+class TestRecommend(unittest.TestCase):
+    """Test recommending votables from similar users' votes.
+    """
+
+    def setUp(self):
+        """Set up a database with two groups of users with different tastes.
+
+        Everyone in the first group votes for all of its locations, and
+        everyone in the second votes for all of theirs.
+        The target user votes for some of the first group's locations.
+        """
+
+        self.tmpdir = tempfile.mkdtemp()
+
+        self.engine = sqlalchemy.create_engine(
+            'sqlite:///{0}'.format(os.path.join(self.tmpdir, 'votes.db')),
+        )
+
+        db.metadata.create_all(self.engine)
+
+        self.session = sqlalchemy.orm.Session(bind=self.engine)
+
+        rawloc = RawLocation(id=uuid.uuid4(), address=u'1 Test St')
+        self.session.add(rawloc)
+
+        self.groups = []
+
+        for group in ('a', 'b'):
+            locations = [
+                Location(
+                    id=uuid.uuid4(),
+                    name=u'{0}{1}'.format(group, i),
+                    rawlocation=rawloc,
+                )
+                for i in range(5)
+            ]
+
+            self.session.add_all(locations)
+
+            users = [
+                self.make_user(u'{0}{1}'.format(group, i))
+                for i in range(6)
+            ]
+
+            for user in users:
+                for location in locations:
+                    self.session.add(Vote(
+                        votable_id=location.id,
+                        user_id=user.id,
+                        numvotes=1,
+                    ))
+
+            self.groups.append([location.id for location in locations])
+
+        self.target = self.make_user(u'target')
+
+        for location in self.groups[0][:3]:
+            self.session.add(Vote(
+                votable_id=location,
+                user_id=self.target.id,
+                numvotes=2,
+            ))
+
+        self.target = self.target.id
+
+        self.session.commit()
+
+    def tearDown(self):
+        """Remove the database.
+        """
+
+        self.session.close()
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def make_user(self, username):
+        """Add a user.
+        """
+
+        user = User(
+            id=uuid.uuid4(),
+            username=username,
+            email=u'{0}@example.com'.format(username),
+            date_of_birth=datetime.date(1999, 9, 9),
+            password=u'correct horse battery',
+        )
+
+        self.session.add(user)
+
+        return user
+
+    def recommendations(self, user_id):
+        """Get a user's recommended votables, best first.
+        """
+
+        return [
+            votable_id
+            for (votable_id,) in self.session.query(
+                Recommendation.votable_id
+            ).filter(
+                Recommendation.user_id == user_id
+            ).order_by(
+                Recommendation.rank
+            )
+        ]
+
+    def age_votes(self):
+        """Make all the votes so far older than the last run.
+        """
+
+        self.session.query(Vote).update(
+            {Vote.updated: 0},
+            synchronize_session=False,
+        )
+        self.session.commit()
+
+    def scores(self):
+        """Get everyone's recommendation scores, by user and votable.
+        """
+
+        return {
+            (user_id, votable_id): score
+            for user_id, votable_id, score in self.session.query(
+                Recommendation.user_id,
+                Recommendation.votable_id,
+                Recommendation.score,
+            )
+        }
+
+    def test_recommend(self):
+        """Test users are recommended what similar users voted for.
+        """
+
+        numusers = hapcat.recommend.recommend(self.session, factors=2)
+
+        self.assertEqual(numusers, 13)
+
+        recommended = self.recommendations(self.target)
+
+        # The rest of the first group's locations, and nothing already voted
+        # for.
+        self.assertEqual(sorted(recommended[:2]), sorted(self.groups[0][3:]))
+        self.assertFalse(set(recommended) & set(self.groups[0][:3]))
+
+    def test_batches(self):
+        """Test the recommendations don't depend on the batch size.
+        """
+
+        hapcat.recommend.recommend(self.session, factors=2, batch=1000)
+        whole = self.scores()
+
+        hapcat.recommend.recommend(
+            self.session,
+            factors=2,
+            batch=4,
+            full=True,
+        )
+        batched = self.scores()
+
+        # Tied votables may come in either order.
+        self.assertEqual(sorted(whole), sorted(batched))
+
+        for key, score in whole.items():
+            self.assertAlmostEqual(score, batched[key])
+
+    def test_removed_votes(self):
+        """Test users whose votes are gone lose their recommendations.
+        """
+
+        hapcat.recommend.recommend(self.session, factors=2)
+        self.assertTrue(self.recommendations(self.target))
+
+        self.session.query(Vote).filter(
+            Vote.user_id == self.target
+        ).delete()
+        self.session.commit()
+
+        hapcat.recommend.recommend(self.session, factors=2)
+        self.assertFalse(self.recommendations(self.target))
+
+    def test_incremental(self):
+        """Test only the users who voted since the last run are updated.
+        """
+
+        hapcat.recommend.recommend(self.session, factors=2)
+        self.age_votes()
+        before = self.scores()
+
+        late = self.make_user(u'late')
+
+        for location in self.groups[1][:3]:
+            self.session.add(Vote(
+                votable_id=location,
+                user_id=late.id,
+                numvotes=1,
+            ))
+
+        late = late.id
+        self.session.commit()
+
+        numusers = hapcat.recommend.recommend(self.session, factors=2)
+
+        self.assertEqual(numusers, 1)
+
+        run = self.session.query(RecommendationRun).order_by(
+            RecommendationRun.id.desc()
+        ).first()
+
+        self.assertFalse(run.full)
+        self.assertEqual(run.users, 1)
+
+        # The new user is projected onto the stored factors.
+        self.assertEqual(
+            sorted(self.recommendations(late)[:2]),
+            sorted(self.groups[1][3:]),
+        )
+
+        # Nobody else's recommendations changed.
+        after = self.scores()
+
+        self.assertEqual(
+            {key: score for key, score in after.items() if key[0] != late},
+            before,
+        )
+
+        # With no new votes, there's nothing to do.
+        self.age_votes()
+
+        self.assertEqual(
+            hapcat.recommend.recommend(self.session, factors=2),
+            0,
+        )
+        self.assertEqual(self.scores(), after)
+
+    def test_rebuild(self):
+        """Test the factors are found from all the votes again when due.
+        """
+
+        hapcat.recommend.recommend(self.session, factors=2)
+        self.age_votes()
+
+        self.assertEqual(
+            hapcat.recommend.recommend(self.session, factors=2),
+            0,
+        )
+
+        # Forced.
+        self.assertEqual(
+            hapcat.recommend.recommend(self.session, factors=2, full=True),
+            13,
+        )
+
+        # The interval has passed.
+        self.assertEqual(
+            hapcat.recommend.recommend(
+                self.session,
+                factors=2,
+                rebuild_interval=0,
+            ),
+            13,
+        )
+
+        # The number of factors changed.
+        self.assertEqual(
+            hapcat.recommend.recommend(self.session, factors=3),
+            13,
+        )
+
+        # The last full run didn't finish.
+        self.session.add(RecommendationRun(
+            started=0,
+            full=True,
+            factors=3,
+        ))
+        self.session.commit()
+
+        self.assertEqual(
+            hapcat.recommend.recommend(self.session, factors=3),
+            13,
+        )
+        self.assertEqual(
+            hapcat.recommend.recommend(self.session, factors=3),
+            0,
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
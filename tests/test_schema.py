@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.schema module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import alembic.script
+import flask_migrate
+import pkg_resources
+import sqlalchemy
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.schema
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.schema
+
+from hapcat import app
+
+
+class TestUpgrade(unittest.TestCase):
+    """Test upgrading the schema only when it's out of date.
+    """
+
+    def setUp(self):
+        """Set up an empty database, and count the migrations run.
+        """
+
+        self.tmpdir = tempfile.mkdtemp()
+
+        self.engine = sqlalchemy.create_engine(
+            'sqlite:///{0}'.format(os.path.join(self.tmpdir, 'schema.db')),
+        )
+
+        self.oldlock = app.iniconfig.get('database', 'migration_lock')
+        app.iniconfig.set(
+            'database',
+            'migration_lock',
+            os.path.join(self.tmpdir, 'migrations.lock'),
+        )
+
+        self.upgrades = []
+        self.oldupgrade = flask_migrate.upgrade
+        flask_migrate.upgrade = lambda: self.upgrades.append(True)
+
+    def tearDown(self):
+        """Remove the database, and restore Flask-Migrate.
+        """
+
+        flask_migrate.upgrade = self.oldupgrade
+        app.iniconfig.set('database', 'migration_lock', self.oldlock)
+
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def set_revision(self, revision):
+        """Record the database as migrated to a revision.
+        """
+
+        with self.engine.begin() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS alembic_version '
+                '(version_num VARCHAR(32) NOT NULL)'
+            )
+            connection.execute('DELETE FROM alembic_version')
+            connection.execute(
+                sqlalchemy.text(
+                    'INSERT INTO alembic_version VALUES (:revision)'
+                ),
+                revision=revision,
+            )
+
+    def test_head_revision(self):
+        """Test the head revision constant matches the migrations.
+        """
+
+        scripts = alembic.script.ScriptDirectory(
+            pkg_resources.resource_filename('hapcat', 'migrations'),
+        )
+
+        self.assertEqual(hapcat.schema.HEAD_REVISION, scripts.get_current_head())
+
+    def test_current(self):
+        """Test an up to date database isn't migrated.
+        """
+
+        self.set_revision(hapcat.schema.HEAD_REVISION)
+
+        with app.app_context():
+            self.assertFalse(hapcat.schema.upgrade(self.engine))
+
+        self.assertEqual(self.upgrades, [])
+
+    def test_out_of_date(self):
+        """Test new and old databases are migrated.
+        """
+
+        with app.app_context():
+            self.assertIsNone(hapcat.schema.current_revision(self.engine))
+            self.assertTrue(hapcat.schema.upgrade(self.engine))
+
+            self.set_revision('e61f4a9d27b3')
+
+            self.assertTrue(hapcat.schema.upgrade(self.engine))
+
+        self.assertEqual(len(self.upgrades), 2)
+
+    def test_modes(self):
+        """Test always and never migrating.
+        """
+
+        self.set_revision(hapcat.schema.HEAD_REVISION)
+
+        with app.app_context():
+            self.assertTrue(hapcat.schema.upgrade(self.engine, 'always'))
+            self.assertFalse(hapcat.schema.upgrade(self.engine, 'never'))
+
+            with self.assertRaises(ValueError):
+                hapcat.schema.upgrade(self.engine, 'sometimes')
+
+        self.assertEqual(len(self.upgrades), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
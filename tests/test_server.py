@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.server module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    from urllib.request import (
+        Request,
+        urlopen,
+    )
+except ImportError:
+    from urllib2 import (
+        Request,
+        urlopen,
+    )
+
+import sqlalchemy
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.server
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.server
+
+from hapcat import db
+from hapcat.models import Vote
+
+CONFIG = '''
+[apiserver]
+address = 127.0.0.1
+port = {port}
+poolstats = yes
+buffer_votes = yes
+vote_flush_interval = 600
+
+[database]
+dburl = sqlite:///{database}
+migrations = never
+
+[passwords]
+argon2_time_cost = 1
+argon2_memory_cost = 1024
+argon2_parallelism = 1
+
+[uwsgi]
+processes = 2
+threads = 2
+'''
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+class TestPreforkServer(unittest.TestCase):
+    """Test serving from several processes with hapcatd.
+    """
+
+    def setUp(self):
+        """Start hapcatd on a free port, with a fresh database.
+        """
+
+        self.tmpdir = tempfile.mkdtemp()
+        database = os.path.join(self.tmpdir, 'server.db')
+
+        self.engine = sqlalchemy.create_engine(
+            'sqlite:///{0}'.format(database),
+        )
+        db.metadata.create_all(self.engine)
+
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+
+        self.configpath = configpath = os.path.join(
+            self.tmpdir,
+            'hapcatd.conf',
+        )
+
+        with open(configpath, 'w') as configfile:
+            configfile.write(CONFIG.format(port=self.port, database=database))
+
+        env = dict(os.environ)
+        env.pop('HAPCAT_FLASK_CONFIG', None)
+        env['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(os.path.abspath(hapcat.server.__file__))
+        )
+
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'hapcat.hapcat', '-c', configpath],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        self.wait_for_workers()
+
+    def tearDown(self):
+        """Stop hapcatd, and remove the database.
+        """
+
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def request(self, path, data=None, token=None):
+        """Request a path, returning the JSON response.
+
+        :param data: The JSON to post, if any.
+
+        :param str token: The access token to authorize with, if any.
+        """
+
+        request = Request('http://127.0.0.1:{0}{1}'.format(self.port, path))
+
+        if data is not None:
+            request.add_header('Content-Type', 'application/json')
+            request.data = json.dumps(data).encode('utf-8')
+
+        if token is not None:
+            request.add_header('Authorization', 'JWT {0}'.format(token))
+
+        response = urlopen(request, timeout=30)
+
+        return json.loads(response.read().decode('utf-8'))
+
+    def get_pid(self):
+        """Get the ID of the process answering a request.
+        """
+
+        response = urlopen(
+            'http://127.0.0.1:{0}/api/v0/poolstats/'.format(self.port),
+            timeout=10,
+        )
+
+        return json.loads(response.read().decode('utf-8'))['pid']
+
+    def wait_for_workers(self, old=()):
+        """Wait until workers other than the given ones answer.
+
+        :returns: The IDs of the workers seen answering.
+        """
+
+        deadline = time.time() + 30
+        pids = set()
+
+        while time.time() < deadline:
+            try:
+                pid = self.get_pid()
+            except (IOError, OSError):
+                time.sleep(0.1)
+                continue
+
+            if pid not in old:
+                pids.add(pid)
+
+                if len(pids) == 2:
+                    return pids
+
+        self.fail('The workers did not answer')
+
+    def test_workers(self):
+        """Test workers answer, reloading replaces them, and stopping stops
+        everything.
+        """
+
+        pids = self.wait_for_workers()
+
+        self.assertNotIn(self.process.pid, pids)
+
+        self.process.send_signal(signal.SIGHUP)
+
+        # The old workers answer until the new ones are ready.
+        self.get_pid()
+
+        self.assertFalse(pids & self.wait_for_workers(old=pids))
+
+        self.process.send_signal(signal.SIGTERM)
+
+        self.assertEqual(self.process.wait(30), 0)
+
+    def test_stop_flushes_votes(self):
+        """Test votes the workers have buffered are written when stopping.
+        """
+
+        self.request('/api/v0/register/', {
+            'username': u'user',
+            'password': u'correct horse battery staple',
+            'email': u'user@example.com',
+            'date_of_birth': {'year': 1999, 'month': 9, 'day': 9},
+        })
+
+        token = self.request('/api/v0/login/', {
+            'username': u'user',
+            'password': u'correct horse battery staple',
+        })['access_token']
+
+        votable = self.request('/api/v0/addlocation/', {
+            'type': 'location',
+            'name': u'Location',
+            'address': u'175 E Main St, Kent, OH 44240',
+            'tags': [],
+            'photos': [],
+        }, token)['votable']['id']
+
+        for i in range(3):
+            self.request('/api/v0/vote/{0}/'.format(votable), token=token)
+
+        votes = sqlalchemy.select([sqlalchemy.func.sum(Vote.numvotes)])
+
+        self.assertIsNone(self.engine.scalar(votes))
+
+        self.process.send_signal(signal.SIGTERM)
+
+        self.assertEqual(self.process.wait(30), 0)
+        self.assertEqual(self.engine.scalar(votes), 3)
+
+    def test_reload_fails(self):
+        """Test the workers keep serving if the reloaded code fails to start.
+        """
+
+        pids = self.wait_for_workers()
+
+        with open(self.configpath, 'w') as configfile:
+            configfile.write('[apiserver\n')
+
+        self.process.send_signal(signal.SIGHUP)
+
+        # Give the check time to fail.
+        time.sleep(5)
+
+        self.assertIsNone(self.process.poll())
+        self.assertEqual(self.wait_for_workers(), pids)
+
+        self.process.send_signal(signal.SIGTERM)
+
+        self.assertEqual(self.process.wait(30), 0)
+
+
+class TestRespawn(unittest.TestCase):
+    """Test replacing workers which exited.
+    """
+
+    def setUp(self):
+        """Make a server which only records spawning workers.
+        """
+
+        self.server = hapcat.server.PreforkServer('127.0.0.1', 0, 1, 1)
+        self.spawned = []
+        self.server.spawn = lambda: self.spawned.append(time.time())
+
+    def test_backoff(self):
+        """Test workers which keep exiting soon after starting are replaced
+        after a growing delay, and others at once.
+        """
+
+        delays = []
+
+        for i in range(10):
+            self.server.lost(time.time())
+            delays.append(self.server._respawn_at - time.time())
+            self.server._respawn_at = 0
+            self.server.respawn()
+
+        self.assertEqual(len(self.spawned), 10)
+        self.assertEqual(delays, sorted(delays))
+        self.assertGreater(delays[-1], 1)
+        self.assertLessEqual(delays[-1], hapcat.server.MAX_RESPAWN_DELAY)
+
+        self.server.lost(time.time() - hapcat.server.MIN_WORKER_LIFETIME)
+        self.server.respawn()
+
+        self.assertEqual(len(self.spawned), 11)
+
+    def test_delay(self):
+        """Test workers aren't replaced until the delay has passed.
+        """
+
+        self.server.lost(time.time())
+        self.server.lost(time.time())
+
+        self.assertGreater(self.server._respawn_at, time.time())
+
+        self.server.respawn()
+
+        self.assertEqual(self.spawned, [])
+
+        self.server._respawn_at = 0
+        self.server.respawn()
+
+        self.assertEqual(len(self.spawned), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.strength module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import sys
+import time
+import unittest
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.strength
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.strength
+
+from hapcat import app
+
+
+class TestStrengthChecker(unittest.TestCase):
+    """Test checking password strengths in worker processes.
+    """
+
+    def setUp(self):
+        """Use a fresh checker, which gives up quickly.
+        """
+
+        self.oldconfig = dict(app.iniconfig.items('passwords'))
+
+        app.iniconfig.set('passwords', 'strength_workers', '1')
+        app.iniconfig.set('passwords', 'strength_timeout', '0.5')
+
+        self.checker = hapcat.strength.StrengthChecker()
+
+    def tearDown(self):
+        """Stop the workers and restore the configuration.
+        """
+
+        self.checker.close()
+
+        for key, value in self.oldconfig.items():
+            app.iniconfig.set('passwords', key, value)
+
+    def test_check(self):
+        """Test weak passwords and ones like the user's details are refused.
+        """
+
+        strong, feedback = self.checker.check(u'password', [])
+
+        self.assertFalse(strong)
+        self.assertTrue(feedback['warning'])
+
+        strong, feedback = self.checker.check(
+            u'vanilla giraffe marmalade',
+            [u'user'],
+        )
+
+        self.assertTrue(strong)
+
+        strong, feedback = self.checker.check(
+            u'vanilla giraffe marmalade',
+            [u'vanilla giraffe marmalade'],
+        )
+
+        self.assertFalse(strong)
+
+    def test_long_password(self):
+        """Test only the first characters of long passwords are checked.
+        """
+
+        began = time.time()
+        strong, feedback = self.checker.check(u'a1!' * 10000, [])
+
+        self.assertFalse(strong)
+        self.assertLess(time.time() - began, 0.5)
+
+    def test_lazy_import(self):
+        """Test zxcvbn is only imported by the workers.
+        """
+
+        self.checker.check(u'password', [])
+
+        self.assertNotIn('zxcvbn', sys.modules)
+
+    def test_timeout(self):
+        """Test stuck checks are given up on, and the workers replaced.
+        """
+
+        with self.assertRaises(hapcat.strength.StrengthCheckTimeout):
+            self.checker.run(time.sleep, 5)
+
+        strong, feedback = self.checker.check(u'password', [])
+
+        self.assertFalse(strong)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.tagindex module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import unittest
+import uuid
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.tagindex
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.tagindex
+
+from hapcat import (
+    app,
+    db,
+)
+
+from hapcat.models import VotableTag
+
+
+class TestTagIndex(unittest.TestCase):
+    """Test adding votables to the tag index.
+    """
+
+    def setUp(self):
+        """Build an empty index which doesn't expire.
+        """
+
+        self.oldttl = app.iniconfig.get('apiserver', 'tag_index_ttl')
+        app.iniconfig.set('apiserver', 'tag_index_ttl', '3600')
+
+        self.context = app.app_context()
+        self.context.push()
+
+        db.session.query(VotableTag).delete()
+        db.session.commit()
+
+        self.index = hapcat.tagindex.TagIndex()
+        self.index.match([])
+
+        self.tags = [uuid.uuid4() for i in range(3)]
+
+    def tearDown(self):
+        """Restore the configuration.
+        """
+
+        db.session.rollback()
+        self.context.pop()
+
+        app.iniconfig.set('apiserver', 'tag_index_ttl', self.oldttl)
+
+    def test_batch(self):
+        """Test votables added at once are all merged by the next query.
+        """
+
+        events = sorted(uuid.uuid4() for i in range(50))
+        location = uuid.uuid4()
+
+        for i, votable_id in enumerate(events):
+            self.index.add(votable_id, 'event', self.tags[:1 + i % 2])
+
+        self.index.add(location, 'location', self.tags[2:])
+
+        # Nothing is copied until the index is queried.
+        self.assertEqual(len(self.index._ids), 0)
+
+        matches = self.index.match(self.tags[:2], 'all')
+
+        self.assertEqual(len(self.index._ids), 51)
+        self.assertEqual(
+            matches.page('events', 100),
+            events[1::2],
+        )
+        self.assertEqual(
+            self.index.match(self.tags, 'any').page('locations', 100),
+            [location],
+        )
+
+    def test_old_matches(self):
+        """Test matches found before an addition don't change.
+        """
+
+        first = uuid.uuid4()
+        self.index.add(first, 'event', self.tags)
+
+        matches = self.index.match(self.tags)
+
+        second = uuid.uuid4()
+        self.index.add(second, 'event', self.tags)
+
+        self.assertEqual(matches.page('events', 10), [first])
+        self.assertEqual(
+            self.index.match(self.tags).page('events', 10),
+            sorted([first, second]),
+        )
+
+    def test_readded(self):
+        """Test adding a votable again with more tags keeps it once.
+        """
+
+        votable_id = uuid.uuid4()
+
+        self.index.add(votable_id, 'event', self.tags[:1])
+        self.index.match(self.tags)
+        self.index.add(votable_id, 'event', self.tags)
+
+        self.assertEqual(
+            self.index.match(self.tags, 'all').page('events', 10),
+            [votable_id],
+        )
+        self.assertEqual(len(self.index._ids), 1)
+
+    def test_scores(self):
+        """Test added votables are scored.
+        """
+
+        votable_id = uuid.uuid4()
+        self.index.add(votable_id, 'location', self.tags[:2])
+
+        scores = self.index.scores({self.tags[0]: 1.0, self.tags[1]: 2.0})
+
+        self.assertEqual(scores.top('locations', 10), [(votable_id, 3.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
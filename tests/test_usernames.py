@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Test the hapcat.usernames module.
+
+This module may be run in several ways.
+
+The preferred method is to use tox in the root directory of the source
+tree.
+tox can take care of all the details easily.
+
+Alternatively, this module can be run directly, which may be more
+prone to issues, and doesn't nice and pretty output.
+
+See README.rst for details.
+"""
+
+import threading
+import unittest
+
+# If this file is run directly by a user we need to shove the path of the src
+# directory onto Python's path.
+# Try to import the module first, though.
+try:
+    import hapcat.usernames
+except ImportError:
+    # Put the src directory into the path and try to import again.
+    import path_hack
+    path_hack.put_src_on_path()
+    import hapcat.usernames
+
+
+class TestBloomFilter(unittest.TestCase):
+    """Test the Bloom filter of usernames.
+    """
+
+    def setUp(self):
+        """Make some usernames.
+        """
+
+        self.usernames = [u'user{0}'.format(i) for i in range(5000)]
+        self.others = [u'other{0}'.format(i) for i in range(5000)]
+
+    def test_add(self):
+        """Test added usernames are always found, and few others are.
+        """
+
+        bloom = hapcat.usernames.BloomFilter(len(self.usernames), 0.01)
+
+        for username in self.usernames:
+            bloom.add(username)
+
+        self.assertTrue(all(username in bloom for username in self.usernames))
+        self.assertLess(
+            sum(username in bloom for username in self.others),
+            len(self.others) * 0.03,
+        )
+
+    def test_update(self):
+        """Test adding usernames at once sets the same bits.
+        """
+
+        one = hapcat.usernames.BloomFilter(len(self.usernames), 0.01)
+        many = hapcat.usernames.BloomFilter(len(self.usernames), 0.01)
+
+        for username in self.usernames:
+            one.add(username)
+
+        many.update(self.usernames)
+
+        self.assertEqual(one._bits.tolist(), many._bits.tolist())
+
+    def test_unicode(self):
+        """Test usernames outside ASCII.
+        """
+
+        bloom = hapcat.usernames.BloomFilter(10, 0.01)
+        bloom.update([u'ünïcødé'])
+
+        self.assertIn(u'ünïcødé', bloom)
+
+    def test_empty(self):
+        """Test an empty filter has nothing.
+        """
+
+        bloom = hapcat.usernames.BloomFilter(0, 0.01)
+        bloom.update([])
+
+        self.assertNotIn(u'user', bloom)
+
+
+class BlockingSession(object):
+    """A session whose reads wait until they're released.
+    """
+
+    def __init__(self, usernames):
+        self.usernames = usernames
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def execute(self, statement):
+        self.started.set()
+        self.released.wait(10)
+
+        return [(username,) for username in self.usernames]
+
+
+class TestUsernameIndex(unittest.TestCase):
+    """Test the index of known usernames.
+    """
+
+    def test_rebuild(self):
+        """Test usernames are checked and added while the filter is rebuilt,
+        and those added meanwhile are kept.
+        """
+
+        index = hapcat.usernames.UsernameIndex()
+
+        session = BlockingSession([u'old'])
+        session.released.set()
+        index._ensure(session)
+
+        # Make the filter stale.
+        index._built = 0
+
+        session = BlockingSession([u'old', u'other'])
+        rebuild = threading.Thread(target=index._ensure, args=(session,))
+        rebuild.start()
+
+        try:
+            self.assertTrue(session.started.wait(10))
+
+            index.add(u'new')
+
+            bloom = index._ensure(BlockingSession([]))
+
+            self.assertIn(u'old', bloom)
+            self.assertNotIn(u'other', bloom)
+        finally:
+            session.released.set()
+            rebuild.join(10)
+
+        bloom = index._ensure(BlockingSession([]))
+
+        for username in [u'old', u'other', u'new']:
+            self.assertIn(username, bloom)
+
+
+if __name__ == '__main__':
+    unittest.main()